@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -85,6 +86,15 @@ DATABASES = {
     'default': env.db(engine='django.db.backends.postgresql_psycopg2')
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    # rendered annotation responses, size is bounded by max_entries
+    'annotations': env.cache('ANNOTATION_CACHE_URL', default='locmemcache://annotations?max_entries=1000'),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -125,7 +135,9 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 # Minio settings
-DEFAULT_FILE_STORAGE = 'minio_storage.storage.MinioMediaStorage'
+# calls to the media storage are recorded into request metrics
+DEFAULT_FILE_STORAGE = 'core.storage.InstrumentedStorage'
+MEDIA_STORAGE = 'minio_storage.storage.MinioMediaStorage'
 
 MINIO_STORAGE_ENDPOINT = env('MINIO_ENDPOINT')
 MINIO_STORAGE_ACCESS_KEY = env('MINIO_ACCESS_KEY')
@@ -135,9 +147,60 @@ MINIO_STORAGE_USE_HTTPS = False
 MINIO_STORAGE_MEDIA_BUCKET_NAME = 'media'
 MINIO_STORAGE_AUTO_CREATE_MEDIA_BUCKET = True
 
+# files are hashed while they're uploaded, the hash is used to store their content only once
+FILE_UPLOAD_HANDLERS = [
+    'core.utils.HashingMemoryFileUploadHandler',
+    'core.utils.HashingTemporaryFileUploadHandler',
+]
+
 MEDIA_UPLOAD_URL_EXPIRES = timedelta(minutes=1)
 MEDIA_DOWNLOAD_TTL = timedelta(minutes=10)
+MEDIA_DOWNLOAD_URL_REFRESH = timedelta(minutes=1)  # presigned urls aren't reused when they're this close to expiry
+MEDIA_DOWNLOAD_MODE = env('MEDIA_DOWNLOAD_MODE', default='proxy')  # proxy, redirect or url
+
+ASYNC_DOWNLOAD_CHUNK_SIZE = 256 * 1024  # size of ranged storage reads of downloads served over ASGI
+
+# local disk cache of downloaded files, disabled if the directory isn't set
+MEDIA_DISK_CACHE_DIR = env('MEDIA_DISK_CACHE_DIR', default=None)
+MEDIA_DISK_CACHE_MAX_BYTES = env.int('MEDIA_DISK_CACHE_MAX_BYTES', default=1024 * 1024 * 1024)
+
+# Batch uploads
+BATCH_UPLOAD_MAX_FILES = 500
+BATCH_UPLOAD_WORKERS = env.int('BATCH_UPLOAD_WORKERS', default=8)  # concurrent writes to the storage
+
+# Batch annotation fetch
+ANNOTATION_BATCH_MAX_FILES = 500
+
+# Dataset export
+DATASET_EXPORT_WORKERS = env.int('DATASET_EXPORT_WORKERS', default=8)  # concurrent reads of images ahead of the archive
+
+# Renditions
+RENDITION_SIZES = [64, 128, 256, 512, 1024]  # allowed width and height of resized images
+RENDITION_CACHE_MAX_BYTES = env.int('RENDITION_CACHE_MAX_BYTES', default=64 * 1024 * 1024)
+
+# Post-upload processing, jobs are run by `manage.py process_jobs` or by threads of the web process
+PROCESSING_STAGES = {  # every stage is a function of an image, run as a job of its own
+    'metadata': 'core.stages.fill_metadata',
+    'renditions': 'core.stages.prerender_renditions',
+}
+PROCESSING_RENDITIONS = [(256, 256, 'jpeg')]  # (width, height, format) rendered ahead of the first request
+PROCESSING_IN_PROCESS = env.bool('PROCESSING_IN_PROCESS', default=False)
+PROCESSING_WORKERS = env.int('PROCESSING_WORKERS', default=4)  # threads running jobs
+PROCESSING_CPU_WORKERS = env.int('PROCESSING_CPU_WORKERS', default=2)  # processes for Pillow work, 0 runs it in place
+PROCESSING_MAX_ATTEMPTS = 3
+PROCESSING_RETRY_DELAY = timedelta(seconds=30)  # doubled after every failed attempt
+PROCESSING_JOB_TIMEOUT = timedelta(minutes=10)  # running jobs are taken again after it, e.g. if a worker died
+PROCESSING_POLL_INTERVAL = 1  # seconds
 
 REST_FRAMEWORK = {
     'URL_FORMAT_OVERRIDE': None,
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.utils.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'core.utils.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
@@ -0,0 +1,94 @@
+import asyncio
+from contextvars import ContextVar
+
+import django
+from asgiref.sync import sync_to_async, ThreadSensitiveContext
+from django.core.handlers import asgi
+
+_deferred_content = ContextVar('deferred_content', default=None)
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """
+    Django's ASGI handler that doesn't let requests block each other or the event loop:
+    - sync code of a request runs in a thread of its own, Django 3.1 runs sync code of all requests in a single thread
+    - regular streaming content is read in the request's thread instead of the event loop
+    - async streaming content (AsyncStreamingHttpResponse) is sent after the request's thread is released,
+      so a slow download holds neither a thread nor more than a chunk of memory
+    """
+
+    async def __call__(self, scope, receive, send):
+        deferred = []
+        token = _deferred_content.set(deferred)
+        try:
+            async with ThreadSensitiveContext():
+                await super().__call__(scope, receive, send)
+
+            for content in deferred:
+                await self.send_async_content(content, receive, send)
+        finally:
+            _deferred_content.reset(token)
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            await super().send_response(response, send)
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': self.encode_headers(response),
+        })
+
+        deferred = _deferred_content.get()
+        content = getattr(response, 'async_streaming_content', None)
+        if content is not None and deferred is not None:
+            # the response doesn't need the request's thread anymore, its content is sent once the thread is released
+            await sync_to_async(response.close, thread_sensitive=True)()
+            deferred.append(content)
+            return
+
+        try:
+            next_part = sync_to_async(next, thread_sensitive=True)
+            iterator = iter(response)
+            while True:
+                part = await next_part(iterator, None)
+                if part is None:
+                    break
+                await self.send_body(part, send)
+            await send({'type': 'http.response.body'})
+        finally:
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+    async def send_async_content(self, content, receive, send):
+        # the request body is read already, the next message is a disconnect
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            async for part in content:
+                if disconnect.done():
+                    return
+                await self.send_body(part, send)
+            await send({'type': 'http.response.body'})
+        finally:
+            disconnect.cancel()
+            await content.aclose()
+
+    async def send_body(self, part, send):
+        for chunk, _ in self.chunk_bytes(part):
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    @staticmethod
+    def encode_headers(response):
+        headers = [
+            (header.encode('ascii') if isinstance(header, str) else header,
+             value.encode('latin1') if isinstance(value, str) else value)
+            for header, value in response.items()
+        ]
+        headers.extend((b'Set-Cookie', cookie.output(header='').encode('ascii').strip())
+                       for cookie in response.cookies.values())
+        return headers
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,202 @@
+import json
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from io import BytesIO
+
+import django
+from PIL import Image as PILImage
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+from django.urls import reverse
+from rest_framework import parsers, renderers, status
+from rest_framework.test import APIClient
+
+from core.serializers import AnnotationSerializer
+from core.utils import JSONParser, JSONRenderer
+
+IMAGE_FORMATS = {
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'tiff': 'TIFF',
+}
+CLASS_IDS = ['tooth', 'caries', 'filling', 'crown', 'implant']
+SURFACES = ['B', 'D', 'L', 'M', 'O']
+ANNOTATION_FORMATS = ['internal', AnnotationSerializer.EXPORT_FORMAT_KEY]
+
+
+@contextmanager
+def isolated_environment():
+    """Runs the benchmark against a fresh test database and a temporary file system storage"""
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(DEFAULT_FILE_STORAGE='core.storage.InstrumentedStorage',
+                                  MEDIA_STORAGE='django.core.files.storage.FileSystemStorage', MEDIA_ROOT=media_root):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def make_image(width, height, format_key, seed):
+    """Deterministic image content: a random tile scaled up, it compresses about as well as a scan does"""
+    rng = random.Random(seed)
+    tile = PILImage.frombytes('L', (32, 32), rng.getrandbits(8 * 32 * 32).to_bytes(32 * 32, 'little'))
+
+    output = BytesIO()
+    tile.resize((width, height), PILImage.BICUBIC).save(output, IMAGE_FORMATS[format_key])
+    return output.getvalue()
+
+
+def make_annotation(label_count, seed):
+    rng = random.Random(seed)
+    labels = []
+    for _ in range(label_count):
+        start_x, start_y = rng.randrange(2000), rng.randrange(2000)
+        labels.append({
+            'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'class_id': rng.choice(CLASS_IDS),
+            'surface': rng.sample(SURFACES, rng.randint(1, 3)),
+            'shape': {'startX': start_x, 'startY': start_y,
+                      'endX': start_x + rng.randrange(1, 500), 'endY': start_y + rng.randrange(1, 500)},
+            'meta': {'confirmed': rng.random() < 0.5, 'confidence_percent': round(rng.random(), 2)},
+        })
+    return {'labels': labels}
+
+
+class Measurement:
+    """Latencies and query counts of requests to one endpoint"""
+
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+
+    def request(self, send, expected_status=status.HTTP_200_OK):
+        with CaptureQueriesContext(connection) as queries:
+            started_at = time.perf_counter()
+            response = send()
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            self.latencies.append(time.perf_counter() - started_at)
+        self.queries.append(len(queries))
+
+        if response.status_code != expected_status:
+            raise RuntimeError(f'Unexpected response {response.status_code}: {response.content[:1000]}')
+        return response
+
+    @staticmethod
+    def percentile(values, percent):
+        """Nearest-rank percentile of sorted values"""
+        return values[max(round(len(values) * percent / 100) - 1, 0)]
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'requests': len(latencies),
+            'throughput': len(latencies) / sum(latencies),  # requests per second of one client
+            'latency_ms': {
+                'mean': sum(latencies) / len(latencies) * 1000,
+                **{f'p{percent}': self.percentile(latencies, percent) * 1000 for percent in (50, 90, 99)},
+                'max': latencies[-1] * 1000,
+            },
+            'queries': {'mean': sum(self.queries) / len(self.queries), 'max': max(self.queries)},
+        }
+
+
+def run_benchmark(images=10, sizes=((512, 512),), formats=tuple(IMAGE_FORMATS), labels=10, seed=0):
+    """
+    Uploads a generated corpus of images of every size and format with annotations of the given number of labels,
+    then downloads the images and reads and rewrites the annotations. Returns a summary of every endpoint
+    """
+    client = APIClient()
+    measurements = {}
+    uploaded = []
+
+    def measure(name):
+        return measurements.setdefault(name, Measurement())
+
+    for width, height in sizes:
+        for format_key in formats:
+            corpus = f'{format_key}.{width}x{height}'
+            for number in range(images):
+                seed += 1
+                filename = f'{corpus}.{number}.{format_key}'
+                file = BytesIO(make_image(width, height, format_key, seed))
+                file.name = filename
+                data = {'file': file, 'data': json.dumps({'annotation': make_annotation(labels, seed)})}
+
+                measure(f'upload.{corpus}').request(
+                    lambda: client.post(reverse('images-create'), data, format='multipart'),
+                    expected_status=status.HTTP_201_CREATED,
+                )
+                uploaded.append((corpus, filename))
+
+    for corpus, filename in uploaded:
+        measure(f'download.{corpus}').request(lambda: client.get(reverse('images-retrieve', kwargs={'file': filename})))
+
+    for _, filename in uploaded:
+        url = reverse('annotation', kwargs={'image__file': filename})
+        for format_key in ANNOTATION_FORMATS:
+            caches['annotations'].clear()
+            measure(f'annotation_get.{format_key}').request(lambda: client.get(url, {'format': format_key}))
+            measure(f'annotation_get_cached.{format_key}').request(lambda: client.get(url, {'format': format_key}))
+
+        seed += 1
+        annotation = make_annotation(labels, seed)
+        measure('annotation_put').request(lambda: client.put(url, annotation, format='json'))
+
+    return {name: measurement.summary() for name, measurement in measurements.items()}
+
+
+def run_json_benchmark(annotations=100, labels=10, seed=0, rounds=20):
+    """
+    Compares throughput of rendering and parsing annotations by the JSON classes of DRF, based on the standard library,
+    and by core.utils ones used by the API. Returns operations per second of both and the speedup
+    """
+    payload = {'annotations': [make_annotation(labels, seed + number) for number in range(annotations)]}
+    content = renderers.JSONRenderer().render(payload)
+    codecs = {
+        'render': {
+            'stdlib': lambda: renderers.JSONRenderer().render(payload),
+            'fast': lambda: JSONRenderer().render(payload),
+        },
+        'parse': {
+            'stdlib': lambda: parsers.JSONParser().parse(BytesIO(content)),
+            'fast': lambda: JSONParser().parse(BytesIO(content)),
+        },
+    }
+
+    results = {'bytes': len(content)}
+    for operation, implementations in codecs.items():
+        throughput = {}
+        for name, run in implementations.items():
+            started_at = time.perf_counter()
+            for _ in range(rounds):
+                run()
+            throughput[name] = rounds / (time.perf_counter() - started_at)
+        results[operation] = {**throughput, 'speedup': throughput['fast'] / throughput['stdlib']}
+    return results
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit and commit.strip(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'platform': platform.platform(),
+    }
@@ -0,0 +1,131 @@
+import hashlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+
+from core.disk_cache import media_cache
+from core.models import Blob
+from core.renditions import RenditionService
+
+
+def file_sha256(file):
+    """SHA-256 of the file, uploads get it computed by the upload handler while the file is streamed"""
+    sha256 = getattr(file, 'sha256', None)
+    if sha256 is None:
+        digest = hashlib.sha256()
+        for chunk in file.chunks():
+            digest.update(chunk)
+        file.seek(0)
+        sha256 = digest.hexdigest()
+    return sha256
+
+
+def reserve_blobs(files):
+    """
+    Commits unreferenced rows of content of the files that isn't known yet and returns blobs of the files by hash.
+    Called before the content is written outside of the transaction taking references to it, so content left by
+    a rolled back transaction keeps its row and is deleted by collect_blobs
+    """
+    files_by_hash = {file_sha256(file): file for file in files}
+    Blob.objects.bulk_create([Blob(sha256=sha256, size=file.size) for sha256, file in files_by_hash.items()],
+                             ignore_conflicts=True)
+    return Blob.objects.in_bulk(list(files_by_hash), field_name='sha256')
+
+
+def mark_stored(file, blob):
+    """Lets acquire_blobs know that content of the file is in the storage as long as the blob isn't collected"""
+    file.stored_blob_id = blob.id
+
+
+def store_blobs(files):
+    """Reserves blobs of the files and writes their content that isn't stored yet, before acquire_blobs is called"""
+    blobs = reserve_blobs(files)
+    for file in files:
+        blob = blobs[file_sha256(file)]
+        if blob.ref_count == 0:
+            write_content(blob.sha256, file)
+        mark_stored(file, blob)
+
+
+def acquire_blobs(files, max_workers=1):
+    """
+    Returns blobs with content of the files and takes a reference to each of them. Content that is already stored
+    isn't written again, the rest is written to the storage concurrently. Must be called in a transaction,
+    content is written by store_blobs beforehand so it isn't left without a row if the transaction is rolled back.
+    Content written that way isn't checked again, unless its blob was collected and created anew meanwhile
+    """
+    hashes = [file_sha256(file) for file in files]
+    files_by_hash = dict(zip(hashes, files))
+
+    blobs = {}
+    while len(blobs) < len(files_by_hash):  # a blob may be collected between the insert and the lock
+        Blob.objects.bulk_create([Blob(sha256=sha256, size=file.size) for sha256, file in files_by_hash.items()],
+                                 ignore_conflicts=True)
+        blobs = {blob.sha256: blob for blob in Blob.objects.select_for_update().filter(sha256__in=files_by_hash)}
+
+    # content of other unreferenced blobs may have been collected already, so it's written again
+    unreferenced = [blob for blob in blobs.values() if blob.ref_count == 0 and
+                    getattr(files_by_hash[blob.sha256], 'stored_blob_id', None) != blob.id]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # a copied context lets the writes be recorded into metrics of the request
+        futures = [executor.submit(copy_context().run, write_content, blob.sha256, files_by_hash[blob.sha256])
+                   for blob in unreferenced]
+        for future in futures:
+            future.result()
+
+    hashes_by_count = defaultdict(list)
+    for sha256, count in Counter(hashes).items():
+        hashes_by_count[count].append(sha256)
+        blobs[sha256].ref_count += count
+    for count, count_hashes in hashes_by_count.items():
+        Blob.objects.filter(sha256__in=count_hashes).update(ref_count=F('ref_count') + count)
+
+    return [blobs[sha256] for sha256 in hashes]
+
+
+def write_content(sha256, file):
+    key = Blob.make_key(sha256)
+    if not default_storage.exists(key):
+        default_storage.save(key, file)
+
+
+def reference_blob(sha256):
+    """Takes a reference to a stored blob, returns None if there's no blob with such content"""
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(sha256=sha256, ref_count__gt=0).first()
+        if blob is not None:
+            blob.ref_count += 1
+            blob.save(update_fields=['ref_count'])
+    return blob
+
+
+def release_blob(blob_id):
+    """Drops a reference to the blob, its content is deleted after commit if nothing references it anymore"""
+    Blob.objects.filter(id=blob_id).update(ref_count=F('ref_count') - 1)
+    transaction.on_commit(lambda: collect_blobs([blob_id]))
+
+
+def collect_blobs(blob_ids=None):
+    """Deletes blobs that aren't referenced by any image together with their content, renditions and cached copy"""
+    blobs = Blob.objects.filter(ref_count=0)
+    if blob_ids is not None:
+        blobs = blobs.filter(id__in=blob_ids)
+
+    collected = 0
+    for blob_id in blobs.values_list('id', flat=True):
+        with transaction.atomic():
+            # the blob may get referenced again meanwhile, locking makes that wait until the content is deleted
+            blob = Blob.objects.select_for_update(skip_locked=True).filter(id=blob_id, ref_count=0).first()
+            if blob is not None:
+                default_storage.delete(blob.key)
+                blob.delete()
+                collected += 1
+        if blob is not None:
+            # renditions are made again on request if the content is stored again meanwhile
+            RenditionService.delete_renditions(blob.key)
+            media_cache.delete(blob.sha256)
+    return collected
@@ -0,0 +1,54 @@
+import threading
+
+from django.core.cache import caches
+from django.db import transaction
+
+
+class AnnotationCache:
+    """
+    Keeps rendered annotation responses per format. Entries remember the annotation version they were rendered from,
+    so a stale entry is never served even if another process missed the invalidation
+    """
+    FORMATS = ['internal', 'export']
+
+    def __init__(self, alias='annotations'):
+        self.alias = alias
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def make_key(annotation_id, format_key):
+        return f'annotation:{annotation_id}:{format_key}'
+
+    def get(self, annotation, format_key):
+        entry = self.backend.get(self.make_key(annotation.id, format_key))
+        hit = entry is not None and entry[0] == annotation.version
+
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry[1] if hit else None
+
+    def set(self, annotation, format_key, content):
+        self.backend.set(self.make_key(annotation.id, format_key), (annotation.version, content))
+
+    def invalidate(self, annotation_id):
+        """Drops all formats of the annotation once the current transaction commits"""
+        keys = [self.make_key(annotation_id, format_key) for format_key in self.FORMATS]
+        transaction.on_commit(lambda: self.backend.delete_many(keys))
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {'hits': hits, 'misses': misses, 'hit_ratio': hits / total if total else 0.0}
+
+
+annotation_cache = AnnotationCache()
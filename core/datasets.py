@@ -0,0 +1,266 @@
+import json
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from io import BytesIO
+from itertools import chain
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from core import metrics
+from core.disk_cache import iter_file_range
+from core.export import iter_annotations
+from core.models import Image, Label
+
+LAYOUTS = ['coco', 'yolo']
+ARCHIVES = {
+    'zip': 'application/zip',
+    'tar': 'application/x-tar',
+}
+
+
+class ArchiveBuffer:
+    """Write-only file object of an archive, written bytes are taken out as soon as a member is added"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        content = b''.join(self.parts)
+        self.parts = []
+        return content
+
+
+class ArchiveWriter:
+    """Writes members of a ZIP or TAR archive to a non-seekable buffer, so the archive is streamed while it's built"""
+
+    def __init__(self, archive):
+        self.buffer = ArchiveBuffer()
+        self.mtime = time.time()
+        if archive == 'zip':
+            self.archive = zipfile.ZipFile(self.buffer, 'w')
+        else:
+            self.archive = tarfile.open(fileobj=self.buffer, mode='w|')
+
+    def add(self, name, content, compress=True):
+        """Adds the member and returns bytes of the archive written since the previous call"""
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            self.archive.writestr(info, content)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(content), self.mtime
+            self.archive.addfile(info, BytesIO(content))
+        return self.buffer.take()
+
+    def add_stream(self, name, chunks, size):
+        """Adds the member of size bytes from the chunks, yields bytes of the archive while they're written"""
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with self.archive.open(info, 'w', force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(chunk)
+                    yield self.buffer.take()
+        else:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = size, self.mtime
+            self.archive.addfile(info)  # only the header, the content is written the way addfile does it
+            for chunk in chunks:
+                self.archive.fileobj.write(chunk)
+                yield self.buffer.take()
+            blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+            if remainder:
+                self.archive.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                blocks += 1
+            self.archive.offset += blocks * tarfile.BLOCKSIZE
+        yield self.buffer.take()
+
+    def close(self):
+        self.archive.close()
+        return self.buffer.take()
+
+
+class JSONSpool:
+    """Items of a JSON array written to a temporary file, so big arrays aren't kept in memory"""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.count = 0
+
+    def append(self, item):
+        content = (b',' if self.count else b'') + json.dumps(item).encode()
+        self.file.write(content)
+        self.size += len(content)
+        self.count += 1
+
+    def chunks(self):
+        return iter_file_range(self.file, 0, self.size)
+
+    def close(self):
+        self.file.close()
+
+
+def read_images(items, workers, prefetch):
+    """
+    Yields (image, labels, content) of (image, labels) items in order while up to prefetch images are read
+    from the storage by the workers
+    """
+    def read(image):
+        with default_storage.open(image.storage_name) as file:
+            return file.read()
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for image, labels in items:
+                # storage reads record into the metrics of the request like the ones of batch uploads do
+                pending.append((image, labels, executor.submit(copy_context().run, read, image)))
+                if len(pending) >= prefetch:
+                    image, labels, future = pending.popleft()
+                    yield image, labels, future.result()
+            while pending:
+                image, labels, future = pending.popleft()
+                yield image, labels, future.result()
+        finally:
+            for _, _, future in pending:  # the export is closed early, e.g. the client disconnected
+                future.cancel()
+
+
+def iter_images(annotations, chunk_size):
+    """Yields (image, labels) of the annotations, images of every chunk are fetched by one query"""
+    chunk = []
+    for annotation in annotations:
+        chunk.append(annotation)
+        if len(chunk) == chunk_size:
+            yield from image_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield from image_chunk(chunk)
+
+
+def image_chunk(annotations):
+    images = Image.objects.select_related('blob').in_bulk([annotation['id'] for annotation in annotations],
+                                                          field_name='file')
+    for annotation in annotations:
+        yield images[annotation['id']], annotation['labels']
+
+
+def image_size(image, content):
+    if image.width is not None and image.height is not None:
+        return image.width, image.height
+    with metrics.timer('decode'):
+        return PILImage.open(BytesIO(content)).size  # only the header is read
+
+
+def yolo_line(class_index, box, width, height):
+    """Box as YOLO expects it: class index, center, width and height relative to the image size"""
+    x_min, y_min, x_max, y_max = box
+    values = [(x_min + x_max) / 2 / width, (y_min + y_max) / 2 / height, (x_max - x_min) / width,
+              (y_max - y_min) / height]
+    return ' '.join([str(class_index), *(f'{value:.6f}' for value in values)]) + '\n'
+
+
+def iter_dataset(layout='coco', archive='zip', export=True, created_after=None, created_before=None, class_id=None,
+                 workers=None, chunk_size=1000):
+    """
+    Yields bytes of a ZIP or TAR archive of annotated images with their labels in COCO or YOLO layout:
+    - coco: images/<file> and annotations.json with boxes in pixels
+    - yolo: images/<file>, labels/<file name without extension>.txt with normalized boxes and classes.txt
+    With export=True only confirmed labels are included, like annotations of format=export.
+    Images are read from the storage by workers ahead of the archive writer, so only a few of them are in memory
+    """
+    workers = workers or settings.DATASET_EXPORT_WORKERS
+    labels = Label.objects.all()
+    if export:
+        labels = labels.filter(confirmed=True)
+    if created_after is not None:
+        labels = labels.filter(annotation__image__created_at__gte=created_after)
+    if created_before is not None:
+        labels = labels.filter(annotation__image__created_at__lt=created_before)
+    if class_id is not None:
+        labels = labels.filter(class_id=class_id)
+    # classes of labels added while the archive is streamed get indexes after the ones known at the start
+    class_index = {value: index for index, value in
+                   enumerate(labels.order_by('class_id').values_list('class_id', flat=True).distinct())}
+
+    annotations = iter_annotations(created_after=created_after, created_before=created_before, class_id=class_id,
+                                   chunk_size=chunk_size, confirmed=export)
+    writer = ArchiveWriter(archive)
+    coco_images, coco_annotations = JSONSpool(), JSONSpool()
+    try:
+        yield from write_images(writer, annotations, layout, class_index, coco_images, coco_annotations, workers,
+                                chunk_size)
+
+        if layout == 'coco':
+            categories = [{'id': index + 1, 'name': value} for value, index in class_index.items()]
+            head, middle = b'{"images": [', b'], "annotations": ['
+            tail = f'], "categories": {json.dumps(categories)}}}'.encode()
+            chunks = chain([head], coco_images.chunks(), [middle], coco_annotations.chunks(), [tail])
+            size = len(head) + coco_images.size + len(middle) + coco_annotations.size + len(tail)
+            yield from writer.add_stream('annotations.json', chunks, size)
+        else:
+            yield writer.add('classes.txt', ''.join(f'{value}\n' for value in class_index).encode())
+        yield writer.close()
+    finally:
+        coco_images.close()
+        coco_annotations.close()
+
+
+def write_images(writer, annotations, layout, class_index, coco_images, coco_annotations, workers, chunk_size):
+    """Yields archive bytes of images with their YOLO labels, or adds COCO entries of them to the spools"""
+    stems = set()  # YOLO labels are named by the image name without extension, e.g. of both a.png and a.jpg
+    for image_id, (image, image_labels, content) in enumerate(read_images(iter_images(annotations, chunk_size),
+                                                                           workers, prefetch=2 * workers), 1):
+        name = image.file.name
+        if layout == 'yolo':
+            name = unique_stem_name(name, stems)
+        width, height = image_size(image, content)
+        yield writer.add(f'images/{name}', content, compress=False)  # images are compressed already
+
+        boxes = [(label, Label.shape_box(label['shape'])) for label in image_labels]
+        boxes = [(label, box) for label, box in boxes if box is not None]  # labels of other shapes are left out
+        for label, _ in boxes:
+            class_index.setdefault(label['class_id'], len(class_index))
+        if layout == 'coco':
+            coco_images.append({'id': image_id, 'file_name': f'images/{name}', 'width': width, 'height': height})
+            for label, (x_min, y_min, x_max, y_max) in boxes:
+                coco_annotations.append({
+                    'id': coco_annotations.count + 1,
+                    'image_id': image_id,
+                    'category_id': class_index[label['class_id']] + 1,
+                    'bbox': [x_min, y_min, x_max - x_min, y_max - y_min],
+                    'area': (x_max - x_min) * (y_max - y_min),
+                    'iscrowd': 0,
+                    'attributes': {'label_id': label['id'], 'surface': label['surface']},
+                })
+        else:
+            lines = [yolo_line(class_index[label['class_id']], box, width, height) for label, box in boxes]
+            yield writer.add(f'labels/{os.path.splitext(name)[0]}.txt', ''.join(lines).encode())
+
+
+def unique_stem_name(name, stems):
+    """Returns the name, or the name with _<n> appended to its stem if an image of the same stem was taken already"""
+    stem, extension = os.path.splitext(name)
+    unique_stem, suffix = stem, 0
+    while unique_stem in stems:
+        suffix += 1
+        unique_stem = f'{stem}_{suffix}'
+    stems.add(unique_stem)
+    return unique_stem + extension
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+
+class DiskCache:
+    """
+    Read-through cache of stored files on local disk, bounded by their total size with LRU eviction.
+    Entries are keyed by content hash or version of the file, so changed content never hits a stale entry
+    and old entries are evicted in time. Disabled if no directory is given
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+        self._entries = None  # size by path in LRU order, read from the directory on first use
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def make_path(self, key):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def load(self):
+        """Indexes entries left by previous runs, least recently written first. Called with the lock held"""
+        if self._entries is not None:
+            return
+
+        entries = []
+        temp_dir = os.path.join(self.directory, 'tmp')
+        os.makedirs(temp_dir, exist_ok=True)
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if root == temp_dir:
+                    os.remove(path)  # fills interrupted by a restart
+                else:
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, path, stat.st_size))
+
+        self._entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+        self.size = sum(self._entries.values())
+
+    def open(self, key):
+        """Returns the cached file opened for reading or None"""
+        if not self.enabled:
+            return None
+
+        path = self.make_path(key)
+        with self._lock:
+            self.load()
+            file = None
+            if path in self._entries:
+                try:
+                    file = open(path, 'rb')
+                except FileNotFoundError:  # evicted by another process sharing the directory
+                    self.size -= self._entries.pop(path)
+
+            if file is not None:
+                self._entries.move_to_end(path)
+                self.hits += 1
+            else:
+                self.misses += 1
+        return file
+
+    def record_saved(self, size):
+        """Counts bytes served from the cache instead of the storage"""
+        with self._lock:
+            self.saved_bytes += size
+
+    def create_temp(self):
+        with self._lock:
+            self.load()
+        return tempfile.NamedTemporaryFile(dir=os.path.join(self.directory, 'tmp'), delete=False)
+
+    def add(self, key, temp_path, size):
+        path = self.make_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+        evicted = []
+        with self._lock:
+            self.size += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            while self.size > self.max_bytes:
+                evicted_path, evicted_size = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                evicted.append(evicted_path)
+
+        for evicted_path in evicted:
+            self.discard(evicted_path)
+
+    def delete(self, key):
+        """Removes the entry of the key, e.g. of content that is deleted from the storage"""
+        if not self.enabled:
+            return
+
+        path = self.make_path(key)
+        with self._lock:
+            self.load()
+            self.size -= self._entries.pop(path, 0)
+        self.discard(path)
+
+    @staticmethod
+    def discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def fill(self, key, size, chunks):
+        """Yields the chunks while writing them to the cache, the entry is added once all size bytes are written"""
+        if not self.enabled or size > self.max_bytes:
+            yield from chunks
+            return
+
+        temp = self.create_temp()
+        written = 0
+        try:
+            with temp:
+                for chunk in chunks:
+                    temp.write(chunk)
+                    written += len(chunk)
+                    yield chunk
+            if written == size:
+                self.add(key, temp.name, size)
+        finally:
+            chunks.close()
+            self.discard(temp.name)
+
+    async def afill(self, key, size, chunks):
+        """Async version of fill, the local disk is written in worker threads, so the event loop isn't blocked"""
+        if not self.enabled or size > self.max_bytes:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        temp = await sync_to_async(self.create_temp, thread_sensitive=False)()
+        write = sync_to_async(temp.write, thread_sensitive=False)
+        written = 0
+        try:
+            try:
+                async for chunk in chunks:
+                    await write(chunk)
+                    written += len(chunk)
+                    yield chunk
+            finally:
+                await sync_to_async(temp.close, thread_sensitive=False)()
+            if written == size:
+                await sync_to_async(self.add, thread_sensitive=False)(key, temp.name, size)
+        finally:
+            await chunks.aclose()
+            await sync_to_async(self.discard, thread_sensitive=False)(temp.name)
+
+    def stats(self):
+        with self._lock:
+            hits, misses, saved_bytes, size = self.hits, self.misses, self.saved_bytes, self.size
+            entries = len(self._entries or ())
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0.0,
+            'saved_bytes': saved_bytes,
+            'entries': entries,
+            'size': size,
+        }
+
+
+media_cache = DiskCache(settings.MEDIA_DISK_CACHE_DIR, settings.MEDIA_DISK_CACHE_MAX_BYTES)
+
+
+def iter_file_range(file, start, length, chunk_size=64 * 1024):
+    """Yields length bytes of the open local file starting at start in chunks"""
+    file.seek(start)
+    while length > 0:
+        chunk = file.read(min(chunk_size, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+async def aiter_file_range(file, start, length, chunk_size=64 * 1024):
+    """Async version of iter_file_range, every chunk is read in a worker thread, so the event loop isn't blocked"""
+    read = sync_to_async(os.pread, thread_sensitive=False)
+    while length > 0:
+        chunk = await read(file.fileno(), min(chunk_size, length), start)
+        if not chunk:
+            break
+        start += len(chunk)
+        length -= len(chunk)
+        yield chunk
@@ -0,0 +1,69 @@
+import json
+
+from django.db.models import Exists, OuterRef
+
+from core.models import Annotation, Label
+from core.serializers import AnnotationSerializer
+
+
+def iter_annotations(export=False, created_after=None, created_before=None, class_id=None, after=None,
+                     chunk_size=1000, confirmed=False):
+    """
+    Yields annotations of the whole store as {'id': <file>, 'cursor': <int>, 'labels': [...]} ordered by cursor.
+    Annotations are read in keyset chunks, so memory use doesn't grow with the store.
+    Iteration is resumed from any cursor with after=<cursor>, confirmed=True leaves only confirmed labels
+    in representations of any format
+    """
+    annotations = Annotation.objects.order_by('id')
+    labels = Label.objects.order_by('annotation_id')
+    if confirmed:
+        labels = labels.filter(confirmed=True)
+
+    if created_after is not None:
+        annotations = annotations.filter(image__created_at__gte=created_after)
+    if created_before is not None:
+        annotations = annotations.filter(image__created_at__lt=created_before)
+    if class_id is not None:
+        labels = labels.filter(class_id=class_id)
+        annotations = annotations.filter(Exists(labels.filter(annotation_id=OuterRef('id'))))
+
+    cursor = after or 0
+    while True:
+        chunk = list(annotations.filter(id__gt=cursor).values_list('id', 'image__file')[:chunk_size])
+        if not chunk:
+            return
+
+        labels_by_annotation = annotation_labels([annotation_id for annotation_id, _ in chunk], labels, export,
+                                                 chunk_size)
+        for annotation_id, file in chunk:
+            yield {'id': file, 'cursor': annotation_id, 'labels': labels_by_annotation[annotation_id]}
+
+        cursor = chunk[-1][0]
+
+
+def annotation_labels(annotation_ids, labels, export=False, chunk_size=1000):
+    """Returns label representations of every annotation by its id, read by one query"""
+    labels_by_annotation = {annotation_id: [] for annotation_id in annotation_ids}
+    rows = AnnotationSerializer.labels_values(labels.filter(annotation_id__in=labels_by_annotation), export,
+                                              extra_fields=['annotation_id'])
+    for row in rows.iterator(chunk_size=chunk_size):
+        annotation_id = row.pop('annotation_id')
+        labels_by_annotation[annotation_id].append(AnnotationSerializer.label_representation(row, export))
+    return labels_by_annotation
+
+
+def fetch_annotations(files, export=False):
+    """
+    Returns annotations of the images by file as {'labels': [...]} like the annotation endpoint does, or None
+    for files that have no annotation. Takes two queries however many files there are
+    """
+    annotation_ids = dict(Annotation.objects.filter(image__file__in=files).values_list('image__file', 'id'))
+    labels_by_annotation = annotation_labels(annotation_ids.values(), Label.objects.order_by('annotation_id'), export)
+
+    return {file: {'labels': labels_by_annotation[annotation_ids[file]]} if file in annotation_ids else None
+            for file in files}
+
+
+def iter_ndjson(items):
+    for item in items:
+        yield json.dumps(item) + '\n'
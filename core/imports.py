@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from PIL import Image as PILImage
+from django.core.files import File
+from django.utils.text import get_valid_filename
+from rest_framework import serializers
+
+from core.ingest import BatchItem, validate_items, store_files, create_rows
+from core.models import Image
+from core.serializers import ImageSerializer
+from core.utils import json_loads
+
+SIDECAR_EXTENSION = '.json'
+
+
+def stored_name(name):
+    """Name an image is stored under, made of its path in the source so images of nested directories don't collide"""
+    return get_valid_filename(os.path.normpath(name).replace(os.sep, '_'))
+
+
+def sidecar_name(name):
+    return os.path.splitext(name)[0] + SIDECAR_EXTENSION
+
+
+def is_image_name(name):
+    return not os.path.basename(name).startswith('.') and not name.endswith(SIDECAR_EXTENSION)
+
+
+class DirectorySource:
+    """Images in a directory tree, annotation of an image is in <name without extension>.json next to it"""
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+            for filename in sorted(files):
+                if is_image_name(filename):
+                    self.names.append(os.path.relpath(os.path.join(root, filename), path))
+
+    def iter_entries(self, start):
+        """Yields (name, path, sidecar content or None) of images from the start-th one"""
+        for name in self.names[start:]:
+            try:
+                with open(os.path.join(self.path, sidecar_name(name)), 'rb') as file:
+                    sidecar = file.read()
+            except FileNotFoundError:
+                sidecar = None
+            yield name, os.path.join(self.path, name), sidecar
+
+    def release(self, path):
+        pass
+
+    def close(self):
+        pass
+
+
+class TarSource:
+    """
+    Images in a tarball of any compression, laid out like the ones of DirectorySource. The archive is read forward
+    only, so compressed ones aren't decompressed again for every member: once to list images and once to extract them
+    to temporary files in archive order
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        sidecars = set()
+        with tarfile.open(path, 'r|*') as archive:
+            for member in archive:
+                if member.isfile():
+                    name = posixpath.normpath(member.name)
+                    if is_image_name(name):
+                        self.names.append(name)
+                    elif name.endswith(SIDECAR_EXTENSION):
+                        sidecars.add(name)
+        self.sidecars = {name: sidecar_name(name) for name in self.names if sidecar_name(name) in sidecars}
+        self.directory = tempfile.TemporaryDirectory()  # copies of images until they're imported
+
+    def iter_entries(self, start):
+        """
+        Yields (name, path of a temporary copy, sidecar content or None) of images from the start-th one in archive
+        order. Images whose sidecar comes later in the archive are held until it's read
+        """
+        owners = {}  # images from the start by their sidecar
+        for name in self.names[start:]:
+            if name in self.sidecars:
+                owners.setdefault(self.sidecars[name], []).append(name)
+        skipped = set(self.names[:start])
+
+        pending = deque()  # [name, path] in archive order
+        sidecars = {}  # content of sidecars until every image of them is yielded
+        with tarfile.open(self.path, 'r|*') as archive:
+            for member in archive:
+                name = posixpath.normpath(member.name)
+                if not member.isfile() or name in skipped:
+                    continue
+
+                if name in owners:
+                    sidecars[name] = archive.extractfile(member).read()
+                elif is_image_name(name):
+                    file = tempfile.NamedTemporaryFile(dir=self.directory.name, delete=False)
+                    with file, archive.extractfile(member) as content:
+                        shutil.copyfileobj(content, file)
+                    pending.append((name, file.name))
+
+                while pending and (pending[0][0] not in self.sidecars or self.sidecars[pending[0][0]] in sidecars):
+                    yield self.pop_entry(pending, owners, sidecars)
+            while pending:
+                yield self.pop_entry(pending, owners, sidecars)
+
+    def pop_entry(self, pending, owners, sidecars):
+        name, path = pending.popleft()
+        sidecar = None
+        if name in self.sidecars:
+            key = self.sidecars[name]
+            owners[key].remove(name)
+            sidecar = sidecars[key] if owners[key] else sidecars.pop(key)
+        return name, path, sidecar
+
+    def release(self, path):
+        os.remove(path)
+
+    def close(self):
+        self.directory.cleanup()
+
+
+def open_source(path):
+    if os.path.isdir(path):
+        return DirectorySource(path)
+    if os.path.isfile(path) and tarfile.is_tarfile(path):
+        return TarSource(path)
+    raise ValueError(f'{path} is neither a directory nor a tarball')
+
+
+def inspect_file(path):
+    """
+    Returns SHA-256, size and metadata read from the image header of the file, metadata is None if it isn't
+    an image. Runs in the process pool, the image data itself isn't decoded
+    """
+    with open(path, 'rb') as file:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+        size = file.tell()
+
+        file.seek(0)
+        try:
+            metadata = ImageSerializer.image_metadata(PILImage.open(file))
+        except Exception:  # Pillow raises all kinds of exceptions on broken headers
+            metadata = None
+    return digest.hexdigest(), size, metadata
+
+
+def load_checkpoint(path, source):
+    """Returns progress of a previous import of the source, a checkpoint of another source is an error"""
+    try:
+        with open(path) as file:
+            checkpoint = json.load(file)
+    except FileNotFoundError:
+        return {'source': source, 'position': 0, 'imported': 0, 'skipped': 0, 'failed': 0}
+
+    if checkpoint['source'] != source:
+        raise ValueError(f'Checkpoint {path} belongs to the import of {checkpoint["source"]}')
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    """Replaces the checkpoint at once, so a crash leaves either the previous or the new one"""
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(f'{path}.tmp', path)
+
+
+def import_images(path, checkpoint_path, batch_size=100, processes=None, threads=None):
+    """
+    Imports images of a directory or tarball with their sidecar annotations in batches:
+    files are hashed and their headers are checked on a pool of processes, content is written to the storage
+    by a pool of threads and rows are created in bulk like the ones of batch uploads.
+    Position in the source is saved to the checkpoint after every batch, so an interrupted import is resumed
+    from the batch it stopped at, files that are stored already aren't written again.
+    Yields the checkpoint, number of files and BatchItem representations of failed files after every batch
+    """
+    source = open_source(path)
+    checkpoint = load_checkpoint(checkpoint_path, os.path.abspath(path))
+    if checkpoint.setdefault('total', len(source.names)) != len(source.names):
+        source.close()
+        raise ValueError(f'Files of {path} changed since checkpoint {checkpoint_path} was saved')
+
+    names = {}
+    for name in source.names:
+        if names.setdefault(stored_name(name), name) != name:
+            source.close()
+            raise ValueError(f'{names[stored_name(name)]} and {name} would be stored under the same name')
+
+    executor = ProcessPoolExecutor(max_workers=processes) if processes != 0 else None
+    entries = source.iter_entries(checkpoint['position'])
+    try:
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                return
+            items = import_batch(source, batch, executor, threads)
+
+            imported = [item for item in items if item.errors is None]
+            failed = [item for item in items if item.errors is not None]
+            checkpoint['position'] += len(batch)
+            checkpoint['imported'] += len(imported)
+            checkpoint['skipped'] += len(batch) - len(items)
+            checkpoint['failed'] += len(failed)
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            yield checkpoint, len(batch), [item.to_representation() for item in failed]
+    finally:
+        entries.close()
+        if executor is not None:
+            executor.shutdown()
+        source.close()
+
+
+def import_batch(source, batch, executor, threads):
+    """Imports (name, path, sidecar) entries of the batch, returns items of the files that weren't imported before"""
+    files = [File(open(path, 'rb'), name=stored_name(name)) for name, path, _ in batch]
+    try:
+        paths = [path for _, path, _ in batch]
+        results = (executor.map if executor is not None else map)(inspect_file, paths)
+
+        items = []
+        for (name, path, sidecar), file, (sha256, size, metadata) in zip(batch, files, results):
+            file.sha256 = sha256
+            item = BatchItem(file)
+            items.append(item)
+
+            if metadata is None:
+                item.errors = {'file': [serializers.ImageField.default_error_messages['invalid_image']]}
+                continue
+            try:
+                ImageSerializer.check_image(metadata['format'], size)
+            except serializers.ValidationError as err:
+                item.errors = {'file': err.detail}
+                continue
+            item.metadata = metadata
+
+            try:
+                item.annotation_data = None if sidecar is None else json_loads(sidecar)
+            except ValueError:
+                item.errors = {'annotation': ['Invalid JSON']}
+
+        # files stored under the same name with the same content were imported before the import was interrupted
+        stored = dict(Image.objects.filter(file__in=[item.filename for item in items])
+                      .values_list('file', 'sha256'))
+        items = [item for item in items if stored.get(item.filename) != item.file.sha256]
+
+        validate_items(items)
+        store_files([item for item in items if item.errors is None], max_workers=threads)
+        create_rows([item for item in items if item.errors is None], max_workers=threads)
+        return items
+    finally:
+        for (_, path, _), file in zip(batch, files):
+            file.close()
+            source.release(path)
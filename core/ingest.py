@@ -0,0 +1,270 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction, DatabaseError
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from rest_framework import serializers, status
+
+from core import metrics
+from core.blobs import file_sha256, acquire_blobs, mark_stored, write_content, reserve_blobs
+from core.cache import annotation_cache
+from core.models import Image, Annotation, Label, UploadReservation
+from core.pipeline import enqueue_processing
+from core.serializers import ImageSerializer, AnnotationSerializer, UploadFinalizeSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem:
+    """A file of a batch upload with its optional annotation data"""
+
+    def __init__(self, file, annotation_data=None):
+        self.file = file
+        self.annotation_data = annotation_data
+        self.filename = get_valid_filename(file.name)
+        self.metadata = None
+        self.labels = None
+        self.errors = None
+
+    def to_representation(self):
+        if self.errors is not None:
+            return {'file': self.file.name, 'status': status.HTTP_400_BAD_REQUEST, 'errors': self.errors}
+        return {'file': self.file.name, 'status': status.HTTP_201_CREATED, 'id': self.filename}
+
+
+def ingest_batch(items):
+    """
+    Validates the items, uploads their content to the storage concurrently and creates rows of the valid ones
+    in bulk. Invalid items get errors and don't affect the rest of the batch
+    """
+    validate_items(items)
+    store_files([item for item in items if item.errors is None])
+    create_rows([item for item in items if item.errors is None])
+
+    return [item.to_representation() for item in items]
+
+
+def validate_items(items):
+    names = [item.filename for item in items]
+    taken_names = set(Image.objects.filter(file__in=names).values_list('file', flat=True))
+    taken_names.update(UploadReservation.objects.filter(file__in=names, expires_at__gt=timezone.now())
+                       .values_list('file', flat=True))
+
+    for item in items:
+        if item.errors is not None:  # failed already, e.g. by the header checks of imports
+            continue
+        try:
+            if item.filename in taken_names:
+                raise serializers.ValidationError({'file': ['File already exists']})
+            taken_names.add(item.filename)
+
+            if item.metadata is None:  # imports read metadata of files beforehand
+                item.metadata = validate_image(item.file)
+            if item.annotation_data is not None:
+                validate_annotation(item)
+        except serializers.ValidationError as err:
+            item.errors = err.detail
+
+    check_label_ids([item for item in items if item.errors is None and item.labels])
+
+
+def validate_image(file):
+    try:
+        with metrics.timer('decode'):
+            image = PILImage.open(file)
+            image.verify()
+    except Exception:
+        # same error as the one of regular uploads, Pillow raises all kinds of exceptions on broken files
+        msg = serializers.ImageField.default_error_messages['invalid_image']
+        raise serializers.ValidationError({'file': [msg]})
+    finally:
+        file.seek(0)
+
+    try:
+        ImageSerializer.check_image(image.format, file.size)
+    except serializers.ValidationError as err:
+        raise serializers.ValidationError({'file': err.detail})
+
+    return ImageSerializer.image_metadata(image)
+
+
+def validate_annotation(item):
+    serializer = AnnotationSerializer(data=item.annotation_data)
+    try:
+        serializer.is_valid(raise_exception=True)
+        item.labels = AnnotationSerializer.build_labels(None, serializer.validated_data.get('labels'))
+    except serializers.ValidationError as err:
+        raise serializers.ValidationError({'annotation': err.detail})
+
+
+def check_label_ids(items):
+    """Label ids must be unique across the batch and the stored labels"""
+    ids = [label.id for item in items for label in item.labels]
+    taken_ids = set(Label.objects.filter(id__in=ids).values_list('id', flat=True))
+
+    for item in items:
+        item_ids = {label.id for label in item.labels}
+        conflicts = item_ids & taken_ids
+        if conflicts:
+            msg = f'Labels with these ids already exist: {list(conflicts)}'
+            item.errors = {'annotation': {'labels': msg}}
+        else:
+            taken_ids |= item_ids
+
+
+def store_files(items, max_workers=None):
+    """
+    Writes content that isn't stored yet concurrently before rows are created, so a failed write fails only the files
+    with that content. Blobs are reserved first and acquired later in the transaction without checking the content
+    again, content of rows that fail to be created is deleted by collect_blobs
+    """
+    items_by_hash = defaultdict(list)
+    for item in items:
+        items_by_hash[file_sha256(item.file)].append(item)
+    blobs = reserve_blobs([item.file for item in items])
+
+    with ThreadPoolExecutor(max_workers=max_workers or settings.BATCH_UPLOAD_WORKERS) as executor:
+        # a copied context lets the writes be recorded into metrics of the request
+        futures = [(sha256, executor.submit(copy_context().run, write_content, sha256, hash_items[0].file))
+                   for sha256, hash_items in items_by_hash.items() if blobs[sha256].ref_count == 0]
+
+        for sha256, future in futures:
+            try:
+                future.result()
+            except Exception:
+                logger.exception('Content %s could not be stored', sha256)
+                for item in items_by_hash[sha256]:
+                    item.errors = {'file': ['File could not be stored']}
+
+    for sha256, hash_items in items_by_hash.items():
+        for item in hash_items:
+            if item.errors is None:
+                mark_stored(item.file, blobs[sha256])
+
+
+def create_rows(items, max_workers=None):
+    try:
+        with transaction.atomic():
+            blobs = acquire_blobs([item.file for item in items],
+                                  max_workers=max_workers or settings.BATCH_UPLOAD_WORKERS)
+            Image.objects.bulk_create([Image(file=item.filename, blob=blob, size=item.file.size, sha256=blob.sha256,
+                                             **item.metadata)
+                                       for item, blob in zip(items, blobs)])
+            image_ids = dict(Image.objects.filter(file__in=[item.filename for item in items])
+                             .values_list('file', 'id'))
+            enqueue_processing(list(image_ids.values()))
+
+            # bulk_create doesn't return ids on every database, so ids are fetched afterwards
+            annotated_items = [item for item in items if item.labels is not None]
+            Annotation.objects.bulk_create([Annotation(image_id=image_ids[item.filename])
+                                            for item in annotated_items])
+            annotation_ids = dict(Annotation.objects.filter(image_id__in=image_ids.values())
+                                  .values_list('image_id', 'id'))
+
+            labels = []
+            for item in annotated_items:
+                for label in item.labels:
+                    label.annotation_id = annotation_ids[image_ids[item.filename]]
+                    labels.append(label)
+            Label.objects.bulk_create(labels)
+    except DatabaseError:
+        logger.exception('Rows of the batch could not be created')
+        for item in items:
+            item.errors = {'file': ['File could not be saved']}
+
+
+def backfill_image_metadata(batch_size=500, max_workers=1):
+    """
+    Fills size, hash and metadata of images stored before they were kept on the row, images are read from the
+    storage only when their blob doesn't have the value. Yields number of images updated by every chunk
+    """
+    missing = Q(size=None) | Q(sha256='') | Q(width=None)
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            images = list(Image.objects.select_related('blob').filter(missing, id__gt=last_id)
+                          .order_by('id')[:batch_size])
+            if not images:
+                return
+            last_id = images[-1].id
+
+            # storage reads record into the metrics of the caller like the ones of batch uploads do
+            updated = [image for image in executor.map(lambda image: copy_context().run(fill_metadata, image), images)
+                       if image is not None]
+            Image.objects.bulk_update(updated, ['size', 'sha256', *Image.METADATA_FIELDS])
+            yield len(updated)
+
+
+
+def backfill_labels(batch_size=1000, check=False):
+    """
+    Packs the JSON columns of labels into the typed columns again, it fixes labels that processes of the previous
+    release wrote while migration 0011 ran. Labels of a batch are locked, so edits made meanwhile aren't overwritten.
+    Yields numbers of labels read and of labels whose typed columns differed of every batch, check=True writes nothing
+    """
+    columns = [*Label.columns(Label.JSON_COLUMNS), *Label.BOX_FIELDS]
+    last_id = None
+    while True:
+        with transaction.atomic():
+            labels = Label.objects.order_by('id')
+            if last_id is not None:
+                labels = labels.filter(id__gt=last_id)
+            batch = list((labels if check else labels.select_for_update())[:batch_size])
+            if not batch:
+                return
+            last_id = batch[-1].id
+
+            changed, annotation_ids = [], set()
+            for label in batch:
+                stored = [getattr(label, column) for column in columns]
+                label.surface, label.shape, label.meta = label.surface_json, label.shape_json, label.meta_json
+                if [getattr(label, column) for column in columns] != stored:
+                    changed.append(label)
+                    annotation_ids.add(label.annotation_id)
+            if changed and not check:
+                Label.objects.bulk_update(changed, columns)
+                # representations of the annotations change, so do their ETags
+                Annotation.objects.filter(id__in=annotation_ids).update(version=F('version') + 1)
+        if not check:
+            for annotation_id in annotation_ids:
+                annotation_cache.invalidate(annotation_id)
+        yield len(batch), len(changed)
+
+def fill_metadata(image):
+    """Sets missing values of the image, returns None if the stored file can't be read"""
+    name = image.storage_name
+    try:
+        if image.blob_id:
+            image.size, image.sha256 = image.blob.size, image.blob.sha256
+        elif image.size is None:
+            image.size = default_storage.size(name)
+
+        if not image.sha256:
+            # images outside of blobs are read as a whole to hash them, so the content is decoded right away
+            with default_storage.open(name) as file:
+                image.sha256 = file_sha256(file)
+                try:
+                    with metrics.timer('decode'):
+                        metadata = ImageSerializer.image_metadata(PILImage.open(file))
+                except (OSError, SyntaxError):
+                    metadata = None
+        elif image.width is None:
+            opened = UploadFinalizeSerializer.open_image(name, image.size)
+            metadata = opened and ImageSerializer.image_metadata(opened)
+        else:
+            return image
+    except (OSError, SyntaxError):
+        logger.exception('Metadata of image %s could not be read', image.file.name)
+        return None
+
+    if metadata:
+        for field, value in metadata.items():
+            setattr(image, field, value)
+    return image
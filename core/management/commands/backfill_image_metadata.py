@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from core.ingest import backfill_image_metadata
+
+
+class Command(BaseCommand):
+    help = 'Fills size, SHA-256, format, MIME type, dimensions and mode of images that were stored without them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='number of images updated at once')
+        parser.add_argument('--workers', type=int, default=4, help='number of images read from the storage at once')
+
+    def handle(self, *args, **options):
+        total = 0
+        for updated in backfill_image_metadata(options['batch_size'], options['workers']):
+            total += updated
+            self.stderr.write(f'Updated {total} images')
+        self.stdout.write(f'Backfilled {total} images')
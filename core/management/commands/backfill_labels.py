@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.ingest import backfill_labels
+
+
+class Command(BaseCommand):
+    help = 'Fills typed columns of labels from their JSON columns again, --check only counts labels that differ'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of labels updated at once')
+        parser.add_argument('--check', action='store_true', help='fail if typed columns of any label differ')
+
+    def handle(self, *args, **options):
+        total = differing = 0
+        for count, changed in backfill_labels(options['batch_size'], options['check']):
+            total += count
+            differing += changed
+            self.stderr.write(f'Read {total} labels')
+
+        if options['check']:
+            if differing:
+                raise CommandError(f'{differing} of {total} labels differ from their JSON columns')
+            self.stdout.write(f'All {total} labels match their JSON columns')
+        else:
+            self.stdout.write(f'Backfilled {differing} of {total} labels')
@@ -0,0 +1,67 @@
+import argparse
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.benchmark import IMAGE_FORMATS, isolated_environment, run_benchmark, run_json_benchmark, environment_info
+
+
+class Command(BaseCommand):
+    help = 'Measures latency, throughput and database queries of the main endpoints on a generated corpus. ' \
+           'Runs against a fresh test database and a temporary file system storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=10, help='number of images of every size and format')
+        parser.add_argument('--sizes', type=self.parse_sizes, default=[(512, 512), (2048, 2048)],
+                            help='comma separated WIDTHxHEIGHT sizes of images')
+        parser.add_argument('--formats', type=self.parse_formats, default=list(IMAGE_FORMATS),
+                            help=f'comma separated formats of images: {", ".join(IMAGE_FORMATS)}')
+        parser.add_argument('--labels', type=int, default=10, help='number of labels of every annotation')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='file to write JSON results to, they are written to stdout by default')
+
+    @staticmethod
+    def parse_sizes(value):
+        sizes = []
+        for size in value.split(','):
+            try:
+                width, height = (int(side) for side in size.lower().split('x'))
+            except ValueError:
+                raise argparse.ArgumentTypeError(f'Invalid size: {size}, expected WIDTHxHEIGHT')
+            if width <= 0 or height <= 0:
+                raise argparse.ArgumentTypeError(f'Invalid size: {size}, sides must be positive')
+            sizes.append((width, height))
+        return sizes
+
+    @staticmethod
+    def parse_formats(value):
+        formats = [format_key.strip().lower() for format_key in value.split(',')]
+        unknown = set(formats) - set(IMAGE_FORMATS)
+        if unknown:
+            raise argparse.ArgumentTypeError(f'Unknown formats: {sorted(unknown)}')
+        return formats
+
+    def handle(self, *args, **options):
+        config = {key: options[key] for key in ('images', 'sizes', 'formats', 'labels', 'seed')}
+        started_at = timezone.now()
+        with isolated_environment():
+            try:
+                results = run_benchmark(**config)
+            except RuntimeError as err:
+                raise CommandError(err)
+
+        report = json.dumps({
+            'started_at': started_at.isoformat(),
+            'environment': environment_info(),
+            'config': config,
+            'results': results,
+            'json': run_json_benchmark(labels=options['labels'], seed=options['seed']),
+        }, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(report)
+            self.stderr.write(f'Results are written to {options["output"]}')
+        else:
+            self.stdout.write(report)
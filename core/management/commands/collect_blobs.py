@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from core.blobs import collect_blobs
+
+
+class Command(BaseCommand):
+    help = 'Deletes stored content that is not referenced by any image'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Collected {collect_blobs()} blobs')
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from core.export import iter_annotations, iter_ndjson
+from core.serializers import AnnotationSerializer
+
+
+class Command(BaseCommand):
+    help = 'Writes annotations of the whole store as NDJSON, one line per image'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['internal', AnnotationSerializer.EXPORT_FORMAT_KEY],
+                            default='internal')
+        parser.add_argument('--created-after', type=self.parse_datetime)
+        parser.add_argument('--created-before', type=self.parse_datetime)
+        parser.add_argument('--class-id')
+        parser.add_argument('--after', type=int, help='cursor of the last exported annotation to resume from')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    @staticmethod
+    def parse_datetime(value):
+        result = parse_datetime(value)
+        if result is None:
+            raise CommandError(f'Invalid datetime: {value}')
+        return result
+
+    def handle(self, *args, **options):
+        annotations = iter_annotations(
+            export=options['format'] == AnnotationSerializer.EXPORT_FORMAT_KEY,
+            created_after=options['created_after'],
+            created_before=options['created_before'],
+            class_id=options['class_id'],
+            after=options['after'],
+            chunk_size=options['chunk_size'],
+        )
+        for line in iter_ndjson(annotations):
+            self.stdout.write(line, ending='')
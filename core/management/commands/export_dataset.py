@@ -0,0 +1,49 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from core.datasets import iter_dataset, LAYOUTS, ARCHIVES
+from core.serializers import AnnotationSerializer
+
+
+class Command(BaseCommand):
+    help = 'Writes annotated images with their labels as a ZIP or TAR archive in COCO or YOLO layout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layout', choices=LAYOUTS, default='coco')
+        parser.add_argument('--archive', choices=list(ARCHIVES), default='zip')
+        parser.add_argument('--format', choices=['internal', AnnotationSerializer.EXPORT_FORMAT_KEY],
+                            default=AnnotationSerializer.EXPORT_FORMAT_KEY,
+                            help='export includes only confirmed labels')
+        parser.add_argument('--created-after', type=self.parse_datetime)
+        parser.add_argument('--created-before', type=self.parse_datetime)
+        parser.add_argument('--class-id')
+        parser.add_argument('--workers', type=int, help='number of images read from the storage at once')
+        parser.add_argument('--output', help='file to write the archive to, it is written to stdout by default')
+
+    @staticmethod
+    def parse_datetime(value):
+        result = parse_datetime(value)
+        if result is None:
+            raise CommandError(f'Invalid datetime: {value}')
+        return result
+
+    def handle(self, *args, **options):
+        chunks = iter_dataset(
+            layout=options['layout'],
+            archive=options['archive'],
+            export=options['format'] == AnnotationSerializer.EXPORT_FORMAT_KEY,
+            created_after=options['created_after'],
+            created_before=options['created_before'],
+            class_id=options['class_id'],
+            workers=options['workers'],
+        )
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,46 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.imports import import_images
+from core.utils import JSONRenderer
+
+
+class Command(BaseCommand):
+    help = 'Imports images of a directory or tarball with their annotations in <name without extension>.json. ' \
+           'Progress is saved to a checkpoint, so running the command again resumes an interrupted import'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='directory or tarball of images')
+        parser.add_argument('--checkpoint', help='file progress is saved to, <source>.checkpoint.json by default')
+        parser.add_argument('--batch-size', type=int, default=100, help='number of files imported at once')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='number of files hashed and checked at once, 0 checks them in place')
+        parser.add_argument('--threads', type=int, help='number of files written to the storage at once')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        checkpoint_path = options['checkpoint'] or f'{os.path.abspath(source).rstrip(os.sep)}.checkpoint.json'
+
+        started_at = time.perf_counter()
+        processed = 0
+        checkpoint = None
+        try:
+            for checkpoint, count, failures in import_images(source, checkpoint_path, options['batch_size'],
+                                                             options['processes'], options['threads']):
+                for failure in failures:
+                    self.stderr.write(f'Failed {failure["file"]}: {JSONRenderer().render(failure["errors"]).decode()}')
+
+                processed += count
+                rate = processed / (time.perf_counter() - started_at)
+                self.stderr.write(f'Processed {checkpoint["position"]} of {checkpoint["total"]} files, '
+                                  f'{rate:.1f} files/s')
+        except ValueError as err:
+            raise CommandError(err)
+
+        if checkpoint is None:
+            self.stdout.write('Nothing to import')
+        else:
+            self.stdout.write(f'Imported {checkpoint["imported"]}, skipped {checkpoint["skipped"]} imported before, '
+                              f'failed {checkpoint["failed"]} files')
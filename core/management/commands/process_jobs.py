@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.pipeline import Worker
+
+
+class Command(BaseCommand):
+    help = 'Runs post-upload processing jobs of the queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.PROCESSING_WORKERS,
+                            help='number of threads running jobs')
+        parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        count = Worker(options['workers']).run(once=options['once'])
+        self.stdout.write(f'Ran {count} jobs')
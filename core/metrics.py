@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current_timings = ContextVar('request_timings', default=None)
+
+COMPONENTS = ['db', 'storage', 'decode', 'parse', 'serialize']
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # seconds
+
+
+class RequestTimings:
+    """Time, number of calls and bytes spent on each component during a request"""
+
+    def __init__(self):
+        self.durations = dict.fromkeys(COMPONENTS, 0.0)
+        self.counts = dict.fromkeys(COMPONENTS, 0)
+        self.bytes = dict.fromkeys(COMPONENTS, 0)
+        self._lock = threading.Lock()  # storage is written concurrently by batch uploads
+
+    def add(self, component, duration, count=1, size=0):
+        with self._lock:
+            self.durations[component] += duration
+            self.counts[component] += count
+            self.bytes[component] += size
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add('db', time.perf_counter() - started_at)
+
+    def server_timing(self, total):
+        """Value of Server-Timing header, durations are in milliseconds"""
+        metrics = []
+        for component in COMPONENTS:
+            if self.counts[component]:
+                description = f'{self.counts[component]} calls'
+                if self.bytes[component]:
+                    description += f' / {self.bytes[component]} bytes'
+                metrics.append(f'{component};dur={self.durations[component] * 1000:.1f};desc="{description}"')
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+@contextmanager
+def collect_timings():
+    """Makes a new RequestTimings current for the code inside, threads started with a copied context share it"""
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+def record(component, duration, count=1, size=0):
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(component, duration, count, size)
+
+
+@contextmanager
+def timer(component, size=0):
+    """Records time of the code inside into the current request timings, does nothing outside of requests"""
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(component, time.perf_counter() - started_at, size=size)
+
+
+class MetricsRegistry:
+    """Per process aggregates of requests by route, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.requests = defaultdict(int)  # by (route, method, status)
+        self.histograms = {}  # by (route, method): [count of every bucket, sum, count]
+        self.components = defaultdict(lambda: [0.0, 0, 0])  # by (route, method, component): [seconds, calls, bytes]
+        self._lock = threading.Lock()
+
+    def observe(self, route, method, status, duration, timings):
+        with self._lock:
+            self.requests[(route, method, status)] += 1
+
+            histogram = self.histograms.setdefault((route, method), [0] * len(DURATION_BUCKETS) + [0.0, 0])
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    histogram[index] += 1
+            histogram[-2] += duration
+            histogram[-1] += 1
+
+            for component in COMPONENTS:
+                if timings.counts[component]:
+                    totals = self.components[(route, method, component)]
+                    totals[0] += timings.durations[component]
+                    totals[1] += timings.counts[component]
+                    totals[2] += timings.bytes[component]
+
+    @staticmethod
+    def format_labels(**labels):
+        return ','.join(f'{name}="{value}"' for name, value in labels.items())
+
+    def render(self, extra_metrics=()):
+        """Renders the metrics and (name, type, value) of extra_metrics"""
+        with self._lock:
+            requests = dict(self.requests)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            components = {key: list(value) for key, value in self.components.items()}
+
+        lines = ['# TYPE imagestore_requests_total counter']
+        for (route, method, status), count in sorted(requests.items()):
+            labels = self.format_labels(route=route, method=method, status=status)
+            lines.append(f'imagestore_requests_total{{{labels}}} {count}')
+
+        lines.append('# TYPE imagestore_request_duration_seconds histogram')
+        for (route, method), histogram in sorted(histograms.items()):
+            labels = self.format_labels(route=route, method=method)
+            for bound, count in zip(DURATION_BUCKETS, histogram):
+                lines.append(f'imagestore_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'imagestore_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram[-1]}')
+            lines.append(f'imagestore_request_duration_seconds_sum{{{labels}}} {histogram[-2]}')
+            lines.append(f'imagestore_request_duration_seconds_count{{{labels}}} {histogram[-1]}')
+
+        for index, unit in enumerate(['seconds', 'calls', 'bytes']):
+            lines.append(f'# TYPE imagestore_request_component_{unit}_total counter')
+            for (route, method, component), totals in sorted(components.items()):
+                if totals[index]:
+                    labels = self.format_labels(route=route, method=method, component=component)
+                    lines.append(f'imagestore_request_component_{unit}_total{{{labels}}} {totals[index]}')
+
+        for name, metric_type, value in extra_metrics:
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,32 @@
+import time
+from contextlib import ExitStack
+
+from django.db import connections
+
+from core.metrics import collect_timings, registry
+
+
+class MetricsMiddleware:
+    """
+    Records time of database queries, storage calls, image decoding, parsing and serialization of every request.
+    They are sent back in Server-Timing header and aggregated by route for the metrics endpoint.
+    Content of streaming responses is sent after the middleware returns, so it isn't included
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started_at = time.perf_counter()
+        with collect_timings() as timings, ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timings.execute_wrapper))
+            response = self.get_response(request)
+        duration = time.perf_counter() - started_at
+
+        match = request.resolver_match
+        route = match.route if match is not None else 'unmatched'
+        registry.observe(route, request.method, response.status_code, duration, timings)
+
+        response['Server-Timing'] = timings.server_timing(duration)
+        return response
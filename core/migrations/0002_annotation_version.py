@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:35
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 10000
+
+
+def copy_meta_fields(apps, schema_editor):
+    """Fills the new columns from meta in batches, every batch is committed on its own"""
+    Label = apps.get_model('core', 'Label')
+
+    last_id = None
+    while True:
+        labels = Label.objects.order_by('id')
+        if last_id is not None:
+            labels = labels.filter(id__gt=last_id)
+        batch = list(labels.only('id', 'meta')[:BATCH_SIZE])
+        if not batch:
+            return
+
+        for label in batch:
+            meta = label.meta if isinstance(label.meta, dict) else {}
+            confidence = meta.get('confidence_percent')
+            label.confirmed = meta.get('confirmed') is True
+            label.confidence = confidence if isinstance(confidence, (int, float)) \
+                and not isinstance(confidence, bool) else None
+        with transaction.atomic():
+            Label.objects.bulk_update(batch, ['confirmed', 'confidence'])
+
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('core', '0004_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='label',
+            name='confidence',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='confirmed',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(copy_meta_fields, migrations.RunPython.noop),
+        # labels aren't locked against writes while the index is built
+        AddIndexConcurrently(
+            model_name='label',
+            index=models.Index(fields=['class_id', 'confirmed', 'annotation', 'confidence'], name='label_search_idx'),
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:36
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 10000
+
+
+def number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def copy_shape_fields(apps, schema_editor):
+    """Fills the box columns from shape in batches, every batch is committed on its own"""
+    Label = apps.get_model('core', 'Label')
+
+    last_id = None
+    while True:
+        labels = Label.objects.order_by('id')
+        if last_id is not None:
+            labels = labels.filter(id__gt=last_id)
+        batch = list(labels.only('id', 'shape')[:BATCH_SIZE])
+        if not batch:
+            return
+
+        for label in batch:
+            shape = label.shape if isinstance(label.shape, dict) else {}
+            xs = [number(shape.get(key)) for key in ('startX', 'endX')]
+            ys = [number(shape.get(key)) for key in ('startY', 'endY')]
+            if None not in xs and None not in ys:
+                label.x_min, label.x_max = min(xs), max(xs)
+                label.y_min, label.y_max = min(ys), max(ys)
+                label.area = (label.x_max - label.x_min) * (label.y_max - label.y_min)
+        with transaction.atomic():
+            Label.objects.bulk_update(batch, ['x_min', 'y_min', 'x_max', 'y_max', 'area'])
+
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('core', '0005_label_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='label',
+            name='area',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='x_max',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='x_min',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='y_max',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='y_min',
+            field=models.FloatField(editable=False, null=True),
+        ),
+        migrations.RunPython(copy_shape_fields, migrations.RunPython.noop),
+        # labels aren't locked against writes while the indexes are built
+        AddIndexConcurrently(
+            model_name='label',
+            index=models.Index(fields=['annotation', 'x_min', 'y_min'], name='label_box_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='label',
+            index=models.Index(fields=['class_id', 'area'], name='label_area_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='label',
+            index=models.Index(fields=['area'], name='label_size_idx'),
+        ),
+    ]
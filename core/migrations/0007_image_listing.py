@@ -0,0 +1,37 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:39
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_blob_sizes(apps, schema_editor):
+    Image = apps.get_model('core', 'Image')
+    Blob = apps.get_model('core', 'Blob')
+
+    sizes = Blob.objects.filter(id=OuterRef('blob_id')).values('size')[:1]
+    Image.objects.filter(blob__isnull=False).update(size=Subquery(sizes))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_label_box'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='format',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(copy_blob_sizes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['created_at', 'id'], name='image_listing_idx'),
+        ),
+    ]
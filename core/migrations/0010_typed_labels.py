@@ -0,0 +1,84 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+# typed columns of labels are filled by 0011. The JSON columns are kept and written by the model together with
+# the typed ones, so processes of the previous release keep working while labels are backfilled
+class Migration(migrations.Migration):
+    dependencies = [
+        ('core', '0009_processing_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='label',
+            name='surface_code',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='raw_surface',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='start_x',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='start_y',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='end_x',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='end_y',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='raw_shape',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='extra_meta',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name='label',
+            name='confidence',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='label',
+            name='confirmed',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.RenameField(model_name='label', old_name=field, new_name=f'{field}_json')
+            for field in ('surface', 'shape', 'meta')
+        ] + [
+            migrations.AlterField(
+                model_name='label',
+                name='surface_json',
+                field=models.JSONField(blank=True, db_column='surface', default=list, editable=False),
+            ),
+            migrations.AlterField(
+                model_name='label',
+                name='shape_json',
+                field=models.JSONField(blank=True, db_column='shape', default=dict, editable=False),
+            ),
+            migrations.AlterField(
+                model_name='label',
+                name='meta_json',
+                field=models.JSONField(blank=True, db_column='meta', default=dict, editable=False),
+            ),
+        ]),
+    ]
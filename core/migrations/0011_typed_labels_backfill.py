@@ -0,0 +1,81 @@
+# Generated by Django 3.1.7 on 2026-10-18 10:52
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 10000
+SURFACE_CODE_LENGTH = 16
+SHAPE_KEYS = {'startX': 'start_x', 'startY': 'start_y', 'endX': 'end_x', 'endY': 'end_y'}
+INT_RANGE = range(-2 ** 31, 2 ** 31)
+FIELDS = ['surface_code', 'raw_surface', *SHAPE_KEYS.values(), 'raw_shape', 'extra_meta', 'confirmed', 'confidence']
+
+
+def number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def pack(label):
+    """Same as Label.pack_surface, pack_shape and pack_meta of the JSON columns, the box columns are filled already"""
+    surface = label.surface_json
+    if isinstance(surface, list) and len(surface) <= SURFACE_CODE_LENGTH and \
+            all(isinstance(part, str) and len(part) == 1 for part in surface):
+        label.surface_code, label.raw_surface = ''.join(surface), None
+    else:
+        label.surface_code, label.raw_surface = '', surface
+
+    shape = label.shape_json
+    if isinstance(shape, dict) and shape.keys() == SHAPE_KEYS.keys() and \
+            all(type(value) is int and value in INT_RANGE for value in shape.values()):
+        for key, column in SHAPE_KEYS.items():
+            setattr(label, column, shape[key])
+        label.raw_shape = None
+    else:
+        for column in SHAPE_KEYS.values():
+            setattr(label, column, None)
+        label.raw_shape = None if shape == {} else shape
+
+    meta = label.meta_json
+    if isinstance(meta, dict):
+        label.extra_meta = dict(meta)
+        label.confirmed = label.extra_meta.pop('confirmed') if isinstance(meta.get('confirmed'), bool) else None
+        label.confidence = number(meta.get('confidence_percent'))
+        if type(label.confidence) is float:
+            del label.extra_meta['confidence_percent']
+    else:
+        label.extra_meta, label.confirmed, label.confidence = meta, None, None
+
+
+def backfill_labels(apps, schema_editor):
+    """
+    Fills the typed columns from the JSON ones in batches, every batch is committed on its own so the table isn't
+    locked for long. Every label is packed again, so the migration can be run again after a failure. Labels written
+    by processes of the previous release during the run are fixed by the backfill_labels command
+    """
+    Label = apps.get_model('core', 'Label')
+
+    last_id = None
+    while True:
+        labels = Label.objects.order_by('id')
+        if last_id is not None:
+            labels = labels.filter(id__gt=last_id)
+        batch = list(labels.only('id', 'surface_json', 'shape_json', 'meta_json')[:BATCH_SIZE])
+        if not batch:
+            return
+
+        for label in batch:
+            pack(label)
+        with transaction.atomic():
+            Label.objects.bulk_update(batch, FIELDS)
+
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('core', '0010_typed_labels'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_labels, migrations.RunPython.noop),
+    ]
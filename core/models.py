@@ -3,30 +3,299 @@ import uuid
 from django.db import models
 
 
+class Blob(models.Model):
+    """
+    Content of uploaded files, stored once under a key derived from its SHA-256 and shared by all images with the same
+    bytes. Content of blobs that aren't referenced anymore is deleted by core.blobs.collect_blobs
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
+    @staticmethod
+    def make_key(sha256):
+        return f'blobs/{sha256[:2]}/{sha256}'
+
+    @property
+    def key(self):
+        return self.make_key(self.sha256)
+
+
 class Image(models.Model):
     file = models.ImageField(unique=True)
+    blob = models.ForeignKey(Blob, null=True, blank=True, related_name='images', on_delete=models.PROTECT)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # metadata of the content kept on the row, so images are listed and served without reading the storage
+    format = models.CharField(max_length=16, blank=True)
+    mime = models.CharField(max_length=64, blank=True)
+    size = models.PositiveIntegerField(blank=True, null=True)
+    width = models.PositiveIntegerField(blank=True, null=True)
+    height = models.PositiveIntegerField(blank=True, null=True)
+    mode = models.CharField(max_length=16, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+
+    METADATA_FIELDS = ['format', 'mime', 'width', 'height', 'mode']  # fields decoded from the content
+
+    # progress of post-upload processing by core.pipeline, images without jobs are done
+    PROCESSING_PENDING = 'pending'
+    PROCESSING_RUNNING = 'processing'
+    PROCESSING_DONE = 'done'
+    PROCESSING_FAILED = 'failed'
+    PROCESSING_STATUSES = [PROCESSING_PENDING, PROCESSING_RUNNING, PROCESSING_DONE, PROCESSING_FAILED]
+
+    processing_status = models.CharField(max_length=16, default=PROCESSING_DONE,
+                                         choices=[(value, value) for value in PROCESSING_STATUSES])
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='image_listing_idx'),
+        ]
+
     def __str__(self):
         return self.file.name
 
+    @property
+    def storage_name(self):
+        """Name of the stored object with bytes of the image, file name is only an id for content-addressed images"""
+        return self.blob.key if self.blob_id else self.file.name
+
+
+class Job(models.Model):
+    """A stage of post-upload processing of an image, the table is the queue workers of core.pipeline take jobs from"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [PENDING, RUNNING, DONE, FAILED]
+
+    image = models.ForeignKey(Image, related_name='jobs', on_delete=models.CASCADE)
+    stage = models.CharField(max_length=64)
+    status = models.CharField(max_length=16, default=PENDING, choices=[(value, value) for value in STATUSES])
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    run_after = models.DateTimeField()  # retries are delayed
+    updated_at = models.DateTimeField()  # running jobs that aren't updated for long are taken again
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.stage} of image #{self.image_id}'
+
+
+class UploadReservation(models.Model):
+    """Filename reserved for a file that is uploaded straight to the storage and isn't finalized yet"""
+    file = models.CharField(max_length=100, unique=True)
+    annotation = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.file
+
 
 # this model seems redundant, but it allows us to easily extend annotation fields if it'll be needed
 class Annotation(models.Model):
     image = models.OneToOneField(Image, on_delete=models.CASCADE)
+    version = models.PositiveIntegerField(default=0)  # bumped on every labels change, used for ETag and caching
 
     def __str__(self):
         return f'Annotation #{self.image_id}'
 
 
 class Label(models.Model):
+    """
+    A label of an annotation. Its surface, shape and meta are stored in typed columns, values that don't fit them
+    are kept as JSON, so every value is read back as it was written. The API fields are properties
+    """
     annotation = models.ForeignKey(Annotation, related_name='labels', on_delete=models.CASCADE)
 
     id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
     class_id = models.CharField(max_length=255)
-    surface = models.JSONField(blank=True, default=list)
-    shape = models.JSONField(blank=True, default=dict)
-    meta = models.JSONField(blank=True, default=dict)
+
+    # surface of one-character parts, e.g. ['M', 'O'] is stored as 'MO'
+    surface_code = models.CharField(max_length=16, blank=True, default='')
+    raw_surface = models.JSONField(null=True, blank=True)
+
+    # shape of a box with integer coordinates
+    start_x = models.IntegerField(null=True, blank=True)
+    start_y = models.IntegerField(null=True, blank=True)
+    end_x = models.IntegerField(null=True, blank=True)
+    end_y = models.IntegerField(null=True, blank=True)
+    raw_shape = models.JSONField(null=True, blank=True)
+
+    # meta['confirmed'] if it's a boolean and meta['confidence_percent'] if it's a number, other keys are extra_meta
+    confirmed = models.BooleanField(null=True, blank=True)
+    confidence = models.FloatField(null=True, blank=True)
+    extra_meta = models.JSONField(blank=True, default=dict)
+
+    # box of the shape that labels are searched by
+    x_min = models.FloatField(null=True, editable=False)
+    y_min = models.FloatField(null=True, editable=False)
+    x_max = models.FloatField(null=True, editable=False)
+    y_max = models.FloatField(null=True, editable=False)
+    area = models.FloatField(null=True, editable=False)
+
+    # JSON columns the API fields were stored in before, they're written too until backfill_labels verifies
+    # that the typed columns of every label match them
+    surface_json = models.JSONField(db_column='surface', blank=True, default=list, editable=False)
+    shape_json = models.JSONField(db_column='shape', blank=True, default=dict, editable=False)
+    meta_json = models.JSONField(db_column='meta', blank=True, default=dict, editable=False)
+
+    COLUMNS = {  # columns every API field is stored in
+        'surface': ['surface_code', 'raw_surface'],
+        'shape': ['start_x', 'start_y', 'end_x', 'end_y', 'raw_shape'],
+        'meta': ['confirmed', 'confidence', 'extra_meta'],
+    }
+    JSON_COLUMNS = {'surface': 'surface_json', 'shape': 'shape_json', 'meta': 'meta_json'}
+    BOX_FIELDS = ['x_min', 'y_min', 'x_max', 'y_max', 'area']
+    SHAPE_KEYS = {'startX': 'start_x', 'startY': 'start_y', 'endX': 'end_x', 'endY': 'end_y'}
+    INT_RANGE = range(-2 ** 31, 2 ** 31)
+
+    class Meta:
+        indexes = [
+            # covers label search: the lookup of an annotation seeks class, confirmed and annotation at once
+            # and checks confidence in the index only
+            models.Index(fields=['class_id', 'confirmed', 'annotation', 'confidence'], name='label_search_idx'),
+            # region queries within an image and area queries across the store, of a class or of any
+            models.Index(fields=['annotation', 'x_min', 'y_min'], name='label_box_idx'),
+            models.Index(fields=['class_id', 'area'], name='label_area_idx'),
+            models.Index(fields=['area'], name='label_size_idx'),
+        ]
 
     def __str__(self):
         return f'{self.id}: {self.class_id}'
+
+    @classmethod
+    def columns(cls, fields):
+        """Columns of the fields, API fields are replaced by the columns they are stored in"""
+        return [column for field in fields for column in cls.COLUMNS.get(field, [field])]
+
+    @classmethod
+    def update_columns(cls, fields):
+        """Columns written when the fields change, the box is derived from the shape"""
+        return [*cls.columns(fields), *(cls.JSON_COLUMNS[field] for field in fields if field in cls.JSON_COLUMNS),
+                *(cls.BOX_FIELDS if 'shape' in fields else [])]
+
+    def column_values(self, field):
+        return {column: getattr(self, column) for column in self.COLUMNS[field]}
+
+    @property
+    def surface(self):
+        return self.unpack_surface(self.column_values('surface'))
+
+    @surface.setter
+    def surface(self, value):
+        for column, column_value in self.pack_surface(value).items():
+            setattr(self, column, column_value)
+        self.surface_json = value
+
+    @property
+    def shape(self):
+        return self.unpack_shape(self.column_values('shape'))
+
+    @shape.setter
+    def shape(self, value):
+        for column, column_value in self.pack_shape(value).items():
+            setattr(self, column, column_value)
+        self.shape_json = value
+
+    @property
+    def meta(self):
+        return self.unpack_meta(self.column_values('meta'))
+
+    @meta.setter
+    def meta(self, value):
+        for column, column_value in self.pack_meta(value).items():
+            setattr(self, column, column_value)
+        self.meta_json = value
+
+    @classmethod
+    def pack_surface(cls, surface):
+        max_length = cls._meta.get_field('surface_code').max_length
+        is_code = isinstance(surface, list) and len(surface) <= max_length and \
+            all(isinstance(part, str) and len(part) == 1 for part in surface)
+        return {'surface_code': ''.join(surface), 'raw_surface': None} if is_code else \
+            {'surface_code': '', 'raw_surface': surface}
+
+    @staticmethod
+    def unpack_surface(row):
+        return list(row['surface_code']) if row['raw_surface'] is None else row['raw_surface']
+
+    @staticmethod
+    def export_surface(row):
+        """Surface of format=export, parts joined into a string"""
+        return row['surface_code'] if row['raw_surface'] is None else ''.join(row['raw_surface'])
+
+    @classmethod
+    def pack_shape(cls, shape):
+        is_box = isinstance(shape, dict) and shape.keys() == cls.SHAPE_KEYS.keys() and \
+            all(type(value) is int and value in cls.INT_RANGE for value in shape.values())
+        if is_box:
+            values = {column: shape[key] for key, column in cls.SHAPE_KEYS.items()}
+            values['raw_shape'] = None
+        else:
+            values = dict.fromkeys(cls.SHAPE_KEYS.values())
+            values['raw_shape'] = None if shape == {} else shape
+
+        box = cls.shape_box(shape)
+        if box is None:
+            values.update(x_min=None, y_min=None, x_max=None, y_max=None, area=None)
+        else:
+            x_min, y_min, x_max, y_max = box
+            values.update(x_min=x_min, y_min=y_min, x_max=x_max, y_max=y_max, area=(x_max - x_min) * (y_max - y_min))
+        return values
+
+    @classmethod
+    def unpack_shape(cls, row):
+        if row['raw_shape'] is not None:
+            return row['raw_shape']
+        if row['start_x'] is None:
+            return {}
+        return {key: row[column] for key, column in cls.SHAPE_KEYS.items()}
+
+    @classmethod
+    def pack_meta(cls, meta):
+        if not isinstance(meta, dict):
+            return {'confirmed': None, 'confidence': None, 'extra_meta': meta}
+
+        extra_meta = dict(meta)
+        confirmed = extra_meta.pop('confirmed') if isinstance(meta.get('confirmed'), bool) else None
+        # integer confidence is searched by too, but it's kept in extra_meta to be read back as an integer
+        confidence = cls.number(meta.get('confidence_percent'))
+        if type(confidence) is float:
+            del extra_meta['confidence_percent']
+        return {'confirmed': confirmed, 'confidence': confidence, 'extra_meta': extra_meta}
+
+    @staticmethod
+    def unpack_meta(row):
+        if not isinstance(row['extra_meta'], dict):
+            return row['extra_meta']
+
+        meta = dict(row['extra_meta'])
+        if row['confirmed'] is not None:
+            meta['confirmed'] = row['confirmed']
+        if row['confidence'] is not None and 'confidence_percent' not in meta:
+            meta['confidence_percent'] = row['confidence']
+        return meta
+
+    @staticmethod
+    def number(value):
+        return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+    @classmethod
+    def shape_box(cls, shape):
+        """Returns (x_min, y_min, x_max, y_max) of the shape or None if it isn't a box"""
+        shape = shape if isinstance(shape, dict) else {}
+        xs = [cls.number(shape.get(key)) for key in ('startX', 'endX')]
+        ys = [cls.number(shape.get(key)) for key in ('startY', 'endY')]
+        if None in xs or None in ys:
+            return None
+        return min(xs), min(ys), max(xs), max(ys)
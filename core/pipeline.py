@@ -0,0 +1,202 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q, F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from core.models import Image, Job
+
+logger = logging.getLogger(__name__)
+
+MAX_BACKOFF = 60  # seconds between attempts to read the queue while the database fails
+
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def enqueue_processing(image_ids):
+    """
+    Queues every stage of settings.PROCESSING_STAGES for the images. Called within the transaction that creates them,
+    so jobs are queued exactly when the images are committed
+    """
+    if not settings.PROCESSING_STAGES or not image_ids:
+        return
+
+    now = timezone.now()
+    Job.objects.bulk_create([Job(image_id=image_id, stage=stage, run_after=now, updated_at=now)
+                             for image_id in image_ids for stage in settings.PROCESSING_STAGES])
+    Image.objects.filter(id__in=image_ids).update(processing_status=Image.PROCESSING_PENDING)
+    transaction.on_commit(notify_worker)
+
+
+def notify_worker():
+    """Wakes up the in-process worker, separate workers poll the queue"""
+    global _worker
+    if not settings.PROCESSING_IN_PROCESS:
+        return
+
+    with _worker_lock:
+        if _worker is None:
+            _worker = Worker(settings.PROCESSING_WORKERS)
+            threading.Thread(target=_worker.run, name='processing-worker', daemon=True).start()
+    _worker.wake()
+
+
+def run_cpu(func, *args):
+    """
+    Runs the function in the process pool of Pillow work, it has to be importable from a module.
+    Processes are spawned instead of forked, a fork of the threaded web process may copy locks held by other threads
+    """
+    global _cpu_pool
+    if not settings.PROCESSING_CPU_WORKERS:
+        return func(*args)
+
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ProcessPoolExecutor(max_workers=settings.PROCESSING_CPU_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'), initializer=django.setup)
+    return _cpu_pool.submit(func, *args).result()
+
+
+def claim_jobs(limit):
+    """
+    Marks due jobs as running and returns them, jobs taken by other workers at the same time are skipped.
+    Jobs that timed out on their last attempt are failed instead of being taken again
+    """
+    now = timezone.now()
+    timed_out = Q(status=Job.RUNNING, updated_at__lt=now - settings.PROCESSING_JOB_TIMEOUT)
+    due = Q(status=Job.PENDING, run_after__lte=now) | (timed_out & Q(attempts__lt=settings.PROCESSING_MAX_ATTEMPTS))
+    with transaction.atomic():
+        exhausted = dict(Job.objects.select_for_update(skip_locked=True)
+                         .filter(timed_out, attempts__gte=settings.PROCESSING_MAX_ATTEMPTS)
+                         .values_list('id', 'image_id'))
+        Job.objects.filter(id__in=exhausted).update(status=Job.FAILED, error='Timed out', updated_at=now)
+
+        job_ids = list(Job.objects.select_for_update(skip_locked=True).filter(due).order_by('id')
+                       .values_list('id', flat=True)[:limit])
+        if job_ids:
+            Job.objects.filter(id__in=job_ids).update(status=Job.RUNNING, attempts=F('attempts') + 1, updated_at=now)
+            Image.objects.filter(jobs__id__in=job_ids).update(processing_status=Image.PROCESSING_RUNNING)
+
+    for image_id in set(exhausted.values()):
+        update_processing_status(image_id)
+    if not job_ids:
+        return []
+    return list(Job.objects.select_related('image__blob').filter(id__in=job_ids).order_by('id'))
+
+
+def run_job(job):
+    try:
+        stage = import_string(settings.PROCESSING_STAGES[job.stage])
+    except (KeyError, ImportError):  # the stage was removed or renamed, retrying won't help
+        logger.exception('Job %s has unknown stage %s', job.id, job.stage)
+        job.status = Job.FAILED
+        job.error = f'Unknown stage: {job.stage}'
+    else:
+        try:
+            stage(job.image)
+        except Exception as err:
+            logger.exception('Job %s failed', job.id)
+            job.error = f'{type(err).__name__}: {err}'
+            if job.attempts >= settings.PROCESSING_MAX_ATTEMPTS:
+                job.status = Job.FAILED
+            else:
+                job.status = Job.PENDING
+                job.run_after = timezone.now() + settings.PROCESSING_RETRY_DELAY * 2 ** (job.attempts - 1)
+        else:
+            job.status = Job.DONE
+            job.error = ''
+
+    # the job is gone if its image was deleted while it ran
+    Job.objects.filter(id=job.id).update(status=job.status, error=job.error, run_after=job.run_after,
+                                         updated_at=timezone.now())
+    update_processing_status(job.image_id)
+
+
+@transaction.atomic
+def update_processing_status(image_id):
+    """Sets status of the image from its jobs, jobs are deleted once all of them are done"""
+    statuses = set(Job.objects.select_for_update().filter(image_id=image_id).values_list('status', flat=True))
+    if Job.PENDING in statuses or Job.RUNNING in statuses:
+        return
+
+    if Job.FAILED in statuses:
+        processing_status = Image.PROCESSING_FAILED
+    else:
+        processing_status = Image.PROCESSING_DONE
+        Job.objects.filter(image_id=image_id).delete()
+    Image.objects.filter(id=image_id).update(processing_status=processing_status)
+
+
+def run_jobs(batch_size=10):
+    """Runs due jobs until there are none left, returns how many were run"""
+    count = 0
+    while True:
+        jobs = claim_jobs(batch_size)
+        if not jobs:
+            return count
+
+        for job in jobs:
+            run_job(job)
+        count += len(jobs)
+
+
+class Worker:
+    """Runs queued jobs in a pool of threads until stopped, polls the queue when it's empty"""
+
+    def __init__(self, threads=1, poll_interval=None):
+        self.threads = threads
+        self.poll_interval = poll_interval or settings.PROCESSING_POLL_INTERVAL
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+
+    def wake(self):
+        self._wake_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def run(self, once=False):
+        """Runs jobs until stopped, or until the queue is empty if once is set. Returns how many jobs were run"""
+        if self.threads == 1:
+            return self.work(once)
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            return sum(executor.map(lambda _: self.work(once), range(self.threads)))
+
+    def work(self, once):
+        count = failures = 0
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    ran = run_jobs()
+                except Exception:
+                    # e.g. a dropped database connection, the worker keeps going once it's back
+                    if once:
+                        raise
+                    logger.exception('Processing jobs failed')
+                    close_old_connections()
+                    failures += 1
+                    self._stop_event.wait(min(self.poll_interval * 2 ** failures, MAX_BACKOFF))
+                    continue
+
+                failures = 0
+                count += ran
+                if not ran:
+                    if once:
+                        break
+                    self._wake_event.wait(self.poll_interval)
+                    self._wake_event.clear()
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()  # every thread has a connection of its own
+        return count
@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from io import BytesIO
+from itertools import product
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from core import metrics
+
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+
+
+class LRUCache:
+    """Thread-safe LRU of bytes values bounded by their total size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class RenditionService:
+    """
+    Resized and re-encoded versions of stored images. Renditions are kept in the storage under a deterministic key
+    with an in-process LRU in front. Concurrent requests for the same missing rendition wait for a single render
+    """
+
+    def __init__(self, max_bytes):
+        self.memory = LRUCache(max_bytes)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(name, width, height, format_key):
+        return f'renditions/{width}x{height}/{name}.{format_key}'
+
+    @classmethod
+    def delete_renditions(cls, name):
+        """Deletes stored renditions of the stored file in every allowed size and format"""
+        for width, height, format_key in product(settings.RENDITION_SIZES, settings.RENDITION_SIZES, FORMATS):
+            default_storage.delete(cls.make_key(name, width, height, format_key))
+
+    def get(self, name, width, height, format_key):
+        key = self.make_key(name, width, height, format_key)
+        content = self.memory.get(key)
+        if content is not None:
+            return content
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            content = self.load(key)
+            if content is None:
+                content = self.render(name, width, height, format_key)
+                default_storage.save(key, ContentFile(content))
+            self.memory.set(key, content)
+            future.set_result(content)
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+        return content
+
+    @staticmethod
+    def load(key):
+        if not default_storage.exists(key):
+            return None
+        with default_storage.open(key) as file:
+            return file.read()
+
+    @staticmethod
+    @metrics.timer('decode')
+    def render(name, width, height, format_key):
+        with default_storage.open(name) as file:
+            return render_image(file, width, height, format_key)
+
+
+def render_image(file, width, height, format_key):
+    """Resized and re-encoded content of the image file"""
+    image = PILImage.open(file)
+    # JPEG can be decoded at a reduced scale right away, which is a lot cheaper than a full decode
+    image.draft('RGB', (width, height))
+    image.thumbnail((width, height))
+
+    pil_format, _ = FORMATS[format_key]
+    if pil_format == 'JPEG' or image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        image = image.convert('RGB')
+
+    output = BytesIO()
+    image.save(output, pil_format)
+    return output.getvalue()
+
+
+def render_content(content, width, height, format_key):
+    """render_image of bytes, used by worker processes of core.pipeline"""
+    return render_image(BytesIO(content), width, height, format_key)
+
+
+rendition_service = RenditionService(settings.RENDITION_CACHE_MAX_BYTES)
@@ -0,0 +1,119 @@
+from django.db.models import Exists, OuterRef, Count, Q
+
+from core.models import Image, Label
+from core.serializers import AnnotationSerializer
+from core.utils import encode_cursor
+
+
+def filter_labels(labels, class_id=None, confirmed=None, confidence_min=None, confidence_max=None, region=None,
+                  relation='intersects', area_min=None, area_max=None):
+    """Applies label filters, they only use indexed columns, so JSON of labels isn't read"""
+    if class_id is not None:
+        labels = labels.filter(class_id=class_id)
+    if confirmed is not None:
+        labels = labels.filter(confirmed=True) if confirmed else labels.exclude(confirmed=True)
+    if confidence_min is not None:
+        labels = labels.filter(confidence__gte=confidence_min)
+    if confidence_max is not None:
+        labels = labels.filter(confidence__lte=confidence_max)
+
+    if region is not None:
+        x0, y0, x1, y1 = region
+        if relation == 'within':
+            labels = labels.filter(x_min__gte=x0, y_min__gte=y0, x_max__lte=x1, y_max__lte=y1)
+        else:
+            labels = labels.filter(x_min__lte=x1, y_min__lte=y1, x_max__gte=x0, y_max__gte=y0)
+
+    if area_min is not None:
+        labels = labels.filter(area__gte=area_min)
+    if area_max is not None:
+        labels = labels.filter(area__lte=area_max)
+
+    return labels
+
+
+def search_images(created_after=None, created_before=None, after=None, limit=100, **label_filters):
+    """
+    Returns (files, cursor) of images that have a label matching all the label filters, ordered by cursor.
+    The cursor of the last image is returned if there may be more of them, the next page starts after it
+    """
+    labels = filter_labels(Label.objects.filter(annotation_id=OuterRef('annotation')), **label_filters)
+
+    images = Image.objects.filter(Exists(labels)).order_by('id')
+    if created_after is not None:
+        images = images.filter(created_at__gte=created_after)
+    if created_before is not None:
+        images = images.filter(created_at__lt=created_before)
+    if after is not None:
+        images = images.filter(id__gt=after)
+
+    rows = list(images.values_list('id', 'file')[:limit])
+    cursor = rows[-1][0] if len(rows) == limit else None
+    return [file for _, file in rows], cursor
+
+
+def search_labels(image=None, after=None, limit=100, **label_filters):
+    """
+    Returns (labels, cursor) of labels matching the filters with ids of their images, ordered by label id.
+    The id of the last label is returned if there may be more of them, the next page starts after it
+    """
+    labels = filter_labels(Label.objects.order_by('id'), **label_filters)
+    if image is not None:
+        labels = labels.filter(annotation__image__file=image)
+    if after is not None:
+        labels = labels.filter(id__gt=after)
+
+    results = []
+    for row in AnnotationSerializer.labels_values(labels, extra_fields=['annotation__image__file'])[:limit]:
+        image_file = row.pop('annotation__image__file')
+        results.append({'image': image_file, **AnnotationSerializer.label_representation(row)})
+
+    cursor = results[-1]['id'] if len(results) == limit else None
+    return results, cursor
+
+
+def list_images(format=None, size_min=None, size_max=None, annotated=None, cursor=None, limit=100):
+    """
+    Returns (images, cursor) of a page of images ordered by (created_at, id). Pages are read by keyset, so every page
+    is as fast as the first one. Label counts of the whole page are read by one aggregated query
+    """
+    images = Image.objects.order_by('created_at', 'id')
+    if format is not None:
+        images = images.filter(format=format)
+    if size_min is not None:
+        images = images.filter(size__gte=size_min)
+    if size_max is not None:
+        images = images.filter(size__lte=size_max)
+    if annotated is not None:
+        images = images.filter(annotation__isnull=not annotated)
+    if cursor is not None:
+        created_at, image_id = cursor
+        images = images.filter(Q(created_at__gt=created_at) | Q(id__gt=image_id), created_at__gte=created_at)
+
+    rows = list(images.values('id', 'file', 'created_at', 'format', 'mime', 'size', 'width', 'height',
+                              'processing_status', 'annotation__id')[:limit])
+
+    annotation_ids = [row['annotation__id'] for row in rows if row['annotation__id'] is not None]
+    counts = Label.objects.filter(annotation_id__in=annotation_ids).values('annotation_id').annotate(
+        labels=Count('id'), confirmed_labels=Count('id', filter=Q(confirmed=True)),
+    ).order_by()
+    counts = {row.pop('annotation_id'): row for row in counts}
+
+    results = [
+        {
+            'id': row['file'],
+            'created_at': row['created_at'],
+            'format': row['format'] or None,
+            'mime': row['mime'] or None,
+            'size': row['size'],
+            'width': row['width'],
+            'height': row['height'],
+            'processing_status': row['processing_status'],
+            'annotated': row['annotation__id'] is not None,
+            **counts.get(row['annotation__id'], {'labels': 0, 'confirmed_labels': 0}),
+        }
+        for row in rows
+    ]
+
+    next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if len(rows) == limit else None
+    return results, next_cursor
@@ -1,20 +1,38 @@
-from collections import OrderedDict
-
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models
+from django.db.models import F, Q
+from django.utils import timezone
 from django.utils.text import get_valid_filename
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound
 from django.db import transaction
 
-from core.models import Image, Annotation, Label
+from core import metrics
+from core.blobs import acquire_blobs, reference_blob, store_blobs
+from core.cache import annotation_cache
+from core.models import Image, Annotation, Label, UploadReservation
+from core.pipeline import enqueue_processing
+from core.renditions import FORMATS as RENDITION_FORMATS
+from core.storage import presigned_upload_url, RangeFile
+from core.utils import decode_cursor
 
 
 class LabelSerializer(serializers.ModelSerializer):
     id = serializers.UUIDField(required=False)
     annotation_id = serializers.IntegerField(required=False, write_only=True)
+    # properties of the model stored in typed columns
+    surface = serializers.JSONField(required=False)
+    shape = serializers.JSONField(required=False)
+    meta = serializers.JSONField(required=False)
 
     class Meta:
         model = Label
         fields = ['annotation_id', 'id', 'class_id', 'surface', 'shape', 'meta']
+        read_fields = ['id', 'class_id', 'surface', 'shape', 'meta']
         export_fields = ['id', 'class_id', 'surface']  # fields used when query param format=export
+        update_fields = ['class_id', 'surface', 'shape', 'meta']  # fields compared when labels are rewritten
 
 
 class AnnotationSerializer(serializers.ModelSerializer):
@@ -27,51 +45,105 @@ class AnnotationSerializer(serializers.ModelSerializer):
         model = Annotation
         fields = ['image_id', 'labels']
 
-    def to_representation(self, instance):
-        result = super().to_representation(instance)
+    @classmethod
+    def is_export(cls, request):
+        return request is not None and request.query_params.get('format', '').lower() == cls.EXPORT_FORMAT_KEY
+
+    @staticmethod
+    def labels_values(labels, export=False, extra_fields=()):
+        """Returns values() rows of label columns of the requested format. Export filtering is done by the database"""
+        if export:
+            labels, fields = labels.filter(confirmed=True), LabelSerializer.Meta.export_fields
+        else:
+            fields = LabelSerializer.Meta.read_fields
+        return labels.values(*extra_fields, *Label.columns(fields))
 
-        format_param = self.context['request'].query_params.get('format', '')
-        if format_param.lower() == self.EXPORT_FORMAT_KEY:
-            result['labels'] = list(filter(lambda o: o['meta'].get('confirmed'),  result['labels']))
+    @staticmethod
+    def label_representation(row, export=False):
+        label = {'id': str(row['id']), 'class_id': row['class_id']}
+        if export:
+            label['surface'] = Label.export_surface(row)
+        else:
+            label.update(surface=Label.unpack_surface(row), shape=Label.unpack_shape(row), meta=Label.unpack_meta(row))
+        return label
 
-            for idx, label in enumerate(result['labels']):
-                label = OrderedDict((key, val) for key, val in label.items()
-                                    if key in LabelSerializer.Meta.export_fields)
-                label['surface'] = ''.join(label['surface'])
-                result['labels'][idx] = label
+    def to_representation(self, instance):
+        # labels are built straight from database rows, nested field serialization is too slow for big annotations
+        export = self.is_export(self.context.get('request'))
+        labels = self.labels_values(Label.objects.filter(annotation_id=instance.id), export)
 
-        return result
+        return {'labels': [self.label_representation(row, export) for row in labels]}
 
     @staticmethod
-    def check_existing_labels(validated_data):
-        ids = [label['id'] for label in validated_data if 'id' in label]
-        existing_labels = Label.objects.filter(id__in=ids).values_list('id', flat=True)
-        if existing_labels:
-            msg = f'Labels with these ids already exist: {list(existing_labels)}'
+    def build_labels(annotation, labels_data):
+        """Makes unsaved labels of the annotation from validated data"""
+        labels = []
+        for label_data in labels_data or []:
+            label_data = dict(label_data)
+            label_data.pop('annotation_id', None)
+            labels.append(Label(annotation=annotation, **label_data))
+
+        ids = [label.id for label in labels]
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError({'labels': 'Label ids must be unique'})
+
+        return labels
+
+    @classmethod
+    def save_labels(cls, annotation, labels_data, created=False):
+        """
+        Brings labels of the annotation in line with labels_data. Incoming ids are compared with the stored ones,
+        so only labels that differ are inserted, updated or deleted. Number of queries doesn't depend on labels count.
+        Returns True if anything was written
+        """
+        labels = cls.build_labels(annotation, labels_data)
+        ids = [label.id for label in labels]
+
+        lookup = Q(id__in=ids)
+        if not created:
+            lookup |= Q(annotation=annotation)
+
+        stored_labels, foreign_ids = {}, []
+        for label in Label.objects.filter(lookup):
+            if label.annotation_id == annotation.id:
+                stored_labels[label.id] = label
+            else:
+                foreign_ids.append(label.id)
+
+        if foreign_ids:
+            msg = f'Labels with these ids already exist: {foreign_ids}'
             raise serializers.ValidationError({'labels': msg})
 
-    @staticmethod
-    def create_labels(annotation, labels_data):
-        if labels_data:
-            for label in labels_data:
-                label['annotation_id'] = annotation.id
+        new_labels, changed_labels = [], []
+        for label in labels:
+            stored = stored_labels.get(label.id)
+            if stored is None:
+                new_labels.append(label)
+            elif any(getattr(label, field) != getattr(stored, field) for field in LabelSerializer.Meta.update_fields):
+                changed_labels.append(label)
 
-            serializer = LabelSerializer(data=labels_data, many=True)
+        removed_ids = stored_labels.keys() - set(ids)
+        if removed_ids:
+            Label.objects.filter(id__in=removed_ids).delete()
+        if new_labels:
+            Label.objects.bulk_create(new_labels)
+        if changed_labels:
+            Label.objects.bulk_update(changed_labels, Label.update_columns(LabelSerializer.Meta.update_fields))
 
-            serializer.is_valid(raise_exception=True)
-            AnnotationSerializer.check_existing_labels(serializer.validated_data)
+        return bool(removed_ids or new_labels or changed_labels)
 
-            labels = serializer.save()
-        else:
-            labels = []
-        return labels
+    @staticmethod
+    def bump_version(instance):
+        Annotation.objects.filter(id=instance.id).update(version=F('version') + 1)
+        instance.refresh_from_db(fields=['version'])
+        annotation_cache.invalidate(instance.id)
 
     @transaction.atomic
     def create(self, validated_data):
         labels_data = validated_data.pop('labels', None)
         annotation = super().create(validated_data)
 
-        self.create_labels(annotation, labels_data)
+        self.save_labels(annotation, labels_data, created=True)
 
         return annotation
 
@@ -80,13 +152,108 @@ class AnnotationSerializer(serializers.ModelSerializer):
         labels_data = validated_data.pop('labels', None)
         instance = super().update(instance, validated_data)
 
-        instance.labels.all().delete()
-        self.create_labels(instance, labels_data)
+        if self.save_labels(instance, labels_data):
+            self.bump_version(instance)
+
+        return instance
+
+
+class LabelPatchSerializer(LabelSerializer):
+    id = serializers.UUIDField()
+    annotation_id = None
+
+    class Meta(LabelSerializer.Meta):
+        fields = ['id', 'class_id', 'surface', 'shape', 'meta']
+        extra_kwargs = {'class_id': {'required': False}}
+
+    def validate_meta(self, meta):
+        if not isinstance(meta, dict):
+            raise serializers.ValidationError('Expected a dictionary of keys to merge.')
+        return meta
+
+
+class AnnotationPatchSerializer(serializers.Serializer):
+    """
+    Incremental changes of annotation labels: labels to add, fields of labels to update and ids of labels to remove.
+    Keys of 'meta' are merged into the stored meta, null removes a key. Number of queries doesn't depend on labels count
+    """
+    def get_fields(self):
+        # declared in here, because a field named 'update' would clash with the serializer method
+        return {
+            'add': LabelSerializer(many=True, required=False),
+            'update': LabelPatchSerializer(many=True, required=False),
+            'remove': serializers.ListField(child=serializers.UUIDField(), required=False),
+        }
+
+    def validate(self, attrs):
+        ids = [label['id'] for label in attrs.get('add', []) if 'id' in label]
+        ids += [label['id'] for label in attrs.get('update', [])]
+        ids += attrs.get('remove', [])
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError('Every label id can be used only once')
+
+        return attrs
+
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        # concurrent patches of the annotation wait for each other, so merged meta keys of neither are lost
+        Annotation.objects.select_for_update().get(pk=instance.pk)
+
+        new_labels = AnnotationSerializer.build_labels(instance, validated_data.get('add'))
+        updates = {label_data['id']: label_data for label_data in validated_data.get('update', [])}
+        removed_ids = set(validated_data.get('remove', []))
+
+        stored_labels = Label.objects.filter(id__in=[*updates, *removed_ids, *(label.id for label in new_labels)])
+        stored_labels = {label.id: label for label in stored_labels}
+
+        taken_ids = [label.id for label in new_labels if label.id in stored_labels]
+        if taken_ids:
+            raise serializers.ValidationError({'add': f'Labels with these ids already exist: {taken_ids}'})
+
+        missing_ids = [label_id for label_id in [*updates, *removed_ids]
+                       if label_id not in stored_labels or stored_labels[label_id].annotation_id != instance.id]
+        if missing_ids:
+            raise serializers.ValidationError(f'Labels with these ids do not exist: {missing_ids}')
+
+        changed_labels, changed_fields = [], set()
+        for label_id, label_data in updates.items():
+            label, is_changed = stored_labels[label_id], False
+            for field, value in label_data.items():
+                if field == 'id':
+                    continue
+                if field == 'meta':
+                    value = {key: val for key, val in {**label.meta, **value}.items() if val is not None}
+
+                if getattr(label, field) != value:
+                    setattr(label, field, value)
+                    changed_fields.add(field)
+                    is_changed = True
+
+            if is_changed:
+                changed_labels.append(label)
+
+        if removed_ids:
+            Label.objects.filter(id__in=removed_ids).delete()
+        if new_labels:
+            Label.objects.bulk_create(new_labels)
+        if changed_labels:
+            Label.objects.bulk_update(changed_labels, Label.update_columns(sorted(changed_fields)))
+
+        if removed_ids or new_labels or changed_labels:
+            AnnotationSerializer.bump_version(instance)
 
         return instance
 
 
+class ImageField(serializers.ImageField):
+    def to_internal_value(self, data):
+        with metrics.timer('decode'):
+            return super().to_internal_value(data)
+
+
 class ImageSerializer(serializers.ModelSerializer):
+    serializer_field_mapping = {**serializers.ModelSerializer.serializer_field_mapping, models.ImageField: ImageField}
+
     SUPPORTED_FORMATS = ['JPEG', 'PNG', 'TIFF']
     FILE_MAX_SIZE = 20 * 1024 * 1024  # in MB
 
@@ -96,35 +263,57 @@ class ImageSerializer(serializers.ModelSerializer):
         model = Image
         fields = ['file', 'annotation']
 
-    def to_internal_value(self, data: dict):
-        data = dict(data)
-        for key, val in data.items():
-            if val:
-                data[key] = val[0]  # unpack data from multipart format
-
-        return super().to_internal_value(data)
-
     def to_representation(self, instance):
         return {'id': instance.file.name}
 
-    def validate_file(self, file):
-        filename = get_valid_filename(file.name)
+    @classmethod
+    def check_image(cls, image_format, size):
+        if image_format not in cls.SUPPORTED_FORMATS:
+            raise serializers.ValidationError(f'{image_format} format is not supported. '
+                                              f'Supported formats: {cls.SUPPORTED_FORMATS}')
+
+        if size > cls.FILE_MAX_SIZE:
+            raise serializers.ValidationError(f'Your file is too big. Maximum size is {cls.FILE_MAX_SIZE} MB')
+
+    @staticmethod
+    def image_metadata(image):
+        """Values of Image.METADATA_FIELDS of an image opened by Pillow"""
+        return {
+            'format': image.format,
+            'mime': PILImage.MIME.get(image.format, ''),
+            'width': image.width,
+            'height': image.height,
+            'mode': image.mode,
+        }
+
+    @staticmethod
+    def check_filename(filename):
         if Image.objects.filter(file=filename).exists():
             raise serializers.ValidationError('File already exists')
 
-        if file.image.format not in self.SUPPORTED_FORMATS:
-            raise serializers.ValidationError(f'{file.image.format} format is not supported. '
-                                              f'Supported formats: {self.SUPPORTED_FORMATS}')
+        if UploadReservation.objects.filter(file=filename, expires_at__gt=timezone.now()).exists():
+            raise serializers.ValidationError('File is being uploaded')
 
-        if file.size > self.FILE_MAX_SIZE:
-            raise serializers.ValidationError(f'Your file is too big. Maximum size is {self.FILE_MAX_SIZE} MB')
+    def validate_file(self, file):
+        self.check_filename(get_valid_filename(file.name))
+        self.check_image(file.image.format, file.size)
 
         return file
 
-    @transaction.atomic
     def create(self, validated_data):
+        store_blobs([validated_data['file']])
+        return self.create_image(validated_data)
+
+    @transaction.atomic
+    def create_image(self, validated_data):
         annotation_data = validated_data.pop('annotation', None)
-        image = super().create(validated_data)
+        file = validated_data['file']
+
+        # bytes are stored once per content, the image only refers to them
+        [blob] = acquire_blobs([file])
+        image = Image.objects.create(file=get_valid_filename(file.name), blob=blob, size=file.size,
+                                     sha256=blob.sha256, **self.image_metadata(file.image))
+        enqueue_processing([image.id])
 
         if annotation_data:
             annotation_data['image_id'] = image.id
@@ -133,3 +322,238 @@ class ImageSerializer(serializers.ModelSerializer):
             serializer.save()
 
         return image
+
+
+class UploadReservationSerializer(serializers.ModelSerializer):
+    file = serializers.CharField(max_length=100)
+    annotation = AnnotationSerializer(required=False)
+
+    class Meta:
+        model = UploadReservation
+        fields = ['file', 'annotation']
+
+    def to_representation(self, instance):
+        expires_in = int((instance.expires_at - timezone.now()).total_seconds())
+        return {'id': instance.file, 'upload_url': instance.upload_url, 'expires_in': expires_in}
+
+    def validate_file(self, file):
+        filename = get_valid_filename(file)
+        ImageSerializer.check_filename(filename)
+
+        return filename
+
+    @transaction.atomic
+    def create(self, validated_data):
+        # expired reservation of the same file is taken over
+        UploadReservation.objects.filter(file=validated_data['file']).delete()
+
+        reservation = UploadReservation.objects.create(
+            file=validated_data['file'],
+            annotation=self.initial_data.get('annotation'),  # validated labels aren't JSON serializable
+            expires_at=timezone.now() + settings.MEDIA_UPLOAD_URL_EXPIRES,
+        )
+        reservation.upload_url = presigned_upload_url(reservation.file)
+
+        return reservation
+
+
+class UploadFinalizeSerializer(serializers.Serializer):
+    """Checks the file uploaded straight to the storage and creates rows of the image and its annotation"""
+    HEADER_SIZE = 64 * 1024  # enough for Pillow to detect format of supported images
+
+    def validate(self, attrs):
+        reservation = self.context['reservation']
+        self.check_expiry(reservation)
+        if Image.objects.filter(file=reservation.file).exists():
+            raise serializers.ValidationError({'file': ['File already exists']})
+
+        try:
+            size = default_storage.size(reservation.file)
+        except OSError:
+            raise serializers.ValidationError({'file': ['File was not uploaded']})
+
+        image = self.open_image(reservation.file, size)
+        try:
+            ImageSerializer.check_image(image.format if image else None, size)
+        except serializers.ValidationError as err:
+            default_storage.delete(reservation.file)
+            reservation.delete()
+            raise serializers.ValidationError({'file': err.detail})
+
+        return {**attrs, 'metadata': {**ImageSerializer.image_metadata(image), 'size': size}}
+
+    @staticmethod
+    def check_expiry(reservation):
+        # the name may be reserved by another request once the reservation expires
+        if reservation.expires_at <= timezone.now():
+            raise serializers.ValidationError({'file': ['Upload reservation has expired']})
+
+    @classmethod
+    def open_image(cls, name, size):
+        """
+        Opens the stored image by Pillow reading only its header, returns None if it isn't an image.
+        Ranges are fetched as Pillow reads them, e.g. the directory of a TIFF file that's further than the header
+        """
+        file = RangeFile(name, size, block_size=cls.HEADER_SIZE)
+        try:
+            file.block(0)  # the header is read outside of the decode timer, like the other storage reads
+            with metrics.timer('decode'):
+                return PILImage.open(file)
+        except (OSError, SyntaxError):
+            return None
+
+    @transaction.atomic
+    def create(self, validated_data):
+        # concurrent finalize requests of the reservation wait for the first one, which deletes it
+        reservation = UploadReservation.objects.select_for_update().filter(pk=self.context['reservation'].pk).first()
+        if reservation is None or Image.objects.filter(file=reservation.file).exists():
+            raise serializers.ValidationError({'file': ['File already exists']})
+        self.check_expiry(reservation)
+
+        # content of direct uploads isn't read as a whole, its hash is left to the metadata stage of processing
+        image = Image.objects.create(file=reservation.file, **validated_data['metadata'])
+        enqueue_processing([image.id])
+
+        if reservation.annotation:
+            serializer = AnnotationSerializer(data={**reservation.annotation, 'image_id': image.id})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+
+        reservation.delete()
+        return image
+
+    def to_representation(self, instance):
+        return {'id': instance.file.name}
+
+
+class RenditionSerializer(serializers.Serializer):
+    w = serializers.ChoiceField(choices=settings.RENDITION_SIZES)
+    h = serializers.ChoiceField(choices=settings.RENDITION_SIZES, required=False)
+    fmt = serializers.ChoiceField(choices=list(RENDITION_FORMATS), default='jpeg')
+
+    def validate(self, attrs):
+        attrs.setdefault('h', attrs['w'])
+        return attrs
+
+
+class AnnotationExportSerializer(serializers.Serializer):
+    format = serializers.ChoiceField(choices=['internal', AnnotationSerializer.EXPORT_FORMAT_KEY], default='internal')
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    class_id = serializers.CharField(required=False, max_length=255)
+    after = serializers.IntegerField(required=False, min_value=0)  # cursor of the last received annotation
+
+
+class AnnotationBatchSerializer(serializers.Serializer):
+    files = serializers.ListField(child=serializers.CharField(max_length=255), allow_empty=False,
+                                  max_length=settings.ANNOTATION_BATCH_MAX_FILES)
+    format = serializers.ChoiceField(choices=['internal', AnnotationSerializer.EXPORT_FORMAT_KEY], default='internal')
+
+
+class DatasetExportSerializer(AnnotationExportSerializer):
+    format = serializers.ChoiceField(choices=['internal', AnnotationSerializer.EXPORT_FORMAT_KEY],
+                                     default=AnnotationSerializer.EXPORT_FORMAT_KEY)
+    layout = serializers.ChoiceField(choices=['coco', 'yolo'], default='coco')
+    archive = serializers.ChoiceField(choices=['zip', 'tar'], default='zip')
+    after = None  # archives aren't resumed
+
+
+class ImageListSerializer(serializers.Serializer):
+    format = serializers.ChoiceField(choices=ImageSerializer.SUPPORTED_FORMATS, required=False)
+    size_min = serializers.IntegerField(required=False, min_value=0)
+    size_max = serializers.IntegerField(required=False, min_value=0)
+    annotated = serializers.BooleanField(required=False, allow_null=True, default=None)
+    cursor = serializers.CharField(required=False)
+    limit = serializers.IntegerField(default=100, min_value=1, max_value=1000)
+
+    def to_internal_value(self, data):
+        if 'format' in data:
+            data = data.copy()
+            data['format'] = data['format'].upper()
+        return super().to_internal_value(data)
+
+    def validate_cursor(self, cursor):
+        try:
+            return decode_cursor(cursor)
+        except ValueError:
+            raise serializers.ValidationError('Invalid cursor')
+
+
+class LabelFilterSerializer(serializers.Serializer):
+    """Filters of label search. A region is given by x0, y0, x1, y1, labels either intersect it or are within it"""
+    RELATIONS = ['intersects', 'within']
+
+    class_id = serializers.CharField(required=False, max_length=255)
+    confirmed = serializers.BooleanField(required=False, allow_null=True, default=None)
+    confidence_min = serializers.FloatField(required=False)
+    confidence_max = serializers.FloatField(required=False)
+    x0 = serializers.FloatField(required=False)
+    y0 = serializers.FloatField(required=False)
+    x1 = serializers.FloatField(required=False)
+    y1 = serializers.FloatField(required=False)
+    relation = serializers.ChoiceField(choices=RELATIONS, default='intersects')
+    area_min = serializers.FloatField(required=False, min_value=0)
+    area_max = serializers.FloatField(required=False, min_value=0)
+
+    def validate(self, attrs):
+        region = [attrs.pop(key, None) for key in ('x0', 'y0', 'x1', 'y1')]
+        if any(value is not None for value in region):
+            if None in region:
+                raise serializers.ValidationError('Region needs all of x0, y0, x1 and y1')
+            x0, y0, x1, y1 = region
+            if x0 > x1 or y0 > y1:
+                raise serializers.ValidationError('Region must have x0 <= x1 and y0 <= y1')
+            attrs['region'] = tuple(region)
+
+        return attrs
+
+
+class ImageSearchSerializer(LabelFilterSerializer):
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    after = serializers.IntegerField(required=False, min_value=0)  # cursor of the last received image
+    limit = serializers.IntegerField(default=100, min_value=1, max_value=1000)
+
+
+class LabelSearchSerializer(LabelFilterSerializer):
+    image = serializers.CharField(required=False, max_length=100)
+    after = serializers.UUIDField(required=False)  # id of the last received label
+    limit = serializers.IntegerField(default=100, min_value=1, max_value=1000)
+
+
+class BlobImageSerializer(serializers.ModelSerializer):
+    """Creates an image from content that is already stored, so its bytes don't have to be uploaded again"""
+    file = serializers.CharField(max_length=100)
+    annotation = AnnotationSerializer(required=False)
+
+    class Meta:
+        model = Image
+        fields = ['file', 'annotation']
+
+    def to_representation(self, instance):
+        return {'id': instance.file.name}
+
+    def validate_file(self, file):
+        filename = get_valid_filename(file)
+        ImageSerializer.check_filename(filename)
+
+        return filename
+
+    @transaction.atomic
+    def create(self, validated_data):
+        blob = reference_blob(self.context['sha256'])
+        if blob is None:
+            raise NotFound('Content with this hash is not stored')
+
+        # images of the same content share its metadata
+        metadata = Image.objects.filter(blob=blob).exclude(format='').values(*Image.METADATA_FIELDS).first()
+        image = Image.objects.create(file=validated_data['file'], blob=blob, size=blob.size, sha256=blob.sha256,
+                                     **(metadata or {}))
+        enqueue_processing([image.id])
+
+        annotation_data = validated_data.get('annotation')
+        if annotation_data:
+            annotation = Annotation.objects.create(image=image)
+            AnnotationSerializer.save_labels(annotation, annotation_data.get('labels'), created=True)
+
+        return image
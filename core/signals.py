@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from core.blobs import release_blob
+from core.models import Image
+
+
+@receiver(post_delete, sender=Image)
+def release_image_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        release_blob(instance.blob_id)
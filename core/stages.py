@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from core import ingest
+from core.models import Image
+from core.pipeline import run_cpu
+from core.renditions import RenditionService, render_content
+
+
+def fill_metadata(image):
+    """Fills size, hash and metadata that weren't known on upload, e.g. hash of direct uploads"""
+    if image.size is not None and image.sha256 and image.width is not None:
+        return
+
+    if ingest.fill_metadata(image) is None:
+        raise OSError('Stored file could not be read')
+    image.save(update_fields=['size', 'sha256', *Image.METADATA_FIELDS])
+
+
+def prerender_renditions(image):
+    """Stores settings.PROCESSING_RENDITIONS of the image, so its first previews are served from the storage"""
+    keys = {rendition: RenditionService.make_key(image.storage_name, *rendition)
+            for rendition in settings.PROCESSING_RENDITIONS}
+    missing = [rendition for rendition, key in keys.items() if not default_storage.exists(key)]
+    if not missing:
+        return
+
+    with default_storage.open(image.storage_name) as file:
+        content = file.read()
+    for rendition in missing:
+        default_storage.save(keys[rendition], ContentFile(run_cpu(render_content, content, *rendition)))
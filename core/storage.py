@@ -0,0 +1,193 @@
+import io
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.utils.module_loading import import_string
+
+from core import metrics
+
+
+class InstrumentedStorage:
+    """Storage of settings.MEDIA_STORAGE that records its calls into request metrics"""
+
+    def __init__(self):
+        self.storage = import_string(settings.MEDIA_STORAGE)()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def open(self, name, mode='rb'):
+        with metrics.timer('storage'):
+            return self.storage.open(name, mode)
+
+    def save(self, name, content, max_length=None):
+        with metrics.timer('storage', size=content.size):
+            return self.storage.save(name, content, max_length=max_length)
+
+    def exists(self, name):
+        with metrics.timer('storage'):
+            return self.storage.exists(name)
+
+    def size(self, name):
+        with metrics.timer('storage'):
+            return self.storage.size(name)
+
+    def delete(self, name):
+        with metrics.timer('storage'):
+            return self.storage.delete(name)
+
+
+def get_minio_client(storage=None):
+    """Returns minio client of the storage or None if the storage isn't backed by Minio"""
+    return getattr(default_storage if storage is None else storage, 'client', None)
+
+
+def presigned_download_url(name, filename=None):
+    """
+    Returns (url, expires_at) of a presigned GET url for the stored file, or None if the storage can't sign urls.
+    The file is downloaded as filename if it's given. Urls are cached and reused until they get close to expiry
+    """
+    client = get_minio_client()
+    if client is None:
+        return None
+
+    cache = caches['default']
+    key = f'presigned-download:{name}:{filename}'
+    presigned = cache.get(key)
+    if presigned is None:
+        ttl = settings.MEDIA_DOWNLOAD_TTL
+        response_headers = {'response-content-disposition': f'attachment; filename="{filename}"'} if filename else None
+        url = client.presigned_get_object(default_storage.bucket_name, name, expires=ttl,
+                                          response_headers=response_headers)
+        presigned = (url, time.time() + ttl.total_seconds())
+
+        reuse_for = ttl - settings.MEDIA_DOWNLOAD_URL_REFRESH
+        cache.set(key, presigned, timeout=max(reuse_for.total_seconds(), 0))
+
+    return presigned
+
+
+def presigned_upload_url(name):
+    """Returns a presigned PUT url for uploading the file straight to the storage, or None if it isn't supported"""
+    client = get_minio_client()
+    if client is None:
+        return None
+
+    return client.presigned_put_object(default_storage.bucket_name, name, expires=settings.MEDIA_UPLOAD_URL_EXPIRES)
+
+
+def read_range(name, start, length):
+    """Reads length bytes of the stored file starting at start. Minio storage is asked for the range only"""
+    client = get_minio_client()
+    if client is None:
+        with default_storage.open(name) as file:
+            file.seek(start)
+            return file.read(length)
+
+    started_at = time.perf_counter()
+    response = client.get_partial_object(default_storage.bucket_name, name, start, length)
+    try:
+        content = response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+    metrics.record('storage', time.perf_counter() - started_at, size=len(content))
+    return content
+
+
+class RangeFile(io.RawIOBase):
+    """
+    Read-only file of a stored object for parsers that seek around, e.g. Pillow reading a TIFF directory.
+    Only blocks that are read are fetched by ranged reads, more than max_blocks of them is an OSError
+    """
+
+    def __init__(self, name, size, block_size=64 * 1024, max_blocks=16):
+        super().__init__()
+        self.name = name
+        self.size = size
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.position = 0
+        self.blocks = {}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def block(self, index):
+        if index not in self.blocks:
+            if len(self.blocks) >= self.max_blocks:
+                raise OSError(f'More than {self.max_blocks} blocks of {self.name} were read')
+            start = index * self.block_size
+            self.blocks[index] = read_range(self.name, start, min(self.block_size, self.size - start))
+        return self.blocks[index]
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        chunks = []
+        while self.position < end:
+            index, offset = divmod(self.position, self.block_size)
+            chunk = self.block(index)[offset:offset + end - self.position]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.position += len(chunk)
+        return b''.join(chunks)
+
+    def readinto(self, buffer):
+        content = self.read(len(buffer))
+        buffer[:len(content)] = content
+        return len(content)
+
+
+def iter_range(name, start, length, chunk_size=64 * 1024):
+    """Yields length bytes of the stored file starting at start in chunks. Minio storage is asked for the range only"""
+    client = get_minio_client()
+    if client is None:
+        with default_storage.open(name) as file:
+            file.seek(start)
+            while length > 0:
+                chunk = file.read(min(chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        return
+
+    with metrics.timer('storage'):  # the content is streamed after the request is handled
+        response = client.get_partial_object(default_storage.bucket_name, name, start, length)
+    try:
+        yield from response.stream(chunk_size)
+    finally:
+        response.close()
+        response.release_conn()
+
+
+async def aiter_range(name, start, length, chunk_size=None):
+    """
+    Async version of iter_range. Every chunk is a separate ranged read done in a worker thread, so neither a thread
+    nor a storage connection is held while a slow client is receiving the previous chunk
+    """
+    chunk_size = chunk_size or settings.ASYNC_DOWNLOAD_CHUNK_SIZE
+    read = sync_to_async(read_range, thread_sensitive=False)
+    while length > 0:
+        chunk = await read(name, start, min(chunk_size, length))
+        if not chunk:
+            break
+        start += len(chunk)
+        length -= len(chunk)
+        yield chunk
@@ -1,17 +1,63 @@
+import argparse
+import asyncio
+import hashlib
 import json
+import math
 import os
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
 from pathlib import Path
-from unittest.mock import patch
+from unittest.mock import Mock, call, patch
+from urllib.parse import unquote, urlsplit
 
+from PIL import Image as PILImage
+from minio import Minio
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.db import connection, DatabaseError
 from django.forms import model_to_dict
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework import status
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+from rest_framework import renderers, status
+from rest_framework.exceptions import ParseError, ValidationError
 from rest_framework.test import APIClient
 
-from core.models import Image, Annotation
-from core.serializers import ImageSerializer
+from core import pipeline
+from core.asgi import ASGIHandler
+from core.benchmark import run_benchmark, run_json_benchmark
+from core.blobs import collect_blobs
+from core.cache import annotation_cache
+from core.datasets import iter_dataset
+from core.disk_cache import DiskCache
+from core.export import iter_annotations as export_iter_annotations
+from core.imports import TarSource
+from core.ingest import create_rows as ingest_create_rows
+from core.metrics import MetricsRegistry
+from core.management.commands.benchmark import Command as BenchmarkCommand
+from core.models import Image, Annotation, Label, UploadReservation, Blob, Job
+from core.pipeline import Worker, claim_jobs, run_cpu, run_job, run_jobs as pipeline_run_jobs
+from core.renditions import RenditionService, render_content
+from core.serializers import ImageSerializer, UploadFinalizeSerializer
+from core.storage import read_range
+from core.utils import JSONParser, JSONRenderer
 
 TEST_DIR = Path(__file__).resolve().parent
 
@@ -21,6 +67,7 @@ class CommonTestCase(TestCase):
         super().setUp()
 
         self.client = APIClient()
+        caches['annotations'].clear()
 
         self.valid_image_path = TEST_DIR.joinpath('sample.png')
         self.invalid_image_path = TEST_DIR.joinpath('sample.gif')
@@ -67,14 +114,14 @@ class ImageCreationTestCase(CommonTestCase):
         file_id = response.json()['id']
         try:
             image = Image.objects.get(file=file_id)
-            self.assertEquals(image.file.size, os.path.getsize(self.valid_image_path))
+            self.assertEquals(default_storage.size(image.storage_name), os.path.getsize(self.valid_image_path))
 
             annotation = Annotation.objects.get(image__id=image.id)
 
             label = list(annotation.labels.all())[0]
-            compare_data = model_to_dict(label)
-            compare_data['id'] = str(label.id)
-            compare_data.pop('annotation')
+            # surface, shape and meta are stored in typed columns and read back by properties
+            compare_data = {'id': str(label.id), 'class_id': label.class_id, 'surface': label.surface,
+                            'shape': label.shape, 'meta': label.meta}
             self.assertDictEqual(compare_data, self.valid_annotation['labels'][0])
         except (Image.DoesNotExist, Annotation.DoesNotExist) as err:
             self.fail(err)
@@ -86,7 +133,7 @@ class ImageCreationTestCase(CommonTestCase):
         file_id = response.json()['id']
         try:
             image = Image.objects.get(file=file_id)
-            self.assertEquals(image.file.size, os.path.getsize(self.valid_image_path))
+            self.assertEquals(default_storage.size(image.storage_name), os.path.getsize(self.valid_image_path))
         except Image.DoesNotExist as err:
             self.fail(err)
 
@@ -167,9 +214,9 @@ class AnnotationUpdateTestCase(AnnotationBaseTestCase):
 
         label = Annotation.objects.get(image__file=self.file_id).labels.first()
 
-        compare_data = model_to_dict(label)
-        compare_data['id'] = str(label.id)
-        compare_data.pop('annotation')
+        # surface, shape and meta are stored in typed columns and read back by properties
+        compare_data = {'id': str(label.id), 'class_id': label.class_id, 'surface': label.surface,
+                        'shape': label.shape, 'meta': label.meta}
         self.assertDictEqual(compare_data, data['labels'][0])
 
     def test_update_empty_valid(self):
@@ -194,6 +241,129 @@ class AnnotationUpdateTestCase(AnnotationBaseTestCase):
         self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
+class AnnotationLabelsDiffTestCase(AnnotationBaseTestCase):
+    @staticmethod
+    def make_labels(count):
+        return [
+            {
+                "id": f"00000000-0000-0000-0000-{idx:012d}",
+                "class_id": "tooth",
+                "surface": ["1"],
+                "shape": {"endX": idx, "endY": idx, "startY": 0, "startX": 0},
+                "meta": {"confirmed": False},
+            }
+            for idx in range(count)
+        ]
+
+    def put_labels(self, labels):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.put(reverse('annotation', kwargs={'image__file': self.file_id}),
+                                       json.dumps({'labels': labels}), content_type='application/json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_update_only_changed_labels(self):
+        labels = self.make_labels(5)
+        self.put_labels(labels)
+
+        labels[0]['meta']['confirmed'] = True
+        labels.pop(1)
+        labels.append(self.make_labels(6)[5])
+        self.put_labels(labels)
+
+        stored = {str(label.id): label for label in Annotation.objects.get(image__file=self.file_id).labels.all()}
+        self.assertSetEqual(set(stored), {label['id'] for label in labels})
+        self.assertTrue(stored[labels[0]['id']].meta['confirmed'])
+
+    def test_update_queries_count_is_constant(self):
+        self.put_labels(self.make_labels(5))
+        small_count = self.put_labels(self.make_labels(10))
+
+        self.put_labels(self.make_labels(100))
+        big_count = self.put_labels(self.make_labels(200))
+
+        # a bulk insert is split into batches by backends that limit query parameters, like SQLite
+        batch_size = connection.ops.bulk_batch_size(Label._meta.concrete_fields, [None] * 100)
+        self.assertEquals(big_count, small_count + math.ceil(100 / batch_size) - 1)
+        self.assertEquals(Label.objects.count(), 200)
+
+    def test_update_duplicate_ids(self):
+        labels = self.make_labels(1) * 2
+        response = self.client.put(reverse('annotation', kwargs={'image__file': self.file_id}),
+                                   json.dumps({'labels': labels}), content_type='application/json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_foreign_label_id(self):
+        labels = deepcopy(self.valid_annotation['labels'])
+        self.valid_annotation['labels'][0]['id'] = "3c1cd508-587b-493b-98ea-b08a8c31d111"
+        data = {
+            'file': SimpleUploadedFile('other.png', self.valid_image_path.read_bytes()),
+            'data': json.dumps({'annotation': self.valid_annotation}),
+        }
+        response = self.client.post(reverse('images-create'), data, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+
+        # labels of the first image can't be moved to another annotation
+        response = self.client.put(reverse('annotation', kwargs={'image__file': response.json()['id']}),
+                                   json.dumps({'labels': labels}), content_type='application/json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LabelStorageTestCase(AnnotationBaseTestCase):
+    def test_values_are_read_back_as_written(self):
+        labels = [
+            {'surface': ['M', 'O'], 'shape': {'startX': 10, 'startY': 5, 'endX': 2, 'endY': 7},
+             'meta': {'confirmed': True, 'confidence_percent': 0.5, 'reviewer': 'dr. smith'}},
+            {'surface': ['MO', 'D'], 'shape': {'startX': 1.5, 'startY': 2, 'endX': 3, 'endY': 5},
+             'meta': {'confirmed': 'yes', 'confidence_percent': 1}},
+            {'surface': '123', 'shape': {'points': [[1, 2], [3, 4]]}, 'meta': ['note']},
+            {'surface': [], 'shape': {}, 'meta': {'confirmed': False, 'confidence_percent': None}},
+            {},
+        ]
+        for idx, label in enumerate(labels):
+            label.update(id=f'00000000-0000-0000-0000-{idx:012d}', class_id='tooth')
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        self.client.put(url, {'labels': labels}, format='json')
+
+        labels[-1].update(surface=[], shape={}, meta={})
+        self.assertEquals(self.client.get(url).json()['labels'], labels)
+        self.assertEquals([label['surface'] for label in self.client.get(url, {'format': 'export'}).json()['labels']],
+                          ['MO'])
+
+        stored = Label.objects.get(id=labels[0]['id'])
+        self.assertEquals((stored.surface_code, stored.start_x, stored.end_x, stored.confirmed, stored.extra_meta),
+                          ('MO', 10, 2, True, {'reviewer': 'dr. smith'}))
+        self.assertEquals((stored.x_min, stored.x_max, stored.area), (2, 10, 16))
+
+        # integer confidence is searched by as well
+        response = self.client.get(reverse('labels-search'), {'x0': 0, 'y0': 0, 'x1': 100, 'y1': 100,
+                                                               'confidence_min': 1})
+        self.assertEquals([label['id'] for label in response.json()['results']], [labels[1]['id']])
+
+    def test_backfill(self):
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        labels = self.client.get(url).json()['labels']
+        stored = Label.objects.get(id=labels[0]['id'])
+        self.assertEquals((stored.surface_json, stored.shape_json, stored.meta_json),
+                          (labels[0]['surface'], labels[0]['shape'], labels[0]['meta']))
+
+        # a process of the previous release writes only the JSON columns
+        meta = {**labels[0]['meta'], 'confirmed': True}
+        Label.objects.filter(id=stored.id).update(meta_json=meta, shape_json={'startX': 1, 'startY': 2, 'endX': 3,
+                                                                               'endY': 4})
+        with self.assertRaisesMessage(CommandError, '1 of 1 labels differ'):
+            call_command('backfill_labels', '--check', stdout=StringIO(), stderr=StringIO())
+
+        output = StringIO()
+        call_command('backfill_labels', stdout=output, stderr=StringIO())
+        self.assertEquals(output.getvalue(), 'Backfilled 1 of 1 labels\n')
+        call_command('backfill_labels', '--check', stdout=StringIO(), stderr=StringIO())
+
+        [label] = self.client.get(url).json()['labels']
+        self.assertEquals((label['meta'], label['shape']), (meta, {'startX': 1, 'startY': 2, 'endX': 3, 'endY': 4}))
+        self.assertEquals(Label.objects.get(id=stored.id).area, 4)
+
+
 class AnnotationRetrieveTestCase(CommonTestCase):
     def setUp(self) -> None:
         super().setUp()
@@ -228,3 +398,1404 @@ class AnnotationRetrieveTestCase(CommonTestCase):
             ]
         }
         self.assertDictEqual(response.json(), expected)
+
+    def test_retrieve_queries_count_is_constant(self):
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        for format_param in ('internal', 'export'):
+            with CaptureQueriesContext(connection) as small_context:
+                self.client.get(url, dict(format=format_param))
+
+            labels = AnnotationLabelsDiffTestCase.make_labels(300)
+            for label in labels[::2]:
+                label['meta']['confirmed'] = True
+            annotation = Annotation.objects.get(image__file=self.file_id)
+            Label.objects.bulk_create(Label(annotation=annotation, **label) for label in labels)
+            caches['annotations'].clear()
+
+            with CaptureQueriesContext(connection) as big_context:
+                response = self.client.get(url, dict(format=format_param))
+
+            self.assertEquals(len(small_context.captured_queries), len(big_context.captured_queries))
+            expected_count = 151 if format_param == 'export' else 302
+            self.assertEquals(len(response.json()['labels']), expected_count)
+            Label.objects.filter(id__in=[label['id'] for label in labels]).delete()
+
+
+class AnnotationCacheTestCase(AnnotationBaseTestCase):
+    def test_not_modified(self):
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        response = self.client.get(url, dict(format='internal'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        response = self.client.get(url, dict(format='internal'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(url, dict(format='export'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_weak_etag(self):
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=f'"other", W/{etag}')
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_browsable_api(self):
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        etag = self.client.get(url)['ETag']
+
+        response = self.client.get(url, HTTP_ACCEPT='text/html', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/html'))
+        self.assertNotEquals(response['ETag'], etag)
+
+        response = self.client.get(url, HTTP_ACCEPT='application/json; indent=2')
+        self.assertEquals(response.content.decode(), json.dumps(response.json(), indent=2))
+
+    def test_update_changes_etag(self):
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        etag = self.client.get(url).get('ETag')
+
+        # unchanged labels keep the version
+        response = self.client.put(url, json.dumps(self.valid_annotation), content_type='application/json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.put(url, json.dumps({'labels': []}), content_type='application/json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertNotEquals(response['ETag'], etag)
+        self.assertDictEqual(response.json(), {'labels': []})
+
+    def test_cache_counters(self):
+        url = reverse('annotation', kwargs={'image__file': self.file_id})
+        before = annotation_cache.stats()
+
+        self.client.get(url, dict(format='export'))
+        with self.assertNumQueries(1):
+            response = self.client.get(url, dict(format='export'))
+        self.assertEquals(response.json()['labels'][0]['surface'], '123')
+
+        stats = self.client.get(reverse('annotation-cache-stats')).json()
+        self.assertEquals(stats['hits'] - before['hits'], 1)
+        self.assertEquals(stats['misses'] - before['misses'], 1)
+
+
+class ImagePresignedRetrieveTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        caches['default'].clear()
+
+        response = self.upload_image(self.valid_image_path, include_annotation=False)
+        self.file_id = response.json()['id']
+
+    def test_redirect_and_url(self):
+        storage = Mock(bucket_name='media')
+        storage.client.presigned_get_object.return_value = 'http://minio/media/signed'
+
+        with patch('core.storage.default_storage', storage):
+            url = reverse('images-retrieve', kwargs={'file': self.file_id})
+            response = self.client.get(url, dict(delivery='redirect'))
+            self.assertEquals(response.status_code, status.HTTP_302_FOUND)
+            self.assertEquals(response['Location'], 'http://minio/media/signed')
+
+            response = self.client.get(url, dict(delivery='url'))
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+            self.assertEquals(response.json()['url'], 'http://minio/media/signed')
+
+        # the url is signed once and reused afterwards
+        storage.client.presigned_get_object.assert_called_once()
+
+    def test_fallback_to_proxy(self):
+        # file system storage can't sign urls
+        response = self.client.get(reverse('images-retrieve', kwargs={'file': self.file_id}), dict(delivery='redirect'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(int(response.get('Content-Length')), os.path.getsize(self.valid_image_path))
+
+    def test_unknown_delivery(self):
+        response = self.client.get(reverse('images-retrieve', kwargs={'file': self.file_id}), dict(delivery='ftp'))
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DirectUploadTestCase(CommonTestCase):
+    def reserve(self, filename):
+        storage = Mock(bucket_name='media')
+        storage.client.presigned_put_object.return_value = 'http://minio/media/upload'
+
+        with patch('core.storage.default_storage', storage):
+            return self.client.post(reverse('uploads-create'),
+                                    {'file': filename, 'annotation': self.valid_annotation}, format='json')
+
+    def put_to_storage(self, path, filename):
+        with open(path, 'rb') as fp:
+            self.addCleanup(default_storage.delete, default_storage.save(filename, File(fp)))
+
+    def finalize(self, filename):
+        return self.client.post(reverse('uploads-finalize', kwargs={'file': filename}))
+
+    def test_upload_valid(self):
+        response = self.reserve('direct.png')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(response.json()['upload_url'], 'http://minio/media/upload')
+
+        # the name is taken until the reservation expires
+        self.assertEquals(self.reserve('direct.png').status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.put_to_storage(self.valid_image_path, 'direct.png')
+        response = self.finalize('direct.png')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertDictEqual(response.json(), {'id': 'direct.png'})
+
+        annotation = Annotation.objects.get(image__file='direct.png')
+        self.assertEquals(annotation.labels.count(), 1)
+        self.assertFalse(UploadReservation.objects.exists())
+
+    def test_finalize_not_uploaded(self):
+        self.reserve('missing.png')
+        response = self.finalize('missing.png')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(UploadReservation.objects.filter(file='missing.png').exists())
+
+    def test_finalize_wrong_format(self):
+        self.reserve('direct.gif')
+        self.put_to_storage(self.invalid_image_path, 'direct.gif')
+
+        response = self.finalize('direct.gif')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        expected = {'file': [f"GIF format is not supported. Supported formats: {ImageSerializer.SUPPORTED_FORMATS}"]}
+        self.assertDictEqual(response.json(), expected)
+        self.assertFalse(default_storage.exists('direct.gif'))
+
+    def test_finalize_tiff_directory_at_the_end(self):
+        width, height = 1024, 512
+        pixels = os.urandom(width * height)
+        tags = [(256, 3, width), (257, 3, height), (258, 3, 8), (259, 3, 1), (262, 3, 1), (273, 4, 8),
+                (278, 3, height), (279, 4, len(pixels))]
+        directory = struct.pack('<H', len(tags)) + b''.join(
+            struct.pack('<HHII', tag, field_type, 1, value) for tag, field_type, value in tags) + struct.pack('<I', 0)
+        self.reserve('direct.tif')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'direct.tif')
+            with open(path, 'wb') as file:
+                file.write(b'II*\x00' + struct.pack('<I', 8 + len(pixels)) + pixels + directory)
+            self.put_to_storage(path, 'direct.tif')
+        with patch('core.storage.read_range', wraps=read_range) as storage_read:
+            response = self.finalize('direct.tif')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(Image.objects.values_list('format', 'width', 'height').get(), ('TIFF', width, height))
+
+        # the header and the directory are read, pixels in between aren't
+        self.assertLess(sum(call.args[2] for call in storage_read.call_args_list), len(pixels) // 2)
+
+    def test_finalize_twice(self):
+        self.reserve('direct.png')
+        self.put_to_storage(self.valid_image_path, 'direct.png')
+
+        # another request finalizes the upload while this one is validated
+        serializer = UploadFinalizeSerializer(data={}, context={'reservation': UploadReservation.objects.get()})
+        serializer.is_valid(raise_exception=True)
+        self.assertEquals(self.finalize('direct.png').status_code, status.HTTP_201_CREATED)
+
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        self.assertEquals(Image.objects.count(), 1)
+
+    def test_finalize_expired(self):
+        self.reserve('direct.png')
+        self.put_to_storage(self.valid_image_path, 'direct.png')
+        UploadReservation.objects.update(expires_at=timezone.now())
+
+        response = self.finalize('direct.png')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertDictEqual(response.json(), {'file': ['Upload reservation has expired']})
+        self.assertFalse(Image.objects.exists())
+
+    def test_finalize_expired_while_validated(self):
+        self.reserve('direct.png')
+        self.put_to_storage(self.valid_image_path, 'direct.png')
+        serializer = UploadFinalizeSerializer(data={}, context={'reservation': UploadReservation.objects.get()})
+        serializer.is_valid(raise_exception=True)
+
+        UploadReservation.objects.update(expires_at=timezone.now())
+        with self.assertRaises(ValidationError):
+            serializer.save()
+        self.assertFalse(Image.objects.exists())
+
+    def test_storage_without_presigning(self):
+        response = self.client.post(reverse('uploads-create'), {'file': 'direct.png'}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+
+
+class ImageRangeRetrieveTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        response = self.upload_image(self.valid_image_path, include_annotation=False)
+        self.url = reverse('images-retrieve', kwargs={'file': response.json()['id']})
+        self.content = self.valid_image_path.read_bytes()
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEquals(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEquals(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEquals(b''.join(response.streaming_content), self.content[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEquals(b''.join(response.streaming_content), self.content[-5:])
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-3, 20-')
+        self.assertEquals(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+
+        body = b''.join(response.streaming_content)
+        self.assertEquals(int(response['Content-Length']), len(body))
+        self.assertIn(self.content[:4], body)
+        self.assertIn(self.content[20:], body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEquals(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEquals(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_if_range(self):
+        response = self.client.get(self.url)
+        self.assertEquals(response['Accept-Ranges'], 'bytes')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        for if_range in (etag, last_modified):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=if_range)
+            self.assertEquals(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(b''.join(response.streaming_content), self.content)
+
+
+@override_settings(PROCESSING_CPU_WORKERS=0)
+class ProcessingTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        response = self.upload_image(self.valid_image_path, include_annotation=False)
+        self.file_id = response.json()['id']
+        self.url = reverse('images-processing', kwargs={'file': self.file_id})
+
+        storage_name = Image.objects.get(file=self.file_id).storage_name
+        self.rendition_keys = [RenditionService.make_key(storage_name, *rendition)
+                               for rendition in settings.PROCESSING_RENDITIONS]
+        for key in self.rendition_keys:
+            self.addCleanup(default_storage.delete, key)
+
+    def process_jobs(self):
+        call_command('process_jobs', '--once', '--workers=1', stdout=StringIO())
+
+    def test_processing(self):
+        response = self.client.get(self.url)
+        self.assertEquals(response.json()['status'], 'pending')
+        self.assertEquals([job['stage'] for job in response.json()['jobs']], list(settings.PROCESSING_STAGES))
+
+        Image.objects.update(sha256='')
+        self.process_jobs()
+
+        self.assertDictEqual(self.client.get(self.url).json(), {'id': self.file_id, 'status': 'done', 'jobs': []})
+        self.assertEquals(Image.objects.get().sha256, hashlib.sha256(self.valid_image_path.read_bytes()).hexdigest())
+        for key in self.rendition_keys:
+            with default_storage.open(key) as file:
+                self.assertLessEqual(max(PILImage.open(file).size), 256)
+
+    def test_retries(self):
+        with patch('core.stages.prerender_renditions', side_effect=OSError('Storage is down')):
+            for attempt in range(settings.PROCESSING_MAX_ATTEMPTS):
+                with self.assertLogs('core.pipeline', 'ERROR'):
+                    self.process_jobs()
+                Job.objects.update(run_after=timezone.now())  # retries are due right away
+
+                job = self.client.get(self.url).json()['jobs'][-1]
+                self.assertEquals((job['attempts'], job['error']), (attempt + 1, 'OSError: Storage is down'))
+
+        response = self.client.get(self.url).json()
+        self.assertEquals(response['status'], 'failed')
+        self.assertEquals([job['status'] for job in response['jobs']], ['done', 'failed'])
+
+    def test_unknown_stage(self):
+        Job.objects.filter(stage='renditions').update(stage='removed')
+        with self.assertLogs('core.pipeline', 'ERROR'):
+            self.process_jobs()
+
+        response = self.client.get(self.url).json()
+        self.assertEquals(response['status'], 'failed')
+        self.assertEquals([(job['status'], job['attempts'], job['error']) for job in response['jobs']],
+                          [('done', 1, ''), ('failed', 1, 'Unknown stage: removed')])
+
+    def test_timed_out_jobs(self):
+        started_at = timezone.now() - settings.PROCESSING_JOB_TIMEOUT * 2
+        Job.objects.filter(stage='metadata').update(status=Job.RUNNING, attempts=1, updated_at=started_at)
+        Job.objects.filter(stage='renditions').update(status=Job.RUNNING, attempts=settings.PROCESSING_MAX_ATTEMPTS,
+                                                      updated_at=started_at)
+        self.process_jobs()
+
+        jobs = self.client.get(self.url).json()['jobs']
+        self.assertEquals([(job['status'], job['attempts'], job['error']) for job in jobs],
+                          [('done', 2, ''), ('failed', settings.PROCESSING_MAX_ATTEMPTS, 'Timed out')])
+
+    def test_worker_survives_database_errors(self):
+        worker = Worker(poll_interval=0.01)
+
+        def run_jobs():
+            if run_jobs_mock.call_count == 1:
+                raise DatabaseError('connection dropped')
+            worker.stop()
+            return pipeline_run_jobs()
+
+        with patch('core.pipeline.run_jobs', side_effect=run_jobs) as run_jobs_mock, \
+                self.assertLogs('core.pipeline', 'ERROR'):
+            self.assertEquals(worker.run(), 2)
+        self.assertEquals(run_jobs_mock.call_count, 2)
+
+    def test_image_deleted_while_processing(self):
+        jobs = claim_jobs(10)
+        Image.objects.all().delete()
+        for job in jobs:
+            run_job(job)
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(PROCESSING_CPU_WORKERS=1)
+    def test_cpu_pool(self):
+        def shutdown_pool():
+            pipeline._cpu_pool.shutdown()
+            pipeline._cpu_pool = None
+
+        self.addCleanup(shutdown_pool)
+        content = render_content(self.valid_image_path.read_bytes(), 64, 64, 'png')
+        self.assertEquals(run_cpu(render_content, self.valid_image_path.read_bytes(), 64, 64, 'png'), content)
+
+
+class MediaCacheTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        response = self.upload_image(self.valid_image_path, include_annotation=False)
+        self.url = reverse('images-retrieve', kwargs={'file': response.json()['id']})
+        self.content = self.valid_image_path.read_bytes()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = DiskCache(directory.name, 2 * len(self.content))
+        patcher = patch('core.views.media_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def download(self, **headers):
+        response = self.client.get(self.url, {'delivery': 'proxy'}, **headers)
+        content = b''.join(response.streaming_content)
+        response.close()
+        return content
+
+    def test_read_through(self):
+        self.assertEquals(self.download(), self.content)
+        with patch.object(default_storage, 'open') as storage_open:
+            self.assertEquals(self.download(), self.content)
+            self.assertEquals(self.download(HTTP_RANGE='bytes=10-19'), self.content[10:20])
+        storage_open.assert_not_called()
+
+        stats = self.client.get(reverse('media-cache-stats')).json()
+        self.assertEquals((stats['hits'], stats['misses'], stats['entries']), (2, 1, 1))
+        self.assertEquals(stats['saved_bytes'], len(self.content) + 10)
+
+    def test_interrupted_fill(self):
+        response = self.client.get(self.url, {'delivery': 'proxy'})
+        next(iter(response.streaming_content))
+        response.close()
+
+        self.assertEquals(self.cache.stats()['entries'], 0)
+        self.assertEquals(os.listdir(os.path.join(self.cache.directory, 'tmp')), [])
+
+    def test_eviction(self):
+        content = b'x' * len(self.content)
+        for key in ('first', 'second', 'third'):
+            b''.join(self.cache.fill(key, len(content), (chunk for chunk in [content])))
+
+        self.assertIsNone(self.cache.open('first'))
+        for key in ('second', 'third'):
+            with self.cache.open(key) as file:
+                self.assertEquals(file.read(), content)
+        self.assertEquals(self.cache.stats()['size'], 2 * len(self.content))
+
+    def test_entry_removed_by_another_process(self):
+        b''.join(self.cache.fill('first', 10, (chunk for chunk in [b'x' * 10])))
+        os.remove(self.cache.make_path('first'))
+
+        self.assertIsNone(self.cache.open('first'))
+        stats = self.cache.stats()
+        self.assertEquals((stats['entries'], stats['size']), (0, 0))
+
+    def test_async_fill(self):
+        async def chunks():
+            yield self.content[:10]
+            yield self.content[10:]
+
+        async def fill():
+            return b''.join([chunk async for chunk in self.cache.afill('first', len(self.content), chunks())])
+
+        threads = []
+        add = self.cache.add
+
+        def record_add(*args):
+            threads.append(threading.get_ident())
+            add(*args)
+
+        with patch.object(self.cache, 'add', side_effect=record_add):
+            self.assertEquals(asyncio.run(fill()), self.content)
+
+        # the entry is added outside of the event loop thread
+        self.assertNotIn(threading.get_ident(), threads)
+        with self.cache.open('first') as file:
+            self.assertEquals(file.read(), self.content)
+
+
+class ImageRenditionTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        response = self.upload_image(self.valid_image_path, include_annotation=False)
+        self.file_id = response.json()['id']
+        self.url = reverse('images-rendition', kwargs={'file': self.file_id})
+        self.storage_name = Image.objects.get(file=self.file_id).storage_name
+        self.service = RenditionService(1024 * 1024)
+
+        for width in (64, 128):
+            key = RenditionService.make_key(self.storage_name, width, width, 'jpeg')
+            self.addCleanup(default_storage.delete, key)
+
+    def test_rendition_valid(self):
+        with patch('core.views.rendition_service', self.service):
+            response = self.client.get(self.url, dict(w=64, fmt='jpeg'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response['Content-Type'], 'image/jpeg')
+
+        rendition = PILImage.open(BytesIO(response.content))
+        self.assertEquals(rendition.format, 'JPEG')
+        self.assertEquals(rendition.size, (64, 64))
+        self.assertTrue(default_storage.exists(RenditionService.make_key(self.storage_name, 64, 64, 'jpeg')))
+
+        # served from memory without touching the storage
+        with patch('core.renditions.default_storage') as storage, patch('core.views.rendition_service', self.service):
+            response = self.client.get(self.url, dict(w=64, h=64))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        storage.open.assert_not_called()
+
+    def test_rendition_size_not_allowed(self):
+        response = self.client.get(self.url, dict(w=100))
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_requests_render_once(self):
+        render = self.service.render
+
+        def slow_render(*args):
+            time.sleep(0.1)
+            return render(*args)
+
+        with patch.object(self.service, 'render', side_effect=slow_render) as mock_render:
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                results = list(executor.map(lambda _: self.service.get(self.storage_name, 128, 128, 'jpeg'), range(4)))
+
+        mock_render.assert_called_once()
+        self.assertEquals(len(set(results)), 1)
+
+
+class ImageBatchCreationTestCase(CommonTestCase):
+    def upload_batch(self, paths, annotations):
+        files = [open(path, 'rb') for path in paths]
+        try:
+            data = {'files': files, 'data': json.dumps({'annotations': annotations})}
+            response = self.client.post(reverse('images-batch'), data, format='multipart')
+        finally:
+            for fp in files:
+                fp.close()
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return response.json()['results']
+
+    def test_batch_valid(self):
+        results = self.upload_batch([self.valid_image_path, self.invalid_image_path],
+                                    {'sample.png': self.valid_annotation})
+
+        self.assertEquals([result['status'] for result in results], [201, 400])
+        self.assertIn('file', results[1]['errors'])
+
+        annotation = Annotation.objects.get(image__file=results[0]['id'])
+        self.assertEquals(str(annotation.labels.get().id), self.valid_annotation['labels'][0]['id'])
+        self.assertEquals(Image.objects.count(), 1)
+
+    def test_batch_duplicate_names_and_labels(self):
+        response = self.upload_image(self.valid_image_path)
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+
+        with open(self.valid_image_path, 'rb') as fp:
+            renamed = SimpleUploadedFile('renamed.png', fp.read())
+        files = {'files': [renamed], 'data': json.dumps({'annotations': {'renamed.png': self.valid_annotation}})}
+        response = self.client.post(reverse('images-batch'), files, format='multipart')
+
+        result = response.json()['results'][0]
+        self.assertEquals(result['status'], status.HTTP_400_BAD_REQUEST)
+        self.assertIn('labels', result['errors']['annotation'])
+        self.assertFalse(Image.objects.filter(file='renamed.png').exists())
+
+    def test_batch_annotations_not_object(self):
+        with open(self.valid_image_path, 'rb') as fp:
+            data = {'files': [fp], 'data': json.dumps({'annotations': [self.valid_annotation]})}
+            response = self.client.post(reverse('images-batch'), data, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('annotations', response.json())
+        self.assertEquals(Image.objects.count(), 0)
+
+
+class AnnotationExportTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        for idx, class_id in enumerate(['tooth', 'caries', 'tooth']):
+            annotation = Annotation.objects.create(image=Image.objects.create(file=f'export{idx}.png'))
+            label = deepcopy(self.valid_annotation['labels'][0])
+            label.update(id=f'00000000-0000-0000-0000-{idx:012d}', class_id=class_id)
+            label['meta']['confirmed'] = idx != 0
+            Label.objects.create(annotation=annotation, **label)
+
+    def export(self, **params):
+        response = self.client.get(reverse('annotations-export'), params)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_export_internal(self):
+        lines = self.export(format='internal')
+        self.assertEquals([line['id'] for line in lines], ['export0.png', 'export1.png', 'export2.png'])
+        self.assertEquals(lines[0]['labels'][0]['shape'], self.valid_annotation['labels'][0]['shape'])
+
+        # resuming from a cursor
+        resumed = self.export(format='internal', after=lines[0]['cursor'])
+        self.assertEquals(resumed, lines[1:])
+
+    def test_export_filters(self):
+        lines = self.export(format='export')
+        self.assertEquals([len(line['labels']) for line in lines], [0, 1, 1])
+        self.assertEquals(lines[1]['labels'][0]['surface'], '123')
+
+        lines = self.export(format='export', class_id='tooth')
+        self.assertEquals([line['id'] for line in lines], ['export0.png', 'export2.png'])
+
+        lines = self.export(created_before='2000-01-01T00:00:00Z')
+        self.assertEquals(lines, [])
+
+    def test_export_command(self):
+        output = StringIO()
+        call_command('export_annotations', '--format=export', '--class-id=caries', stdout=output)
+
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEquals([line['id'] for line in lines], ['export1.png'])
+
+
+class AnnotationBatchTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.files = []
+        for idx in range(3):
+            annotation = Annotation.objects.create(image=Image.objects.create(file=f'batch{idx}.png'))
+            for number in range(idx):
+                label = deepcopy(self.valid_annotation['labels'][0])
+                label.update(id=f'00000000-0000-0000-{idx:04d}-{number:012d}')
+                label['meta']['confirmed'] = number == 0
+                Label.objects.create(annotation=annotation, **label)
+            self.files.append(f'batch{idx}.png')
+
+    def test_batch(self):
+        for format_key in ['internal', 'export']:
+            with self.assertNumQueries(2):
+                response = self.client.post(reverse('annotations-batch'),
+                                            {'files': [*self.files, 'missing.png'], 'format': format_key},
+                                            format='json')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+            results = response.json()['results']
+            self.assertEquals(list(results), [*self.files, 'missing.png'])
+            for file in self.files:
+                url = reverse('annotation', kwargs={'image__file': file})
+                expected = self.client.get(url, {'format': format_key}).json()
+                self.assertEquals(sorted(results[file]['labels'], key=lambda label: label['id']),
+                                  sorted(expected['labels'], key=lambda label: label['id']))
+            self.assertEquals(results['missing.png'], {'detail': 'Not found.'})
+
+        response = self.client.post(reverse('annotations-batch'), {'files': []}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DatasetExportTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        for idx, class_id in enumerate(['tooth', 'caries']):
+            label = deepcopy(self.valid_annotation['labels'][0])
+            label.update(id=f'00000000-0000-0000-0000-{idx:012d}', class_id=class_id)
+            label['meta']['confirmed'] = idx != 0
+            data = {'file': SimpleUploadedFile(f'scan{idx}.png', self.valid_image_path.read_bytes()),
+                    'data': json.dumps({'annotation': {'labels': [label]}})}
+            self.client.post(reverse('images-create'), data, format='multipart')
+
+    def export(self, **params):
+        response = self.client.get(reverse('datasets-export'), params)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return BytesIO(b''.join(response.streaming_content))
+
+    def test_coco_zip(self):
+        with zipfile.ZipFile(self.export(layout='coco', archive='zip')) as archive:
+            self.assertEquals(archive.namelist(), ['images/scan0.png', 'images/scan1.png', 'annotations.json'])
+            self.assertEquals(archive.read('images/scan1.png'), self.valid_image_path.read_bytes())
+            coco = json.loads(archive.read('annotations.json'))
+
+        # only confirmed labels like in format=export
+        self.assertEquals(coco['categories'], [{'id': 1, 'name': 'caries'}])
+        self.assertEquals(coco['images'][0], {'id': 1, 'file_name': 'images/scan0.png', 'width': 600, 'height': 600})
+        [annotation] = coco['annotations']
+        self.assertEquals((annotation['image_id'], annotation['category_id']), (2, 1))
+        self.assertEquals(annotation['bbox'], [44, 605, 67, 794])
+
+        with zipfile.ZipFile(self.export(layout='coco', format='internal')) as archive:
+            coco = json.loads(archive.read('annotations.json'))
+        self.assertEquals([category['name'] for category in coco['categories']], ['caries', 'tooth'])
+
+    def test_labels_of_any_meta(self):
+        label = {**self.valid_annotation['labels'][0], 'id': '00000000-0000-0000-0000-000000000009', 'meta': ['note']}
+        Label.objects.create(annotation=Annotation.objects.get(image__file='scan1.png'), **label)
+
+        with zipfile.ZipFile(self.export(layout='coco')) as archive:
+            coco = json.loads(archive.read('annotations.json'))
+        self.assertEquals([annotation['attributes']['label_id'] for annotation in coco['annotations']],
+                          ['00000000-0000-0000-0000-000000000001'])
+
+    def test_yolo_tar(self):
+        with tarfile.open(fileobj=self.export(layout='yolo', archive='tar')) as archive:
+            self.assertEquals(archive.getnames(), ['images/scan0.png', 'labels/scan0.txt', 'images/scan1.png',
+                                                   'labels/scan1.txt', 'classes.txt'])
+            self.assertEquals(archive.extractfile('labels/scan0.txt').read(), b'')
+            self.assertEquals(archive.extractfile('labels/scan1.txt').read(),
+                              b'0 0.129167 1.670000 0.111667 1.323333\n')
+            self.assertEquals(archive.extractfile('classes.txt').read(), b'caries\n')
+
+    def test_yolo_names_of_the_same_stem(self):
+        data = {'file': SimpleUploadedFile('scan1.jpg', self.valid_image_path.read_bytes()),
+                'data': json.dumps({'annotation': {'labels': []}})}
+        self.client.post(reverse('images-create'), data, format='multipart')
+
+        with tarfile.open(fileobj=self.export(layout='yolo', archive='tar', format='internal')) as archive:
+            self.assertEquals(archive.getnames(), ['images/scan0.png', 'labels/scan0.txt', 'images/scan1.png',
+                                                   'labels/scan1.txt', 'images/scan1_1.jpg', 'labels/scan1_1.txt',
+                                                   'classes.txt'])
+            self.assertNotEquals(archive.extractfile('labels/scan1.txt').read(), b'')
+
+    def test_class_added_during_export(self):
+        def iter_annotations(**kwargs):
+            for idx, annotation in enumerate(export_iter_annotations(**kwargs)):
+                if idx == 1:  # the next chunk isn't read yet
+                    label = {**self.valid_annotation['labels'][0], 'class_id': 'plaque'}
+                    data = {'file': SimpleUploadedFile('scan2.png', self.valid_image_path.read_bytes()),
+                            'data': json.dumps({'annotation': {'labels': [label]}})}
+                    self.client.post(reverse('images-create'), data, format='multipart')
+                yield annotation
+
+        for layout, archive_format in [('yolo', 'tar'), ('coco', 'zip')]:
+            Image.objects.filter(file='scan2.png').delete()
+            with patch('core.datasets.iter_annotations', iter_annotations):
+                content = BytesIO(b''.join(iter_dataset(layout, archive_format, chunk_size=1, workers=1)))
+
+            if layout == 'yolo':
+                with tarfile.open(fileobj=content) as archive:
+                    self.assertEquals(archive.extractfile('classes.txt').read(), b'caries\nplaque\n')
+                    self.assertTrue(archive.extractfile('labels/scan2.txt').read().startswith(b'1 '))
+            else:
+                with zipfile.ZipFile(content) as archive:
+                    coco = json.loads(archive.read('annotations.json'))
+                self.assertEquals(coco['categories'], [{'id': 1, 'name': 'caries'}, {'id': 2, 'name': 'plaque'}])
+                self.assertEquals([annotation['category_id'] for annotation in coco['annotations']], [1, 2])
+                self.assertEquals(len(coco['images']), 3)
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dataset.zip')
+            call_command('export_dataset', '--layout=yolo', '--class-id=caries', f'--output={path}')
+            with zipfile.ZipFile(path) as archive:
+                self.assertEquals(archive.namelist(), ['images/scan1.png', 'labels/scan1.txt', 'classes.txt'])
+
+
+class ImportImagesTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.source = os.path.join(self.directory, 'clinic')
+        os.makedirs(os.path.join(self.source, 'scans'))
+
+        for idx in range(4):  # content that isn't stored yet
+            PILImage.frombytes('L', (20 + idx, 10), os.urandom((20 + idx) * 10)).save(
+                os.path.join(self.source, 'scans' * (idx % 2), f'scan{idx}.png'))
+        with open(os.path.join(self.source, 'scan0.json'), 'w') as file:
+            json.dump(self.valid_annotation, file)
+        with open(os.path.join(self.source, 'broken.png'), 'wb') as file:
+            file.write(b'not an image')
+        with open(os.path.join(self.source, 'scan2.json'), 'w') as file:
+            file.write('{"labels": [')
+
+    def run_import(self, source, *args):
+        output = StringIO()
+        call_command('import_images', source, f'--checkpoint={self.directory}/checkpoint.json', '--batch-size=2',
+                     *args, stdout=output, stderr=StringIO())
+        return output.getvalue()
+
+    def test_import_directory(self):
+        output = self.run_import(self.source, '--processes=2')
+        self.assertEquals(output, 'Imported 3, skipped 0 imported before, failed 2 files\n')
+
+        self.assertSetEqual(set(Image.objects.values_list('file', flat=True)),
+                            {'scan0.png', 'scans_scan1.png', 'scans_scan3.png'})
+        image = Image.objects.get(file='scans_scan1.png')
+        self.assertEquals((image.format, image.width, image.height, image.size), ('PNG', 21, 10, image.blob.size))
+        response = self.client.get(reverse('annotation', kwargs={'image__file': 'scan0.png'}))
+        self.assertEquals(response.json(), self.valid_annotation)
+        response = self.client.get(reverse('images-retrieve', kwargs={'file': 'scans_scan3.png'}),
+                                   {'delivery': 'proxy'})
+        self.assertEquals(b''.join(response.streaming_content),
+                          Path(self.source, 'scans', 'scan3.png').read_bytes())
+
+        # the checkpoint covers the whole source
+        self.assertEquals(self.run_import(self.source), 'Nothing to import\n')
+
+    def test_nested_names(self):
+        os.makedirs(os.path.join(self.source, 'patient1'))
+        os.makedirs(os.path.join(self.source, 'patient2'))
+        for patient in ['patient1', 'patient2']:
+            PILImage.frombytes('L', (8, 8), os.urandom(64)).save(os.path.join(self.source, patient, 'scan.png'))
+        self.run_import(self.source, '--processes=0')
+        self.assertEquals(Image.objects.filter(file__in=['patient1_scan.png', 'patient2_scan.png']).count(), 2)
+
+        # names that would collide are refused before anything is imported
+        PILImage.new('L', (8, 8)).save(os.path.join(self.source, 'patient1_scan.png'))
+        os.remove(os.path.join(self.directory, 'checkpoint.json'))
+        with self.assertRaisesMessage(CommandError, 'would be stored under the same name'):
+            self.run_import(self.source, '--processes=0')
+
+    def test_resume(self):
+        def create_rows(items, max_workers=None):
+            if any(item.filename == 'scans_scan1.png' for item in items):
+                raise RuntimeError('crash')
+            return ingest_create_rows(items, max_workers)
+
+        with patch('core.imports.create_rows', create_rows), self.assertRaises(RuntimeError):
+            self.run_import(self.source, '--processes=0')
+        with open(os.path.join(self.directory, 'checkpoint.json')) as file:
+            self.assertEquals(json.load(file)['position'], 2)
+
+        # the crashed batch is imported again, content written before the crash isn't
+        with patch.object(default_storage, 'save', wraps=default_storage.save) as storage_save:
+            output = self.run_import(self.source, '--processes=0')
+        self.assertEquals(output, 'Imported 3, skipped 0 imported before, failed 2 files\n')
+        self.assertEquals(storage_save.call_count, 1)
+        self.assertEquals(Image.objects.count(), 3)
+
+    def test_import_tarball(self):
+        path = os.path.join(self.directory, 'clinic.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            archive.add(self.source, arcname='clinic')
+        self.run_import(path, '--processes=0')
+
+        self.assertEquals(Image.objects.count(), 3)
+        self.assertEquals(Label.objects.get().annotation.image.file.name, 'clinic_scan0.png')
+
+        # files imported before are skipped when the checkpoint is lost
+        os.remove(os.path.join(self.directory, 'checkpoint.json'))
+        output = self.run_import(path, '--processes=0')
+        self.assertEquals(output, 'Imported 0, skipped 3 imported before, failed 2 files\n')
+
+    def test_tarball_order(self):
+        path = os.path.join(self.directory, 'ordered.tar.gz')
+        with tarfile.open(path, 'w:gz') as archive:
+            for name, content in [('a.png', b'a'), ('a.json', b'{}'), ('b.json', b'[]'), ('b.png', b'b'),
+                                  ('c.png', b'c')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, BytesIO(content))
+
+        source = TarSource(path)
+        self.addCleanup(source.close)
+        # images are held until their sidecar is read, resumed reads skip the imported ones
+        entries = [(name, Path(entry_path).read_bytes(), sidecar)
+                   for name, entry_path, sidecar in source.iter_entries(0)]
+        self.assertEquals(entries, [('a.png', b'a', b'{}'), ('b.png', b'b', b'[]'), ('c.png', b'c', None)])
+        self.assertEquals([name for name, _, _ in source.iter_entries(2)], ['c.png'])
+
+
+class AnnotationPatchTestCase(AnnotationBaseTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.url = reverse('annotation', kwargs={'image__file': self.file_id})
+        self.label_id = self.valid_annotation['labels'][0]['id']
+
+    def patch_labels(self, operations):
+        return self.client.patch(self.url, json.dumps(operations), content_type='application/json')
+
+    def test_patch_valid(self):
+        new_label = AnnotationLabelsDiffTestCase.make_labels(1)[0]
+        operations = {
+            'add': [new_label],
+            'update': [{'id': self.label_id, 'meta': {'confirmed': False, 'confidence_percent': None}}],
+        }
+        response = self.patch_labels(operations)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        labels = {label['id']: label for label in response.json()['labels']}
+        self.assertDictEqual(labels[self.label_id]['meta'], {'confirmed': False})
+        self.assertEquals(labels[self.label_id]['class_id'], 'tooth')
+        self.assertIn(new_label['id'], labels)
+
+        label = Label.objects.get(id=self.label_id)
+        self.assertEquals((label.confirmed, label.confidence), (False, None))
+
+        response = self.patch_labels({'remove': [new_label['id']]})
+        self.assertEquals([label['id'] for label in response.json()['labels']], [self.label_id])
+
+    def test_patch_single_update(self):
+        labels = AnnotationLabelsDiffTestCase.make_labels(50)
+        self.patch_labels({'add': labels})
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.patch_labels({'update': [{'id': labels[10]['id'], 'meta': {'confirmed': True}}]})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+        label_updates = [query for query in context.captured_queries
+                         if query['sql'].startswith('UPDATE') and 'core_label' in query['sql']]
+        self.assertEquals(len(label_updates), 1)
+        self.assertTrue(Label.objects.get(id=labels[10]['id']).meta['confirmed'])
+
+    def test_patch_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        self.patch_labels({'update': [{'id': self.label_id, 'class_id': 'caries'}]})
+        self.assertEquals(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_patch_invalid(self):
+        unknown_id = '00000000-0000-0000-0000-000000000000'
+        response = self.patch_labels({'remove': [unknown_id]})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.patch_labels({'add': self.valid_annotation['labels']})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.patch_labels({'update': [{'id': self.label_id}], 'remove': [self.label_id]})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ContentDeduplicationTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.sha256 = hashlib.sha256(self.valid_image_path.read_bytes()).hexdigest()
+
+    def upload_copy(self, filename):
+        data = {'file': SimpleUploadedFile(filename, self.valid_image_path.read_bytes()), 'data': ''}
+        response = self.client.post(reverse('images-create'), data, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        return Image.objects.get(file=response.json()['id'])
+
+    def test_same_content_is_stored_once(self):
+        key = Blob.make_key(self.sha256)
+        default_storage.delete(key)
+        with patch.object(default_storage, 'save', wraps=default_storage.save) as mock_save, \
+                patch.object(default_storage, 'exists', wraps=default_storage.exists) as mock_exists:
+            first, second = self.upload_copy('first.png'), self.upload_copy('second.png')
+
+        self.assertEquals(first.blob_id, second.blob_id)
+        self.assertEquals(Blob.objects.get().ref_count, 2)
+        self.assertEquals(first.blob.sha256, self.sha256)
+        mock_save.assert_called_once()
+        self.assertEquals(mock_save.call_args[0][0], key)
+        # content written before the transaction isn't checked again while its blob is locked
+        self.assertEquals([call for call in mock_exists.call_args_list if call[0][0] == key], [call(key)])
+
+        response = self.client.get(reverse('images-retrieve', kwargs={'file': 'second.png'}))
+        self.assertEquals(b''.join(response.streaming_content), self.valid_image_path.read_bytes())
+
+    def test_create_from_hash(self):
+        url = reverse('blobs-retrieve', kwargs={'sha256': self.sha256})
+        self.assertEquals(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+        self.upload_copy('first.png')
+        expected = {'sha256': self.sha256, 'size': os.path.getsize(self.valid_image_path)}
+        self.assertDictEqual(self.client.get(url).json(), expected)
+
+        response = self.client.post(reverse('blobs-images', kwargs={'sha256': self.sha256}),
+                                    {'file': 'copy.png', 'annotation': self.valid_annotation}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(Annotation.objects.get(image__file='copy.png').labels.count(), 1)
+        self.assertEquals(Blob.objects.get().ref_count, 2)
+
+        response = self.client.post(reverse('blobs-images', kwargs={'sha256': '0' * 64}), {'file': 'x.png'},
+                                    format='json')
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_content_is_deleted_with_last_reference(self):
+        first, second = self.upload_copy('first.png'), self.upload_copy('second.png')
+        key = first.blob.key
+
+        first.delete()
+        self.assertEquals(collect_blobs(), 0)
+        self.assertTrue(default_storage.exists(key))
+
+        second.delete()
+        self.assertEquals(collect_blobs(), 1)
+        self.assertFalse(default_storage.exists(key))
+        self.assertFalse(Blob.objects.exists())
+
+    def test_renditions_and_cached_copy_are_collected(self):
+        image = self.upload_copy('first.png')
+        rendition_key = RenditionService.make_key(image.blob.key, 64, 64, 'webp')
+        default_storage.save(rendition_key, ContentFile(b'rendition'))
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = DiskCache(directory.name, 1024)
+        b''.join(cache.fill(self.sha256, 6, (chunk for chunk in [b'cached'])))
+
+        image.delete()
+        with patch('core.blobs.media_cache', cache):
+            self.assertEquals(collect_blobs(), 1)
+        self.assertFalse(default_storage.exists(rendition_key))
+        self.assertIsNone(cache.open(self.sha256))
+        self.assertEquals(cache.size, 0)
+
+    def test_content_of_failed_upload_is_collected(self):
+        Label.objects.create(annotation=Annotation.objects.create(image=Image.objects.create(file='other.png')),
+                             **self.valid_annotation['labels'][0])
+        data = {'file': SimpleUploadedFile('first.png', self.valid_image_path.read_bytes()),
+                'data': json.dumps({'annotation': self.valid_annotation})}  # the label id is taken
+        response = self.client.post(reverse('images-create'), data, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        key = Blob.make_key(self.sha256)
+        self.assertEquals(Blob.objects.get(sha256=self.sha256).ref_count, 0)
+        self.assertTrue(default_storage.exists(key))
+        self.assertEquals(collect_blobs(), 1)
+        self.assertFalse(default_storage.exists(key))
+
+
+class BenchmarkTestCase(CommonTestCase):
+    def test_run_benchmark(self):
+        results = run_benchmark(images=2, sizes=[(64, 32)], formats=['png', 'tiff'], labels=3)
+
+        self.assertSetEqual(set(results), {
+            'upload.png.64x32', 'upload.tiff.64x32', 'download.png.64x32', 'download.tiff.64x32',
+            'annotation_get.internal', 'annotation_get.export', 'annotation_get_cached.internal',
+            'annotation_get_cached.export', 'annotation_put',
+        })
+        self.assertEquals(results['upload.png.64x32']['requests'], 2)
+        self.assertEquals(results['annotation_get.internal']['requests'], 4)
+        self.assertEquals(results['annotation_get_cached.internal']['queries']['max'], 1)
+        self.assertEquals(Image.objects.count(), 4)
+        json.dumps(results)
+
+        results = run_json_benchmark(annotations=2, labels=3, rounds=2)
+        self.assertSetEqual(set(results), {'bytes', 'render', 'parse'})
+        self.assertSetEqual(set(results['render']), {'stdlib', 'fast', 'speedup'})
+
+    def test_parse_sizes(self):
+        self.assertEquals(BenchmarkCommand.parse_sizes('512x256, 64X64'), [(512, 256), (64, 64)])
+        for value in ('512', '512x256x3', '0x64', '64x-1', 'x', ''):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                BenchmarkCommand.parse_sizes(value)
+
+
+class JSONCodecTestCase(CommonTestCase):
+    def test_renderer_matches_drf(self):
+        data = {
+            'created_at': timezone.now(),
+            'id': uuid.uuid4(),
+            'value': Decimal('1.5'),
+            'message': gettext_lazy('This field is required.'),
+            'line': 'a\u2028b\u2029c',
+            1: [None, True, 0.25, 'зуб'],
+        }
+        expected = renderers.JSONRenderer().render(data)
+        self.assertEquals(JSONRenderer().render(data), expected)
+        self.assertEquals(JSONRenderer().render({'big': 2 ** 70}), b'{"big":1180591620717411303424}')
+        with patch('core.utils.orjson', None):
+            self.assertEquals(JSONRenderer().render(data), expected)
+
+    def test_parser(self):
+        self.assertEquals(JSONParser().parse(BytesIO(b'{"a": [1, 2.5, "b"]}')), {'a': [1, 2.5, 'b']})
+        with self.assertRaises(ParseError):
+            JSONParser().parse(BytesIO(b'{"a": NaN}'))
+
+        self.upload_image(self.valid_image_path)
+        url = reverse('annotation', kwargs={'image__file': 'sample.png'})
+        response = self.client.put(url, '{"labels": [', content_type='application/json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_multipart_data_is_passed_as_is(self):
+        labels = [{'id': '00000000-0000-0000-0000-000000000001', 'class_id': 'tooth', 'surface': ['B'],
+                   'shape': {'startX': 1, 'startY': 2, 'endX': 3, 'endY': 4}, 'meta': {'confirmed': True}}]
+        data = {'file': SimpleUploadedFile('sample.png', self.valid_image_path.read_bytes()),
+                'data': json.dumps({'annotation': {'labels': labels}})}
+        response = self.client.post(reverse('images-create'), data, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(reverse('annotation', kwargs={'image__file': 'sample.png'}))
+        self.assertEquals(response.json()['labels'], labels)
+
+
+class ImageSearchTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.url = reverse('images-search')
+        metas = {
+            'a.png': {'confirmed': True, 'confidence_percent': 0.95},
+            'b.png': {'confirmed': True, 'confidence_percent': 0.5},
+            'c.png': {'confirmed': False, 'confidence_percent': 0.99},
+            'd.png': {'confirmed': True, 'confidence_percent': 0.97},
+        }
+        for idx, (filename, meta) in enumerate(metas.items()):
+            labels = [{'id': f'00000000-0000-0000-0000-{idx:012d}', 'class_id': 'tooth', 'meta': meta}]
+            data = {'file': SimpleUploadedFile(filename, self.valid_image_path.read_bytes()),
+                    'data': json.dumps({'annotation': {'labels': labels}})}
+            self.client.post(reverse('images-create'), data, format='multipart')
+
+    def search(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def test_search(self):
+        result = self.search(class_id='tooth', confirmed='true', confidence_min=0.9)
+        self.assertEquals(result, {'results': ['a.png', 'd.png'], 'next': None})
+
+        self.assertEquals(self.search(confidence_max=0.6)['results'], ['b.png'])
+        self.assertEquals(self.search(confirmed='false')['results'], ['c.png'])
+        self.assertEquals(self.search(class_id='caries')['results'], [])
+
+    def test_pagination(self):
+        first_page = self.search(class_id='tooth', limit=3)
+        self.assertEquals(first_page['results'], ['a.png', 'b.png', 'c.png'])
+
+        second_page = self.search(class_id='tooth', limit=3, after=first_page['next'])
+        self.assertEquals(second_page, {'results': ['d.png'], 'next': None})
+
+    def test_search_after_update(self):
+        url = reverse('annotation', kwargs={'image__file': 'b.png'})
+        labels = [{'id': '00000000-0000-0000-0000-000000000001', 'class_id': 'tooth',
+                   'meta': {'confirmed': True, 'confidence_percent': 0.91}}]
+        self.client.put(url, {'labels': labels}, format='json')
+
+        self.assertEquals(self.search(confidence_min=0.9, confirmed='true')['results'], ['a.png', 'b.png', 'd.png'])
+
+
+class LabelRegionSearchTestCase(CommonTestCase):
+    BOXES = {
+        '00000000-0000-0000-0000-000000000001': (0, 0, 10, 10),
+        '00000000-0000-0000-0000-000000000002': (50, 50, 150, 100),
+        '00000000-0000-0000-0000-000000000003': (120, 40, 90, 10),  # start is further than end
+    }
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        labels = [{'id': label_id, 'class_id': 'tooth', 'shape': {'startX': x0, 'startY': y0, 'endX': x1, 'endY': y1}}
+                  for label_id, (x0, y0, x1, y1) in self.BOXES.items()]
+        data = {'file': open(self.valid_image_path, 'rb'), 'data': json.dumps({'annotation': {'labels': labels}})}
+        self.client.post(reverse('images-create'), data, format='multipart')
+        data['file'].close()
+
+    def search_labels(self, **params):
+        response = self.client.get(reverse('labels-search'), params)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return [label['id'][-1] for label in response.json()['results']]
+
+    def test_region(self):
+        self.assertEquals(self.search_labels(x0=5, y0=5, x1=60, y1=60), ['1', '2'])
+        self.assertEquals(self.search_labels(x0=0, y0=0, x1=130, y1=100, relation='within'), ['1', '3'])
+        self.assertEquals(self.search_labels(x0=0, y0=0, x1=130, y1=100, relation='within', image='sample.png'),
+                          ['1', '3'])
+        self.assertEquals(self.search_labels(x0=0, y0=0, x1=100, y1=100, image='other.png'), [])
+
+        response = self.client.get(reverse('images-search'), {'x0': 140, 'y0': 90, 'x1': 200, 'y1': 200})
+        self.assertEquals(response.json()['results'], ['sample.png'])
+
+        response = self.client.get(reverse('labels-search'), {'x0': 10, 'y0': 10, 'x1': 0})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_area(self):
+        self.assertEquals(self.search_labels(area_min=800), ['2', '3'])
+        self.assertEquals(self.search_labels(area_min=800, area_max=1000), ['3'])
+
+    def test_area_after_patch(self):
+        url = reverse('annotation', kwargs={'image__file': 'sample.png'})
+        shape = {'startX': 0, 'startY': 0, 'endX': 100, 'endY': 100}
+        self.client.patch(url, {'update': [{'id': '00000000-0000-0000-0000-000000000001', 'shape': shape}]},
+                          format='json')
+
+        self.assertEquals(self.search_labels(area_min=5000), ['1', '2'])
+
+
+class ImageListTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        labels = AnnotationLabelsDiffTestCase.make_labels(3)
+        labels[0]['meta'] = {'confirmed': True}
+        for idx in range(5):
+            annotation = {'annotation': {'labels': labels if idx == 1 else []}} if idx % 2 else None
+            data = {'file': SimpleUploadedFile(f'{idx}.png', self.valid_image_path.read_bytes()),
+                    'data': json.dumps(annotation) if annotation else ''}
+            self.client.post(reverse('images-create'), data, format='multipart')
+
+    def list_images(self, **params):
+        response = self.client.get(reverse('images-create'), params)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def test_pagination(self):
+        files, cursor = [], None
+        while True:
+            page = self.list_images(limit=2, **({'cursor': cursor} if cursor else {}))
+            files += [image['id'] for image in page['results']]
+            cursor = page['next']
+            if cursor is None:
+                break
+        self.assertEquals(files, [f'{idx}.png' for idx in range(5)])
+
+        response = self.client.get(reverse('images-create'), {'cursor': 'broken'})
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_items(self):
+        image = self.list_images(limit=2)['results'][1]
+        self.assertEquals(image['format'], 'PNG')
+        self.assertEquals(image['size'], os.path.getsize(self.valid_image_path))
+        self.assertEquals((image['annotated'], image['labels'], image['confirmed_labels']), (True, 3, 1))
+
+        with CaptureQueriesContext(connection) as context:
+            self.list_images()
+        self.assertEquals(len(context.captured_queries), 2)
+
+    def test_filters(self):
+        self.assertEquals([image['id'] for image in self.list_images(annotated='true')['results']], ['1.png', '3.png'])
+        self.assertEquals(len(self.list_images(annotated='false')['results']), 3)
+        self.assertEquals(len(self.list_images(format='png')['results']), 5)
+        self.assertEquals(self.list_images(format='jpeg')['results'], [])
+        self.assertEquals(self.list_images(size_max=100)['results'], [])
+
+
+class ImageMetadataTestCase(CommonTestCase):
+    def upload(self, filename):
+        data = {'file': SimpleUploadedFile(filename, self.valid_image_path.read_bytes())}
+        response = self.client.post(reverse('images-create'), data, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        return Image.objects.get(file=filename)
+
+    def test_stored_on_upload(self):
+        image = self.upload('image.png')
+        with PILImage.open(self.valid_image_path) as expected:
+            self.assertEquals((image.format, image.mime, image.width, image.height, image.mode),
+                              ('PNG', 'image/png', expected.width, expected.height, expected.mode))
+        self.assertEquals(image.size, os.path.getsize(self.valid_image_path))
+        self.assertEquals(image.sha256, hashlib.sha256(self.valid_image_path.read_bytes()).hexdigest())
+
+        with patch.object(default_storage, 'size') as size:
+            response = self.client.get(reverse('images-retrieve', kwargs={'file': 'image.png'}), {'delivery': 'proxy'})
+            self.assertEquals(b''.join(response.streaming_content), self.valid_image_path.read_bytes())
+        size.assert_not_called()
+        self.assertEquals(response['Content-Type'], 'image/png')
+
+    def test_backfill(self):
+        image = self.upload('image.png')
+        expected = model_to_dict(image, fields=['size', 'sha256', *Image.METADATA_FIELDS])
+        Image.objects.update(size=None, sha256='', mime='', width=None, height=None, mode='')
+
+        # images stored before blobs are read from the storage
+        with open(self.valid_image_path, 'rb') as file:
+            default_storage.save('legacy.png', File(file))
+        legacy = Image.objects.create(file='legacy.png')
+
+        output = StringIO()
+        call_command('backfill_image_metadata', '--batch-size=1', stdout=output, stderr=StringIO())
+        self.assertEquals(output.getvalue().strip(), 'Backfilled 2 images')
+
+        for instance in (image, legacy):
+            instance.refresh_from_db()
+            self.assertEquals(model_to_dict(instance, fields=['size', 'sha256', *Image.METADATA_FIELDS]), expected)
+
+
+class MetricsTestCase(CommonTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+
+        registry = MetricsRegistry()
+        for target in ('core.middleware.registry', 'core.views.metrics_registry'):
+            patcher = patch(target, registry)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_server_timing(self):
+        output = BytesIO()
+        PILImage.frombytes('L', (16, 16), os.urandom(16 * 16)).save(output, 'PNG')  # content that isn't stored yet
+        data = {'file': SimpleUploadedFile('noise.png', output.getvalue()), 'data': ''}
+        response = self.client.post(reverse('images-create'), data, format='multipart')
+
+        timings = dict(metric.split(';', 1) for metric in response['Server-Timing'].split(', '))
+        self.assertSetEqual(set(timings), {'db', 'storage', 'decode', 'parse', 'serialize', 'total'})
+        self.assertIn(f'{len(output.getvalue())} bytes', timings['storage'])
+
+        response = self.client.get(reverse('annotation', kwargs={'image__file': 'noise.png'}))
+        self.assertIn('serialize;', response['Server-Timing'])
+
+    def test_metrics(self):
+        self.upload_image(self.valid_image_path)
+        self.client.get(reverse('annotation', kwargs={'image__file': 'sample.png'}))
+
+        content = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('imagestore_requests_total{route="api/v1/images/",method="POST",status="201"} 1', content)
+        self.assertIn('imagestore_request_duration_seconds_count{route="api/v1/images/",method="POST"} 1', content)
+        self.assertIn('imagestore_request_duration_seconds_bucket{route="api/v1/images/<str:image__file>/annotation/",'
+                      'method="GET",le="+Inf"} 1', content)
+        self.assertIn('imagestore_request_component_calls_total{route="api/v1/images/",method="POST",'
+                      'component="decode"} 1', content)
+        self.assertIn('# TYPE imagestore_annotation_cache_misses_total counter', content)
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """Answers ranged GETs of objects the way S3 does, objects are kept in server.objects by path"""
+
+    def do_GET(self):
+        content = self.server.objects.get(unquote(urlsplit(self.path).path))
+        if content is None:
+            self.send_error(status.HTTP_404_NOT_FOUND)
+            return
+
+        start, _, end = self.headers.get('Range', 'bytes=0-').partition('=')[2].partition('-')
+        start, end = int(start), int(end) if end else len(content) - 1
+        body = content[start:end + 1]
+
+        self.send_response(status.HTTP_206_PARTIAL_CONTENT if 'Range' in self.headers else status.HTTP_200_OK)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AsgiDownloadTestCase(TransactionTestCase):
+    """Downloads served by the ASGI application from a fake S3 server running in the process"""
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        client = Minio(f'127.0.0.1:{self.server.server_port}', access_key='access', secret_key='secret',
+                       secure=False, region='us-east-1')
+        storage_patcher = patch('core.storage.default_storage', Mock(client=client, bucket_name='media'))
+        storage_patcher.start()
+        self.addCleanup(storage_patcher.stop)
+
+        self.content = os.urandom(300 * 1024)
+        blob = Blob.objects.create(sha256=hashlib.sha256(self.content).hexdigest(), size=len(self.content),
+                                   ref_count=1)
+        Image.objects.create(file='scan.png', blob=blob)
+        self.server.objects = {f'/media/{blob.key}': self.content}
+
+        self.application = ASGIHandler()
+        self.path = reverse('images-retrieve', kwargs={'file': 'scan.png'})
+
+    async def get(self, headers=(), send_delay=0, started=None, resume=None):
+        """Makes a GET request to the application, returns the status, the headers and the body of the response"""
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': self.path, 'raw_path': self.path.encode(), 'query_string': b'', 'root_path': '',
+            'headers': [(b'host', b'testserver'), *headers], 'client': ('127.0.0.1', 1), 'server': ('testserver', 80),
+        }
+        requested = asyncio.Event()
+        messages = []
+
+        async def receive():
+            if not requested.is_set():
+                requested.set()
+                return {'type': 'http.request', 'body': b''}
+            await asyncio.Event().wait()  # the client doesn't disconnect
+
+        async def send(message):
+            if message['type'] == 'http.response.body' and started is not None and not started.done():
+                started.set_result(None)
+                await resume.wait()
+            messages.append(message)
+            await asyncio.sleep(send_delay)
+
+        await self.application(scope, receive, send)
+        body = b''.join(message.get('body', b'') for message in messages[1:])
+        return messages[0]['status'], dict(messages[0]['headers']), body
+
+    def test_download(self):
+        response_status, headers, body = asyncio.run(self.get())
+        self.assertEquals(response_status, status.HTTP_200_OK)
+        self.assertEquals(int(headers[b'Content-Length']), len(self.content))
+        self.assertEquals(body, self.content)
+
+    def test_range_download(self):
+        response_status, headers, body = asyncio.run(self.get([(b'range', b'bytes=1000-280000')]))
+        self.assertEquals(response_status, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEquals(body, self.content[1000:280001])
+
+    @override_settings(ASYNC_DOWNLOAD_CHUNK_SIZE=64 * 1024)
+    def test_slow_downloads_dont_hold_threads(self):
+        self.assert_slow_downloads_dont_hold_threads()
+
+    def test_slow_cached_downloads_dont_hold_threads(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = DiskCache(directory.name, len(self.content))
+        b''.join(cache.fill(hashlib.sha256(self.content).hexdigest(), len(self.content),
+                            (chunk for chunk in [self.content])))
+        Image.objects.update(sha256=hashlib.sha256(self.content).hexdigest())
+        self.server.objects = {}  # served from the local disk only
+
+        with patch('core.views.media_cache', cache):
+            self.assert_slow_downloads_dont_hold_threads()
+            response_status, _, body = asyncio.run(self.get([(b'range', b'bytes=1000-280000')]))
+        self.assertEquals((response_status, body), (status.HTTP_206_PARTIAL_CONTENT, self.content[1000:280001]))
+
+    def assert_slow_downloads_dont_hold_threads(self):
+        downloads = 200
+
+        async def run():
+            resume = asyncio.Event()
+            started = [asyncio.get_running_loop().create_future() for _ in range(downloads)]
+            tasks = [asyncio.ensure_future(self.get(send_delay=0.01, started=future, resume=resume))
+                     for future in started]
+
+            # every download is in progress and waits for its client, threads of their requests are released
+            await asyncio.gather(*started)
+            for _ in range(100):
+                if threading.active_count() < downloads / 4:
+                    break
+                await asyncio.sleep(0.05)
+            threads = threading.active_count()
+
+            resume.set()
+            return threads, await asyncio.gather(*tasks)
+
+        threads, responses = asyncio.run(run())
+        self.assertLess(threads, downloads / 4)
+        self.assertTrue(all(body == self.content for _, _, body in responses))
@@ -1,9 +1,25 @@
 from django.urls import path
 
-from core.views import ImageView, AnnotationView
+from core.views import ImageView, AnnotationView, AnnotationCacheStatsView, UploadView, AnnotationExportView, \
+    BlobView, MetricsView, ImageSearchView, LabelSearchView, MediaCacheStatsView, DatasetExportView, AnnotationBatchView
 
 urlpatterns = [
-    path('v1/images/', ImageView.as_view({'post': 'create'}), name='images-create'),
+    path('v1/images/', ImageView.as_view({'post': 'create', 'get': 'list'}), name='images-create'),
+    path('v1/images/batch/', ImageView.as_view({'post': 'batch'}), name='images-batch'),
+    path('v1/images/search/', ImageSearchView.as_view(), name='images-search'),
     path('v1/images/<str:file>/', ImageView.as_view({'get': 'retrieve'}), name='images-retrieve'),
+    path('v1/images/<str:file>/rendition/', ImageView.as_view({'get': 'rendition'}), name='images-rendition'),
+    path('v1/images/<str:file>/processing/', ImageView.as_view({'get': 'processing'}), name='images-processing'),
     path('v1/images/<str:image__file>/annotation/', AnnotationView.as_view(), name='annotation'),
+    path('v1/annotations/batch/', AnnotationBatchView.as_view(), name='annotations-batch'),
+    path('v1/annotations/export/', AnnotationExportView.as_view(), name='annotations-export'),
+    path('v1/datasets/export/', DatasetExportView.as_view(), name='datasets-export'),
+    path('v1/labels/search/', LabelSearchView.as_view(), name='labels-search'),
+    path('v1/blobs/<str:sha256>/', BlobView.as_view({'get': 'retrieve'}), name='blobs-retrieve'),
+    path('v1/blobs/<str:sha256>/images/', BlobView.as_view({'post': 'create_image'}), name='blobs-images'),
+    path('v1/uploads/', UploadView.as_view({'post': 'create'}), name='uploads-create'),
+    path('v1/uploads/<str:file>/finalize/', UploadView.as_view({'post': 'finalize'}), name='uploads-finalize'),
+    path('v1/stats/annotation-cache/', AnnotationCacheStatsView.as_view(), name='annotation-cache-stats'),
+    path('v1/stats/media-cache/', MediaCacheStatsView.as_view(), name='media-cache-stats'),
+    path('v1/metrics/', MetricsView.as_view(), name='metrics'),
 ]
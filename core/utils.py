@@ -1,11 +1,31 @@
+import codecs
+import hashlib
 import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 
-from django.http import QueryDict
-from rest_framework import parsers
+from django.conf import settings
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.http import StreamingHttpResponse
+from django.utils.datastructures import MultiValueDict
+from django.utils.dateparse import parse_datetime
+from rest_framework import parsers, renderers
+from rest_framework.exceptions import ParseError
+
+try:
+    import orjson
+except ImportError:  # the standard library is used then
+    orjson = None
+
+from core import metrics
 
 
 class MultipartJsonParser(parsers.MultiPartParser):
+    """
+    Multipart parser of uploads with their JSON in the data field. The parsed JSON is handed to serializers
+    as a plain dict, so nested annotation data doesn't go through a QueryDict and back
+    """
 
+    @metrics.timer('parse')
     def parse(self, stream, media_type=None, parser_context=None):
         result = super().parse(
             stream,
@@ -14,12 +34,157 @@ class MultipartJsonParser(parsers.MultiPartParser):
         )
 
         # find the data field and parse it
-        qdict = QueryDict('', mutable=True)
+        data = MultipartData()
         if 'data' in result.data:
             try:
-                data = json.loads(result.data['data'])
-            except json.decoder.JSONDecodeError:
+                parsed = json_loads(result.data['data'])
+            except ValueError:
                 pass
             else:
-                qdict.update(data)
-        return parsers.DataAndFiles(qdict, result.files)
+                if isinstance(parsed, dict):
+                    data.update(parsed)
+        return parsers.DataAndFiles(data, result.files)
+
+
+class MultipartData(dict):
+    """Parsed data of a multipart request, DRF merges files into it with the last file of every name"""
+
+    def copy(self):
+        return MultipartData(self)
+
+    def update(self, other=(), **kwargs):
+        super().update(other.items() if isinstance(other, MultiValueDict) else other, **kwargs)
+
+
+def json_loads(content):
+    return orjson.loads(content) if orjson is not None else json.loads(content)
+
+
+class JSONParser(parsers.JSONParser):
+    """Parses JSON with orjson if it's installed, otherwise with the standard library like DRF does"""
+
+    @metrics.timer('parse')
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or codecs.lookup(encoding).name != 'utf-8':
+            return super().parse(stream, media_type, parser_context)
+
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """
+    Renders JSON with orjson if it's installed. Types orjson doesn't know, e.g. Decimal or lazy strings, are converted
+    by the encoder of DRF, indented output of the browsable API is rendered by DRF itself
+    """
+    ORJSON_OPTIONS = orjson and orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    @metrics.timer('serialize')
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            content = orjson.dumps(data, default=self.encoder_class().default, option=self.ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:  # e.g. integers beyond 64 bits
+            return super().render(data, accepted_media_type, renderer_context)
+        # escaped like DRF does, so the JSON can be embedded in JavaScript
+        return content.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class HashingUploadHandlerMixin:
+    """Computes SHA-256 of uploaded files while they're streamed, the digest is kept in file.sha256"""
+
+    def new_file(self, *args, **kwargs):
+        self.digest = hashlib.sha256()
+        return super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        result = super().receive_data_chunk(raw_data, start)
+        if result is None:  # only the handler that keeps the data hashes it
+            self.digest.update(raw_data)
+        return result
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    pass
+
+
+MAX_RANGES = 16  # more ranges in one request are served as the whole file
+
+
+def parse_range_header(header, size):
+    """
+    Parses 'Range: bytes=...' header into a list of inclusive (start, end) pairs.
+    Returns None if the header is missing or malformed, so the whole file is served,
+    and an empty list if none of the ranges can be satisfied
+    """
+    unit, _, ranges_spec = (header or '').partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+
+    specs = ranges_spec.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if not sep or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+            return None
+
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+        elif int(last):  # suffix range: last N bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            continue
+
+        if start < size:
+            ranges.append((start, end))
+
+    return ranges
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+    Streaming response with the same content available as an async iterator as well.
+    core.asgi.ASGIHandler sends the async content, WSGI servers iterate the regular one
+    """
+
+    def __init__(self, streaming_content, async_streaming_content, *args, **kwargs):
+        super().__init__(streaming_content, *args, **kwargs)
+        self.async_streaming_content = async_streaming_content
+
+
+def encode_cursor(created_at, row_id):
+    """Opaque cursor of a (created_at, id) keyset position"""
+    return urlsafe_b64encode(f'{created_at.isoformat()}|{row_id}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns (created_at, id) of the cursor, raises ValueError if it's malformed"""
+    try:
+        created_at, _, row_id = urlsafe_b64decode(cursor.encode()).decode().partition('|')
+        created_at = parse_datetime(created_at)
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if created_at is None:
+        raise ValueError('Invalid cursor')
+    return created_at, int(row_id)
@@ -1,40 +1,395 @@
-from django.http import FileResponse
+import time
+import uuid
+from functools import partial
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.http import parse_etags, http_date, parse_http_date_safe
 from rest_framework import mixins, status
 from rest_framework.generics import RetrieveUpdateAPIView
 from rest_framework.parsers import FormParser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 
-from core.models import Image, Annotation
-from core.serializers import ImageSerializer, AnnotationSerializer
-from core.utils import MultipartJsonParser
+from core.cache import annotation_cache
+from core.disk_cache import media_cache, iter_file_range, aiter_file_range
+from core.datasets import iter_dataset, ARCHIVES as DATASET_ARCHIVES
+from core.export import iter_annotations, iter_ndjson, fetch_annotations
+from core.ingest import BatchItem, ingest_batch
+from core.models import Image, Annotation, UploadReservation, Blob
+from core.serializers import ImageSerializer, AnnotationSerializer, UploadReservationSerializer, \
+    UploadFinalizeSerializer, RenditionSerializer, AnnotationExportSerializer, AnnotationPatchSerializer, \
+    BlobImageSerializer, ImageSearchSerializer, LabelSearchSerializer, ImageListSerializer, DatasetExportSerializer, \
+    AnnotationBatchSerializer
+from core.search import search_images, search_labels, list_images
+from core.renditions import rendition_service, FORMATS as RENDITION_FORMATS
+from core.storage import presigned_download_url, get_minio_client, iter_range, aiter_range
+from core.metrics import registry as metrics_registry
+from core.utils import MultipartJsonParser, parse_range_header, AsyncStreamingHttpResponse, JSONRenderer
 
 
 class ImageView(mixins.CreateModelMixin,
                 mixins.RetrieveModelMixin,
                 GenericViewSet):
-    queryset = Image.objects.all()
+    queryset = Image.objects.select_related('blob')
     lookup_field = 'file'
     serializer_class = ImageSerializer
 
     parser_classes = (MultipartJsonParser, FormParser,)  # content type: multipart/form-data
 
+    DELIVERY_MODES = ['proxy', 'redirect', 'url']
+
+    def list(self, request, *args, **kwargs):
+        params = ImageListSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        images, cursor = list_images(**params.validated_data)
+        return Response({'results': images, 'next': cursor})
+
+    def batch(self, request, *args, **kwargs):
+        files = request.FILES.getlist('files')
+        if not files:
+            return Response({'files': ['No files were submitted.']}, status=status.HTTP_400_BAD_REQUEST)
+        if len(files) > settings.BATCH_UPLOAD_MAX_FILES:
+            msg = f'Too many files. Maximum is {settings.BATCH_UPLOAD_MAX_FILES}'
+            return Response({'files': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+
+        annotations = request.data.get('annotations') or {}  # annotation data by original filename
+        if not isinstance(annotations, dict):
+            msg = 'Expected an object of annotations by filename.'
+            return Response({'annotations': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+        items = [BatchItem(file, annotations.get(file.name)) for file in files]
+
+        return Response({'results': ingest_batch(items)})
+
     def retrieve(self, request, *args, **kwargs):
+        delivery = request.query_params.get('delivery', settings.MEDIA_DOWNLOAD_MODE).lower()
+        if delivery not in self.DELIVERY_MODES:
+            msg = f'Unknown delivery mode. Supported modes: {self.DELIVERY_MODES}'
+            return Response({'delivery': [msg]}, status=status.HTTP_400_BAD_REQUEST)
+
+        instance = self.get_object()
+
+        # clients fetch the file from the storage directly, falls back to proxying if the storage can't sign urls
+        presigned = presigned_download_url(instance.storage_name, instance.file.name) if delivery != 'proxy' else None
+        if presigned is not None:
+            url, expires_at = presigned
+            expires_in = int(expires_at - time.time())
+
+            if delivery == 'redirect':
+                response = HttpResponseRedirect(url)
+            else:
+                response = Response({'url': url, 'expires_in': expires_in})
+            response['Cache-Control'] = f'private, max-age={expires_in}'
+            return response
+
+        return self.proxy_response(request, instance)
+
+    def rendition(self, request, *args, **kwargs):
+        params = RenditionSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        width, height, format_key = params.validated_data['w'], params.validated_data['h'], params.validated_data['fmt']
+
         instance = self.get_object()
-        file_handle = instance.file.open()
+        content = rendition_service.get(instance.storage_name, width, height, format_key)
 
-        extension = instance.file.name.rpartition('.')[2] or '*'
-        response = FileResponse(file_handle, content_type=f'image/{extension}')
-        response['Content-Length'] = instance.file.size
-        response['Content-Disposition'] = f'attachment; filename="{instance.file.name}"'
+        _, content_type = RENDITION_FORMATS[format_key]
+        response = HttpResponse(content, content_type=content_type)
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'  # stored images are never modified
 
         return response
 
+    def processing(self, request, *args, **kwargs):
+        instance = self.get_object()
+        jobs = instance.jobs.order_by('id').values('stage', 'status', 'attempts', 'error')
+        return Response({'id': instance.file.name, 'status': instance.processing_status, 'jobs': list(jobs)})
+
+    @staticmethod
+    def image_etag(instance):
+        return f'"{instance.id}.{int(instance.created_at.timestamp())}"'  # images are never modified after upload
+
+    @staticmethod
+    def if_range_matches(request, etag, last_modified):
+        if_range = request.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if if_range.startswith(('"', 'W/')):
+            return if_range == etag  # weak tags never match
+        return parse_http_date_safe(if_range) == parse_http_date_safe(last_modified)
+
+    def proxy_response(self, request, instance):
+        name = instance.file.name
+        storage_name = instance.storage_name
+        size = instance.size
+        if size is None:  # images that aren't backfilled yet
+            size = instance.blob.size if instance.blob_id else instance.file.size
+        content_type = instance.mime or f'image/{name.rpartition(".")[2] or "*"}'
+        etag = self.image_etag(instance)
+        last_modified = http_date(instance.created_at.timestamp())
+
+        ranges = parse_range_header(request.headers.get('Range'), size)
+        if ranges is not None and not self.if_range_matches(request, etag, last_modified):
+            ranges = None
+
+        # cached files are keyed by content hash, or by version for images that weren't hashed
+        cache_key = instance.sha256 or etag
+        cached = media_cache.open(cache_key) if ranges != [] else None
+
+        if ranges is None:
+            response = self.stream_response(storage_name, [(b'', 0, size)], cached=cached,
+                                            fill_key=cache_key if cached is None else None, content_type=content_type)
+            response['Content-Length'] = size
+        elif not ranges:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{size}'
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            response = self.stream_response(storage_name, [(b'', start, end - start + 1)], cached=cached,
+                                            status=status.HTTP_206_PARTIAL_CONTENT, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = end - start + 1
+        else:
+            response = self.multipart_ranges_response(storage_name, ranges, size, content_type, cached)
+
+        if cached is not None:
+            media_cache.record_saved(int(response['Content-Length']))
+
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        response['Content-Disposition'] = f'attachment; filename="{name}"'
+
+        return response
+
+    @classmethod
+    def multipart_ranges_response(cls, name, ranges, size, content_type, cached=None):
+        boundary = uuid.uuid4().hex
+        parts = [
+            ((f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\n'
+              f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode(), start, end - start + 1)
+            for start, end in ranges
+        ]
+        closing = f'\r\n--{boundary}--\r\n'.encode()
+
+        response = cls.stream_response(name, parts, closing, cached=cached, status=status.HTTP_206_PARTIAL_CONTENT,
+                                       content_type=f'multipart/byteranges; boundary={boundary}')
+        response['Content-Length'] = sum(len(prefix) + length for prefix, _, length in parts) + len(closing)
+        return response
+
+    @staticmethod
+    def stream_response(name, parts, closing=b'', cached=None, fill_key=None, **kwargs):
+        """
+        Streams (prefix, start, length) parts of the stored file, each one after its prefix. Parts are read from
+        cached, the file opened from the local disk cache, if it's given, or from the storage otherwise. Under ASGI
+        every chunk is read in a worker thread of its own, so a download in progress doesn't hold a thread.
+        The whole file streamed with fill_key is written to the local disk cache on the way
+        """
+        def stream(read_range):
+            for prefix, start, length in parts:
+                if prefix:
+                    yield prefix
+                yield from read_range(start, length)
+            if closing:
+                yield closing
+
+        async def async_stream(aread_range):
+            for prefix, start, length in parts:
+                if prefix:
+                    yield prefix
+                async for chunk in aread_range(start, length):
+                    yield chunk
+            if closing:
+                yield closing
+
+        if cached is not None:
+            # only one of the streams is iterated, it closes the file
+            def cached_stream():
+                with cached:
+                    yield from stream(partial(iter_file_range, cached))
+
+            async def async_cached_stream():
+                try:
+                    async for chunk in async_stream(partial(aiter_file_range, cached)):
+                        yield chunk
+                finally:
+                    cached.close()
+
+            return AsyncStreamingHttpResponse(cached_stream(), async_cached_stream(), **kwargs)
+
+        content, async_content = stream(partial(iter_range, name)), async_stream(partial(aiter_range, name))
+        if fill_key is not None:
+            [(_, _, size)] = parts
+            content = media_cache.fill(fill_key, size, content)
+            async_content = media_cache.afill(fill_key, size, async_content)
+        return AsyncStreamingHttpResponse(content, async_content, **kwargs)
+
+
+class ImageSearchView(APIView):
+    """Finds images by their labels, pages are requested with the cursor of the previous page"""
+
+    def get(self, request, *args, **kwargs):
+        params = ImageSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        files, cursor = search_images(**params.validated_data)
+        return Response({'results': files, 'next': cursor})
+
+
+class LabelSearchView(APIView):
+    """Finds labels by their box, class and confidence across the store or within an image"""
+
+    def get(self, request, *args, **kwargs):
+        params = LabelSearchSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        labels, cursor = search_labels(**params.validated_data)
+        return Response({'results': labels, 'next': cursor})
+
+
+class UploadView(mixins.CreateModelMixin,
+                 GenericViewSet):
+    """Two-step upload: a filename is reserved for a presigned PUT url first, then the uploaded file is finalized"""
+    queryset = UploadReservation.objects.all()
+    lookup_field = 'file'
+    serializer_class = UploadReservationSerializer
+
+    def create(self, request, *args, **kwargs):
+        if get_minio_client() is None:
+            return Response({'detail': 'Storage does not support direct uploads'},
+                            status=status.HTTP_501_NOT_IMPLEMENTED)
+        return super().create(request, *args, **kwargs)
+
+    def finalize(self, request, *args, **kwargs):
+        serializer = UploadFinalizeSerializer(data={}, context={'reservation': self.get_object()})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class BlobView(mixins.RetrieveModelMixin,
+               GenericViewSet):
+    """Lets clients check whether content is already stored and create images from it without sending the bytes"""
+    queryset = Blob.objects.filter(ref_count__gt=0)
+    lookup_field = 'sha256'
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return Response({'sha256': instance.sha256, 'size': instance.size})
+
+    def create_image(self, request, *args, **kwargs):
+        serializer = BlobImageSerializer(data=request.data, context={'sha256': kwargs['sha256']})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
 
 class AnnotationView(RetrieveUpdateAPIView):
     queryset = Annotation.objects.all()
     lookup_field = 'image__file'
     serializer_class = AnnotationSerializer
 
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        format_key = AnnotationSerializer.EXPORT_FORMAT_KEY if AnnotationSerializer.is_export(request) else 'internal'
+        renderer = request.accepted_renderer
+        etag = f'"{instance.id}.{instance.version}.{format_key}.{renderer.format}"'
+
+        # compared the weak way like Django does, proxies may weaken the tag of compressed responses
+        if_none_match = [tag[2:] if tag.startswith('W/') else tag
+                         for tag in parse_etags(request.headers.get('If-None-Match', ''))]
+        if etag in if_none_match or '*' in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif isinstance(renderer, JSONRenderer) and request.accepted_media_type == renderer.media_type:
+            # plain JSON is the same for every request, so it's rendered once per version
+            content = annotation_cache.get(instance, format_key)
+            if content is None:
+                content = renderer.render(self.get_serializer(instance).data, renderer.media_type)
+                annotation_cache.set(instance, format_key, content)
+            response = HttpResponse(content, content_type=renderer.media_type)
+        else:
+            response = Response(self.get_serializer(instance).data)
+
+        response['ETag'] = etag
+        return response
+
     def patch(self, request, *args, **kwargs):
-        return Response(status=status.HTTP_501_NOT_IMPLEMENTED)
+        instance = self.get_object()
+        serializer = AnnotationPatchSerializer(instance, data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+
+        return Response(self.get_serializer(instance).data)
+
+
+class AnnotationBatchView(APIView):
+    """Returns annotations of many images by file, files without an annotation get a not found entry"""
+
+    def post(self, request, *args, **kwargs):
+        params = AnnotationBatchSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+
+        export = params.validated_data['format'] == AnnotationSerializer.EXPORT_FORMAT_KEY
+        annotations = fetch_annotations(params.validated_data['files'], export=export)
+        results = {file: annotation if annotation is not None else {'detail': 'Not found.'}
+                   for file, annotation in annotations.items()}
+        return Response({'results': results})
+
+
+class AnnotationExportView(APIView):
+    """Streams annotations of the whole store as NDJSON, one line per image"""
+
+    def get(self, request, *args, **kwargs):
+        params = AnnotationExportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        filters = dict(params.validated_data)
+        export = filters.pop('format') == AnnotationSerializer.EXPORT_FORMAT_KEY
+        annotations = iter_annotations(export=export, **filters)
+
+        return StreamingHttpResponse(iter_ndjson(annotations), content_type='application/x-ndjson')
+
+
+class DatasetExportView(APIView):
+    """Streams annotated images with their labels as a ZIP or TAR archive in COCO or YOLO layout"""
+
+    def get(self, request, *args, **kwargs):
+        params = DatasetExportSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        options = dict(params.validated_data)
+        export = options.pop('format') == AnnotationSerializer.EXPORT_FORMAT_KEY
+        archive = options['archive']
+
+        response = StreamingHttpResponse(iter_dataset(export=export, **options), content_type=DATASET_ARCHIVES[archive])
+        response['Content-Disposition'] = f'attachment; filename="dataset.{options["layout"]}.{archive}"'
+        return response
+
+
+class AnnotationCacheStatsView(APIView):
+    def get(self, request, *args, **kwargs):
+        return Response(annotation_cache.stats())
+
+
+class MediaCacheStatsView(APIView):
+    def get(self, request, *args, **kwargs):
+        return Response(media_cache.stats())
+
+
+class MetricsView(APIView):
+    """Request metrics of this process in Prometheus text format"""
+
+    def get(self, request, *args, **kwargs):
+        cache_stats = annotation_cache.stats()
+        media_stats = media_cache.stats()
+        content = metrics_registry.render([
+            ('imagestore_annotation_cache_hits_total', 'counter', cache_stats['hits']),
+            ('imagestore_annotation_cache_misses_total', 'counter', cache_stats['misses']),
+            ('imagestore_media_cache_hits_total', 'counter', media_stats['hits']),
+            ('imagestore_media_cache_misses_total', 'counter', media_stats['misses']),
+            ('imagestore_media_cache_saved_bytes_total', 'counter', media_stats['saved_bytes']),
+            ('imagestore_media_cache_bytes', 'gauge', media_stats['size']),
+        ])
+        return HttpResponse(content, content_type='text/plain; version=0.0.4')